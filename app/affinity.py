@@ -0,0 +1,165 @@
+"""
+Afinidad chat → instancia para despliegues con varias instancias.
+Las sesiones de agente viven en la RAM de una instancia (app.sessions), pero el
+balanceador reparte los webhooks al azar. Este registro en Redis asigna cada
+chat a la instancia que tiene su sesión caliente:
+- `affinity:chat:{dialog_id}` guarda la instancia dueña con un lease
+  (AFFINITY_CHAT_TTL, renovado en cada mensaje).
+- `affinity:instances` (ZSET) guarda el último heartbeat de cada instancia; una
+  instancia sin heartbeat en AFFINITY_INSTANCE_TTL se da por muerta y sus
+  chats quedan libres para quien reciba el siguiente mensaje.
+La cola de ingesta consulta `route()` antes de procesar un evento y, si el chat
+es de otra instancia viva, lo reenvía a la cola propia de esa instancia.
+Al apagar (scale-down) la instancia se marca como muerta, libera sus chats y
+devuelve su cola a la cola compartida (ver IngestionQueue.stop).
+"""
+import logging
+import os
+import time
+import socket
+import asyncio
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+AFFINITY_ENABLED = os.getenv("AFFINITY_ENABLED", "true").lower() in ("1", "true", "yes")
+# Igual al TTL de las sesiones: pasado ese tiempo la sesión ya no está caliente
+AFFINITY_CHAT_TTL = int(os.getenv("AFFINITY_CHAT_TTL", str(30 * 60)))
+AFFINITY_HEARTBEAT_SECONDS = float(os.getenv("AFFINITY_HEARTBEAT_SECONDS", "5"))
+AFFINITY_INSTANCE_TTL = float(os.getenv("AFFINITY_INSTANCE_TTL", "20"))
+# Tiempo que una instancia tiene reservada la adopción de la cola de otra
+AFFINITY_ADOPT_LOCK_MS = 60000
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+_OWNED_PRUNE_AT = 10000
+REGISTRY_KEY = "affinity:instances"
+CHAT_KEY_PREFIX = "affinity:chat"
+ADOPT_KEY_PREFIX = "affinity:adopt"
+
+# Retorna la instancia que debe procesar el chat. Si el dueño registrado está
+# vivo y no es esta instancia, se respeta; si no, esta instancia toma el chat.
+# KEYS: chat, registro ; ARGV: instancia, ttl_ms, now_ms, instance_ttl_ms
+_ROUTE_LUA = """
+local me = ARGV[1]
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= me then
+    local seen = tonumber(redis.call('ZSCORE', KEYS[2], owner))
+    if seen and seen > tonumber(ARGV[3]) - tonumber(ARGV[4]) then
+        return owner
+    end
+end
+redis.call('SET', KEYS[1], me, 'PX', tonumber(ARGV[2]))
+if owner and owner ~= me then
+    return {me, owner}
+end
+return me
+"""
+
+# Libera el chat solo si sigue siendo de esta instancia
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ChatAffinity:
+    """Registro de dueños de chat con leases y heartbeat de instancias."""
+
+    def __init__(self, redis, instance_id: str = INSTANCE_ID):
+        self._redis = redis
+        self.instance_id = instance_id
+        # Chats tomados por esta instancia -> vencimiento local del lease (para liberarlos al salir)
+        self._owned: dict[str, float] = {}
+        self._heartbeat_task: asyncio.Task | None = None
+        self._stats = defaultdict(int)
+
+    def _chat_key(self, chat_id: str) -> str:
+        return f"{CHAT_KEY_PREFIX}:{chat_id}"
+
+    async def start(self):
+        await self._beat()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        logger.info(f"🧲 [Affinity] Instancia {self.instance_id} registrada")
+
+    async def _beat(self):
+        await self._redis.zadd(REGISTRY_KEY, {self.instance_id: int(time.time() * 1000)})
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(AFFINITY_HEARTBEAT_SECONDS)
+            try:
+                await self._beat()
+            except Exception as e:
+                logger.warning(f"⚠️ [Affinity] Error en heartbeat: {e}")
+
+    async def route(self, chat_id: str) -> str:
+        """Instancia que debe procesar el mensaje del chat (toma el chat si no tiene dueño vivo)."""
+        result = await self._redis.eval(
+            _ROUTE_LUA, 2, self._chat_key(chat_id), REGISTRY_KEY, self.instance_id,
+            AFFINITY_CHAT_TTL * 1000, int(time.time() * 1000), int(AFFINITY_INSTANCE_TTL * 1000),
+        )
+        if isinstance(result, list):
+            # El dueño anterior está muerto o se fue: el chat pasa a esta instancia
+            self._stats["taken_over"] += 1
+            result = result[0]
+        if result == self.instance_id:
+            now = time.monotonic()
+            self._owned[chat_id] = now + AFFINITY_CHAT_TTL
+            if len(self._owned) > _OWNED_PRUNE_AT:
+                self._owned = {c: exp for c, exp in self._owned.items() if exp > now}
+            self._stats["local"] += 1
+        else:
+            self._stats["forwarded"] += 1
+        return result
+
+    async def dead_instances(self) -> list[str]:
+        """Instancias registradas sin heartbeat reciente (caídas o ya apagadas)."""
+        cutoff = int((time.time() - AFFINITY_INSTANCE_TTL) * 1000)
+        dead = await self._redis.zrangebyscore(REGISTRY_KEY, "-inf", cutoff)
+        return [d for d in dead if d != self.instance_id]
+
+    async def claim_adoption(self, instance_id: str) -> bool:
+        """Reserva a esta instancia la adopción de la cola de `instance_id` (una sola lo hace)."""
+        return bool(await self._redis.set(
+            f"{ADOPT_KEY_PREFIX}:{instance_id}", self.instance_id, nx=True, px=AFFINITY_ADOPT_LOCK_MS
+        ))
+
+    async def forget(self, instance_id: str):
+        await self._redis.zrem(REGISTRY_KEY, instance_id)
+
+    async def release_all(self) -> int:
+        """Libera los chats que siguen siendo de esta instancia."""
+        now = time.monotonic()
+        owned = [chat_id for chat_id, expires in self._owned.items() if expires > now]
+        self._owned.clear()
+        if not owned:
+            return 0
+        pipe = self._redis.pipeline(transaction=False)
+        for chat_id in owned:
+            pipe.eval(_RELEASE_LUA, 1, self._chat_key(chat_id), self.instance_id)
+        released = sum(int(r or 0) for r in await pipe.execute())
+        self._stats["released"] += released
+        return released
+
+    async def stop(self) -> bool:
+        """
+        Sale del registro para el scale-down: se marca como muerta (nadie le reenvía
+        más eventos) y libera sus chats. Retorna True si esta instancia se reservó la
+        devolución de su propia cola; los reenvíos que lleguen tarde los adopta otra
+        instancia cuando vence la reserva.
+        """
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        await self._redis.zadd(REGISTRY_KEY, {self.instance_id: 0})
+        released = await self.release_all()
+        logger.info(f"🧲 [Affinity] {released} chats liberados por {self.instance_id}")
+        return await self.claim_adoption(self.instance_id)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "instance": self.instance_id,
+            "owned_chats": sum(1 for expires in self._owned.values() if expires > now),
+            **self._stats,
+        }
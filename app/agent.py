@@ -2,34 +2,36 @@
 Módulo principal del agente AI.
 Coordina la gestión de sesiones, la interacción con el LLM.
 """
+import logging
 import asyncio
-import traceback
-import sys
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+from app.log import debug_sampled
 
-from app.memory import add_message
+logger = logging.getLogger(__name__)
+
+from app.memory import add_message, get_summary, format_turn_context, trim_live_history
+from app.prompt_cache import set_memory_message, with_volatile_context
 from app.sessions import (
-    get_chat_lock, get_session, set_session, 
-    create_new_session, cleanup_expired_sessions, remove_session
+    get_chat_lock, get_session, set_session, account_session,
+    create_new_session, cleanup_expired_sessions, remove_session, refresh_session_config
 )
 from app.bitrix import send_typing_indicator
 from app.metrics import MetricsService
+from app.telemetry import SESSION_CREATE_SECONDS, ERRORS
+from app.chat_lock import ChatLockTimeout
+from app.session_snapshot import schedule_snapshot, memory_text_for
 
-async def get_response(user_message: str, chat_id: str, event_token: str = None, client_endpoint: str = None, session_id: int = None, user_name: str = None, user_id: str = None, chat_id_num: int = None) -> str:
+async def get_response(user_message: str, chat_id: str, event_token: str = None, client_endpoint: str = None, session_id: int = None, user_name: str = None, user_id: str = None, chat_id_num: int = None, reply=None) -> str:
     """
     Envía un mensaje al agente AI y retorna la respuesta.
     Recibe chat_id (dialog_id) y opcionalmente chat_id_num (el ID numérico para tools).
+    Si se pasa `reply` (ProgressiveReply), los deltas del LLM se entregan mientras se generan.
     """
     # Typing indicator usa token del EVENTO (para que Bitrix sepa quién escribe)
     if event_token and client_endpoint:
         asyncio.create_task(send_typing_indicator(event_token, client_endpoint, chat_id, "on"))
 
-    # Obtener lock específico para este chat
+    # Obtener lock específico para este chat (turno FIFO; la espera se mide en app.chat_lock)
     chat_lock = await get_chat_lock(chat_id)
 
     try:
@@ -41,57 +43,72 @@ async def get_response(user_message: str, chat_id: str, event_token: str = None,
             if session is None or session.is_expired():
                 if session and session.is_expired():
                     try:
-                        await session.agent.__aexit__(None, None, None)
+                        await session.close()
                     except Exception:
                         pass
-                session = await create_new_session(chat_id)
+                with SESSION_CREATE_SECONDS.time():
+                    session = await create_new_session(chat_id)
                 await set_session(chat_id, session)
+            elif session.config_stale:
+                # Cambió el prompt/config del bot en Firestore mientras la sesión estaba viva
+                session = await refresh_session_config(chat_id, session)
 
             session.touch()
+            session.busy = True
 
             try:
+                # Mantener el historial vivo del LLM dentro del presupuesto de tokens
+                if trim_live_history(session.llm):
+                    session.last_context = None  # el turno que traía el contexto pudo salir
+                    summary = await get_summary(chat_id)
+                    memory_text = memory_text_for(
+                        f"--- RESUMEN DE LA CONVERSACIÓN ---\n{summary['text']}" if summary["text"] else "",
+                        session.crm,
+                    )
+                    if memory_text:
+                        set_memory_message(session.llm, memory_text)
+
                 # 1. Guardar mensaje del usuario en memoria persistente
-                # Incluimos info de contexto para el Agente AI (Usamos nombres inequívocos)
-                context_list = []
-                if session_id: context_list.append(f"BITRIX_SESSION_ID={session_id}")
-                if chat_id_num: context_list.append(f"BITRIX_CHAT_ID={chat_id_num}")
-                if user_name: context_list.append(f"USER_NAME={user_name}")
-                if user_id: context_list.append(f"USER_ID={user_id}")
-                if client_endpoint: context_list.append(f"client_endpoint={client_endpoint}")
-                context_list.append(f"DIALOG_ID={chat_id}")
-                
+                # El texto crudo y el contexto estructurado se guardan por separado;
+                # al LLM el contexto solo se le repite cuando cambia (las notas fijas están en el system prompt)
+                context = {}
+                if session_id: context["BITRIX_SESSION_ID"] = session_id
+                if chat_id_num: context["BITRIX_CHAT_ID"] = chat_id_num
+                if user_name: context["USER_NAME"] = user_name
+                if user_id: context["USER_ID"] = user_id
+                if client_endpoint: context["client_endpoint"] = client_endpoint
+                context["DIALOG_ID"] = chat_id
+
                 from datetime import datetime
-                now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                context_prefix = (
-                    f"[FECHA Y HORA ACTUAL: {now_str}]\n"
-                    f"[CONTEXTO ACTUAL: {', '.join(context_list)}]\n\n"
-                    "⚠️ NOTA: El `BITRIX_CHAT_ID` numérico es el que debes usar para herramientas del CRM.\n"
-                    "⚠️ NOTA: IMPORTANTE - Al llamar a `manage_lead`, DEBES incluir el Nombre y el Teléfono/Email recolectados como argumentos explicitamente.\n"
-                    "⚠️ NOTA: NO necesitas pasar `access_token` a las herramientas.\n"
-                )
-                
-                full_message = f"{context_prefix}{user_message}"
-                await add_message(chat_id, "user", full_message)
+                now_str = datetime.now().strftime('%Y-%m-%d %H:%M')
+
+                # Lo volátil va al final para no romper el prefijo cacheado por el proveedor
+                context_line = f"[FECHA Y HORA ACTUAL: {now_str}]"
+                if context != session.last_context:
+                    context_line += f"\n{format_turn_context(context)}"
+                    session.last_context = context
+
+                full_message = with_volatile_context(user_message, context_line)
+                await add_message(chat_id, "user", user_message, context=context)
 
                 # 2. Enviar al LLM (contexto multi-turno nativo de mcp-agent)
-                print(f"  📤 Enviando a LLM: {user_message[:50]}...")
+                logger.info(f"📤 Enviando a LLM: {user_message[:50]}...")
+                if reply is not None and hasattr(session.llm, "stream_sink"):
+                    session.llm.stream_sink = reply
                 response = await session.llm.generate(message=full_message)
-                print(f"  📥 Respuesta raw LLM type: {type(response)}")
+                logger.debug(f"📥 Respuesta raw LLM type: {type(response)}")
 
                 # Extraer texto de la respuesta de forma segura
                 ai_response = ""
                 try:
-                    # Debug deep inspection
-                    if isinstance(response, list):
+                    # Debug deep inspection (muestreado: es caro y muy verboso)
+                    if isinstance(response, list) and debug_sampled(logger):
                         for i, content in enumerate(response):
-                            print(f"    Item {i}: type={type(content)}")
-                            if hasattr(content, 'parts'):
-                                print(f"      Parts: {content.parts}")
-                            if hasattr(content, 'role'):
-                                print(f"      Role: {content.role}")
-                            if hasattr(content, 'content'):
-                                print(f"      Content: {content.content}")
+                            logger.debug(f"Item {i}: type={type(content)}", extra={
+                                "parts": str(getattr(content, 'parts', None)),
+                                "role": getattr(content, 'role', None),
+                                "content": str(getattr(content, 'content', None)),
+                            })
 
                     # Standard extraction
                     for content in response:
@@ -113,23 +130,25 @@ async def get_response(user_message: str, chat_id: str, event_token: str = None,
                             pass
 
                         else:
-                            print(f"      ⚠️ Unknown content type: {type(content)}")
+                            logger.warning(f"⚠️ Unknown content type: {type(content)}")
 
                     if not ai_response and hasattr(response, 'text'):
                          # Fallback for some LLM wrappers
                          ai_response = response.text
 
                 except Exception as e:
-                    print(f"  ❌ Error parsing response: {e}")
-                    traceback.print_exc()
+                    logger.exception(f"❌ Error parsing response: {e}")
 
-                print(f"  💡 AI Response final: '{ai_response}'")
+                logger.info(f"💡 AI Response final: {len(ai_response)} chars")
+                logger.debug(f"💡 AI Response final: '{ai_response}'")
 
                 # 3. Guardar respuesta del bot en memoria persistente
                 if ai_response:
                     await add_message(chat_id, "assistant", ai_response)
+                    # Estado nativo del LLM para re-hidratar el chat en cualquier instancia
+                    schedule_snapshot(chat_id, session, ("assistant", ai_response))
                 else:
-                     print("  ⚠️ AI Response is empty!")
+                     logger.warning("⚠️ AI Response is empty!")
                      ai_response = "Lo siento, no pude generar una respuesta en este momento."
 
                 # Desactivar typing indicator
@@ -159,16 +178,16 @@ async def get_response(user_message: str, chat_id: str, event_token: str = None,
                             model_name = session.llm.model
 
                         await metrics.log_token_usage(current_tenant, prompt_tokens, completion_tokens, model_name)
-                        print(f"📊 [Metrics] Tokens logged: {prompt_tokens} + {completion_tokens}")
+                        logger.info(f"📊 [Metrics] Tokens logged: {prompt_tokens} + {completion_tokens}")
 
                 except Exception as e:
-                    print(f"⚠️ Error logging metrics: {e}")
+                    logger.warning(f"⚠️ Error logging metrics: {e}")
 
                 return ai_response
 
             except Exception as e:
-                print(f"❌ Error de mcp-agent en get_response: {e}")
-                traceback.print_exc()
+                ERRORS.labels("agent").inc()
+                logger.exception(f"❌ Error de mcp-agent en get_response: {e}")
 
                 # Invalidar sesión para recrear en próximo intento
                 await remove_session(chat_id)
@@ -176,23 +195,32 @@ async def get_response(user_message: str, chat_id: str, event_token: str = None,
                 # Limpieza segura si la sesión llegó a existir
                 if 'session' in locals() and session:
                     try:
-                        if hasattr(session.agent, '__aexit__'):
-                            await session.agent.__aexit__(None, None, None)
-                        if session.app_context_manager and hasattr(session.app_context_manager, '__aexit__'):
-                            await session.app_context_manager.__aexit__(None, None, None)
+                        await session.close()
                     except Exception as cleanup_err:
-                        print(f"  ⚠️ Error en limpieza post-error: {cleanup_err}")
+                        logger.warning(f"⚠️ Error en limpieza post-error: {cleanup_err}")
 
                 return "Lo siento, ocurrió un error al procesar tu mensaje. Por favor intenta de nuevo."
 
+            finally:
+                if hasattr(session.llm, "stream_sink"):
+                    session.llm.stream_sink = None
+                session.busy = False
+                await account_session(chat_id)
+
+    except ChatLockTimeout as lock_err:
+        ERRORS.labels("chat_lock").inc()
+        logger.warning(f"⏳ [Agent] Timeout esperando lock para {chat_id}: {lock_err}")
+        return "Lo siento, el sistema está recibiendo muchas peticiones. Por favor intenta de nuevo en unos segundos."
+
     except Exception as lock_err:
         # Check specific LockError logic if needed
+        ERRORS.labels("chat_lock" if "lock" in str(lock_err).lower() else "agent").inc()
         if "lock" in str(lock_err).lower():
-            print(f"⏳ [Agent] Timeout esperando lock para {chat_id}: {lock_err}")
+            logger.warning(f"⏳ [Agent] Timeout esperando lock para {chat_id}: {lock_err}")
             return "Lo siento, el sistema está recibiendo muchas peticiones. Por favor intenta de nuevo en unos segundos."
         
         # Re-raise other errors or return generic
-        print(f"💥 Error crítico fuera del lock: {lock_err}")
+        logger.error(f"💥 Error crítico fuera del lock: {lock_err}")
         return "Error del sistema."
 
 
@@ -0,0 +1,261 @@
+"""
+Fábrica de agentes por (tenant, bot).
+Lo costoso (registrar las tools del servidor MCP in-process, resolver el prompt
+desde Firestore, inicializar el Agent y configurar el proveedor LLM) se hace una
+sola vez por (tenant, bot) en un prototipo compartido. Cada chat nuevo solo crea
+un AugmentedLLM liviano que guarda su propio historial multi-turno.
+"""
+import logging
+import os
+import time
+import asyncio
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+from mcp_agent.agents.agent import Agent
+from mcp_agent.workflows.llm.augmented_llm import RequestParams
+from app.streaming import StreamingOpenAIAugmentedLLM
+from app.prompt_cache import CachedGoogleAugmentedLLM, seed_history
+from app.session_snapshot import config_version
+from app.secrets_loader import get_secret
+from app.memory import TURN_CONTEXT_NOTES
+
+# Tiempo máximo que un prototipo vive antes de re-resolver el prompt del tenant
+PROTOTYPE_TTL_SECONDS = int(os.getenv("AGENT_PROTOTYPE_TTL", "600"))
+# Margen antes de cerrar un Agent retirado: cubre sesiones que se están creando con él
+RETIRED_GRACE_SECONDS = 60
+
+_tool_map: dict | None = None
+
+
+def get_mcp_tool_map() -> dict:
+    """
+    Tools del servidor MCP in-process (nombre -> Tool ya parseada por FastMCP).
+    Se construye una vez por proceso y se comparte entre todos los prototipos.
+    """
+    global _tool_map
+    if _tool_map is None:
+        try:
+            from mcp_server import mcp as bitrix_mcp_server
+            tools = bitrix_mcp_server._tool_manager.list_tools()
+            _tool_map = {tool.name: tool for tool in tools}
+            logger.info(f"🏛️ [AgentFactory] {len(_tool_map)} tools del MCP Server '{bitrix_mcp_server.name}' registradas (In-Process)")
+        except Exception as e:
+            logger.warning(f"⚠️ [AgentFactory] Error integrando servidor MCP local: {e}")
+            _tool_map = {}
+    return _tool_map
+
+
+@dataclass
+class AgentPrototype:
+    """Agent inicializado y configuración de LLM compartidos por los chats de un (tenant, bot)."""
+    tenant_id: str
+    bot_id: str
+    agent: Agent
+    instruction: str
+    llm_class: type
+    request_params: RequestParams
+    provider: str
+    # Huella de prompt/proveedor/modelo: los snapshots de sesión solo se restauran con la misma
+    config_version: str = ""
+    created_at: float = field(default_factory=time.time)
+    sessions_created: int = 0
+
+    def is_expired(self) -> bool:
+        return (time.time() - self.created_at) > PROTOTYPE_TTL_SECONDS
+
+
+async def resolve_instruction(tenant_id: str, bot_id: str = None) -> str:
+    """Prompt del tenant/bot: systemPrompt o rol desde Firestore, o el prompt local por defecto."""
+    from app.firestore_config import get_firestore_config
+    fs_service = await get_firestore_config()
+    config = await fs_service.get_tenant_config(tenant_id, bot_id=bot_id) if tenant_id else None
+
+    # Determinar Prompt desde Firestore (único dato dinámico por cliente)
+    if config:
+        if config.get('systemPrompt'):
+            logger.info(f"📜 [AgentFactory] Usando System Prompt desde Firestore para {tenant_id}")
+            return config.get('systemPrompt')
+        if config.get('role'):
+            from app.base_prompt import BASE_SYSTEM_PROMPT
+            role = config.get('role', 'Asistente Virtual')
+            logger.info(f"🤖 [AgentFactory] Usando rol de Agente Activo para {tenant_id}")
+            return f"{BASE_SYSTEM_PROMPT}\n\n# CONFIGURACIÓN ESPECÍFICA DEL AGENTE\nRol: {role}"
+
+    from app.prompts import get_system_prompt
+    logger.warning(f"⚠️ [AgentFactory] Usando prompt local/default para {tenant_id}")
+    return await get_system_prompt()
+
+
+def _configure_provider():
+    """Lee proveedor/modelo/API key globales (app.config) y los expone en el entorno."""
+    from app.config import config as ai_config
+    llm_provider = ai_config.LLM_PROVIDER
+    api_key = ai_config.API_KEY or get_secret(llm_provider)
+
+    if api_key:
+        masked_key = f"{api_key[:8]}...{api_key[-4:]}"
+        logger.info(f"🔑 [AgentFactory] Usando API Key GLOBAL: {masked_key}")
+        # Poner en environ por compatibilidad
+        env_var_name = "OPENAI_API_KEY" if llm_provider == "openai" else "GOOGLE_API_KEY"
+        os.environ[env_var_name] = api_key
+        if llm_provider == "openai":
+            import openai
+            openai.api_key = api_key
+            os.environ["OPENAI_DEFAULT_MODEL"] = ai_config.MODEL
+    else:
+        logger.error("❌ [AgentFactory] CRITICAL: No se encontró API Key GLOBAL!!")
+
+    return llm_provider, ai_config.MODEL, ai_config.TEMPERATURE
+
+
+class AgentFactory:
+    """
+    Mantiene un prototipo por (tenant, bot) y fabrica sesiones por chat a partir de él.
+    Los prototipos expiran (PROTOTYPE_TTL_SECONDS) o se invalidan al cambiar la config.
+    """
+
+    def __init__(self):
+        self._prototypes: dict[tuple, AgentPrototype] = {}
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        # Agents de prototipos reemplazados: (agent, retirado_en). Se cierran cuando
+        # ninguna sesión viva los usa (ver close_retired)
+        self._retired: list[tuple[Agent, float]] = []
+        self.retired_closed = 0
+        self.prototypes_built = 0
+
+    async def build_prototype(self, tenant_id: str, bot_id: str = None, instruction: str = None) -> AgentPrototype:
+        """Construye el Agent compartido: tools, prompt y configuración del LLM."""
+        if instruction is None:
+            instruction = await resolve_instruction(tenant_id, bot_id)
+        # Las notas fijas sobre el contexto van una vez en el system prompt, no en cada mensaje
+        instruction = f"{instruction}\n\n{TURN_CONTEXT_NOTES}"
+        llm_provider, ai_model, ai_temp = _configure_provider()
+
+        bot_name = os.getenv("BOT_NAME", "travel_assistant")
+        agent_version = os.getenv("AGENT_VERSION", "1.0.0")
+        agent = Agent(
+            name=f"{bot_name}_v{agent_version}_{tenant_id}_{bot_id or 'default'}",
+            instruction=instruction,
+            server_names=[],  # Tools in-process, sin subprocesos
+        )
+        # Reusar los schemas que FastMCP ya parseó en lugar de re-generarlos por agente
+        agent._function_tool_map = dict(get_mcp_tool_map())
+
+        # Reusar el AgentApp global y entrar al contexto del Agent una sola vez
+        from app.context import get_agent_app
+        await get_agent_app()
+        await agent.__aenter__()
+
+        request_params = RequestParams(
+            model=ai_model,
+            temperature=ai_temp,
+            maxTokens=4096,
+            max_iterations=10,
+            use_history=True,
+            # Varias tools independientes por paso; app.tool_scheduler ordena las mutaciones
+            parallel_tool_calls=True,
+        )
+        logger.info(f"🔌 [AgentFactory] Prototipo listo para {tenant_id}/{bot_id} ({llm_provider}): {ai_model} (T={ai_temp})")
+        self.prototypes_built += 1
+        return AgentPrototype(
+            tenant_id=tenant_id,
+            bot_id=bot_id,
+            agent=agent,
+            instruction=instruction,
+            llm_class=StreamingOpenAIAugmentedLLM if llm_provider == "openai" else CachedGoogleAugmentedLLM,
+            request_params=request_params,
+            provider=llm_provider,
+            config_version=config_version(instruction, llm_provider, ai_model),
+        )
+
+    async def get_prototype(self, tenant_id: str, bot_id: str = None) -> AgentPrototype:
+        key = (tenant_id, bot_id)
+        proto = self._prototypes.get(key)
+        if proto is not None and not proto.is_expired():
+            return proto
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            proto = self._prototypes.get(key)
+            if proto is None or proto.is_expired():
+                if proto is not None:
+                    # Los chats activos conservan su referencia; se cierra al apagar
+                    self._retired.append((proto.agent, time.monotonic()))
+                proto = await self.build_prototype(tenant_id, bot_id)
+                self._prototypes[key] = proto
+        return proto
+
+    def invalidate(self, tenant_id: str, bot_id: str = None):
+        """Descarta el prototipo (p.ej. cambió el prompt); el próximo chat lo reconstruye."""
+        keys = [k for k in self._prototypes if k[0] == tenant_id and (bot_id is None or k[1] == bot_id)]
+        for key in keys:
+            self._retired.append((self._prototypes.pop(key).agent, time.monotonic()))
+
+    def create_llm(self, proto: AgentPrototype, chat_id: str, history_seed: str = ""):
+        """
+        LLM por chat sobre el Agent compartido: solo estado de conversación.
+        El system prompt es el del prototipo tal cual (prefijo cacheable entre chats);
+        la memoria del chat va como mensaje aparte (app.prompt_cache).
+        """
+        params = proto.request_params.model_copy(update={"systemPrompt": proto.instruction})
+        proto.sessions_created += 1
+        llm = proto.llm_class(
+            agent=proto.agent,
+            instruction=proto.instruction,
+            name=f"{proto.agent.name}_{chat_id}",
+            default_request_params=params,
+        )
+        seed_history(llm, proto.instruction, history_seed)
+        return llm
+
+    async def close_retired(self, in_use: set[int]) -> int:
+        """
+        Cierra los Agents retirados que ya no usa ninguna sesión viva (`in_use`: ids
+        de los Agents de las sesiones en RAM). Se llama desde la limpieza periódica.
+        """
+        now = time.monotonic()
+        closing = [a for a, at in self._retired if id(a) not in in_use and now - at > RETIRED_GRACE_SECONDS]
+        if not closing:
+            return 0
+        closing_ids = {id(a) for a in closing}
+        self._retired = [(a, at) for a, at in self._retired if id(a) not in closing_ids]
+        await self._close_agents(closing)
+        self.retired_closed += len(closing)
+        logger.info(f"🧹 [AgentFactory] {len(closing)} agentes retirados cerrados ({len(self._retired)} aún en uso)")
+        return len(closing)
+
+    async def _close_agents(self, agents: list):
+        for agent in agents:
+            try:
+                await agent.__aexit__(None, None, None)
+            except Exception as e:
+                logger.warning(f"⚠️ [AgentFactory] Error cerrando agente {agent.name}: {e}")
+
+    async def close(self):
+        """Cierra todos los Agents (prototipos vigentes y retirados)."""
+        agents = [p.agent for p in self._prototypes.values()] + [a for a, _ in self._retired]
+        self._prototypes.clear()
+        self._retired = []
+        await self._close_agents(agents)
+
+    def stats(self) -> dict:
+        return {
+            "prototypes": len(self._prototypes),
+            "prototypes_built": self.prototypes_built,
+            "retired": len(self._retired),
+            "retired_closed": self.retired_closed,
+            "tools": len(_tool_map or {}),
+            "sessions_created": {f"{p.tenant_id}/{p.bot_id}": p.sessions_created for p in self._prototypes.values()},
+        }
+
+
+_agent_factory: AgentFactory | None = None
+
+
+async def get_agent_factory() -> AgentFactory:
+    global _agent_factory
+    if _agent_factory is None:
+        _agent_factory = AgentFactory()
+    return _agent_factory
@@ -2,12 +2,18 @@
 Módulo de autenticación y llamadas a la API de Bitrix24.
 Usa httpx.AsyncClient para no bloquear el event loop.
 """
+import logging
 import os
+import re
+import json
+import time
+import urllib.parse
 import httpx
-import sys
-import os
-import httpx
-import sys
+
+from app.rate_limiter import get_rate_limiter, priority_for, throttled_response, MAX_RETRIES
+from app.telemetry import BITRIX_REQUEST_SECONDS, ERRORS
+
+logger = logging.getLogger(__name__)
 
 # BASE_DIR and ENV_FILE only used for local dev if they exist
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -61,10 +67,12 @@ def update_env_file(key, value):
 
 
 
-async def call_bitrix_method(method, params=None, access_token=None, domain=None, member_id=None):
+async def call_bitrix_method(method, params=None, access_token=None, domain=None, member_id=None, priority=None):
     """
     Llama a un método de la API de Bitrix24.
     - Resolucion de tenant: Prioriza member_id -> context_var -> env.
+    - Respeta el límite de tasa del portal (app.rate_limiter); `priority` es
+      "high" | "normal" | "low" y por defecto se infiere del método.
     """
     if params is None:
         params = {}
@@ -81,51 +89,220 @@ async def call_bitrix_method(method, params=None, access_token=None, domain=None
         access_token = await tm.get_token(member_id)
 
     if not domain:
-        # Intentar obtener del cache de Redis vía TokenManager para este tenant
+        # Intentar obtener del cache (L1 / Redis) vía TokenManager para este tenant
         if member_id:
-            redis = await tm._get_redis()
-            cached_domain = await redis.get(tm._get_redis_key(member_id, "domain"))
-            if cached_domain:
-                domain = cached_domain.decode("utf-8") if isinstance(cached_domain, bytes) else cached_domain
+            domain = await tm.get_domain(member_id)
 
         if not domain:
             domain = get_env_var("BITRIX_DOMAIN")
 
     if not domain or not access_token:
         error_msg = f"Faltan credenciales para tenant {member_id}: DOMAIN={'OK' if domain else 'MISSING'}, TOKEN={'OK' if access_token else 'MISSING'}"
-        sys.stderr.write(f"  ❌ {error_msg}\n")
+        logger.error(f"❌ {error_msg}")
         raise ValueError(error_msg)
 
     url = f"https://{domain}/rest/{method}"
     # Se agrega auth como query param
     auth_url = f"{url}?auth={access_token}" if "?" not in url else f"{url}&auth={access_token}"
 
+    limiter = await get_rate_limiter()
+    priority = priority or priority_for(method)
+
+    started = time.perf_counter()
     try:
         client = await get_http_client()
-        response = await client.post(auth_url, json=params)
+        for attempt in range(MAX_RETRIES + 1):
+            if not await limiter.acquire(domain, priority, method):
+                return _throttled(domain, method, started)
+            response = await client.post(auth_url, json=params)
+            try:
+                data = response.json()
+            except ValueError:
+                break
+            # QUERY_LIMIT_EXCEEDED: el limitador aplica backoff y se reintenta
+            if not await limiter.observe(domain, method, data) or attempt == MAX_RETRIES:
+                break
 
         # Si el token es inválido o expiró
         if response.status_code in [400, 401]:
             try:
                 data = response.json()
                 if data.get("error") in ["expired_token", "invalid_token", "WRONG_AUTH_TYPE"]:
-                    sys.stderr.write(f"  🔄 Token expirado para {member_id}, refrescando...\n")
-                    new_token = await tm.force_refresh(member_id)
+                    logger.info(f"🔄 Token expirado para {member_id}, refrescando...")
+                    new_token = await tm.force_refresh(member_id, stale_token=access_token)
                     auth_url = f"{url}?auth={new_token}" if "?" not in url else f"{url}&auth={new_token}"
+                    if not await limiter.acquire(domain, priority, method):
+                        return _throttled(domain, method, started)
                     response = await client.post(auth_url, json=params)
             except:
                 pass
 
         if response.status_code >= 400:
-            sys.stderr.write(f"  ❌ Bitrix API Error ({member_id}): {response.text}\n")
+            logger.error(f"❌ Bitrix API Error ({member_id}): {response.text}")
 
         response.raise_for_status()
+        BITRIX_REQUEST_SECONDS.labels(method, "ok").observe(time.perf_counter() - started)
         return response.json()
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error llamando a {method}: {e}\n")
+        BITRIX_REQUEST_SECONDS.labels(method, "error").observe(time.perf_counter() - started)
+        ERRORS.labels("bitrix").inc()
+        logger.error(f"❌ Error llamando a {method}: {e}")
         raise
 
+
+def _throttled(domain: str, method: str, started: float) -> dict:
+    """El portal sigue saturado tras la espera máxima: no se llama a Bitrix y el llamador recibe el error."""
+    BITRIX_REQUEST_SECONDS.labels(method, "throttled").observe(time.perf_counter() - started)
+    logger.warning(f"🚦 [RateLimit] {method} descartado: {domain} saturado")
+    return throttled_response(domain)
+
+# ─── Batch ────────────────────────────────────────────────────────
+
+BATCH_MAX_COMMANDS = 50
+_RESULT_REF = re.compile(r"\$result\[([^\]]+)\]((?:\[[^\]]*\])*)")
+
+
+def _build_query(params, prefix: str = None) -> list:
+    """Codifica params al formato anidado de PHP (fields[PHONE][0][VALUE]=...)."""
+    pairs = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            pairs.extend(_build_query(value, name))
+        elif isinstance(value, bool):
+            pairs.append((name, "1" if value else "0"))
+        elif value is None:
+            pairs.append((name, ""))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+
+class BatchResult:
+    """Resultados de un BitrixBatch, indexados por nombre de comando."""
+
+    def __init__(self):
+        self.results: dict = {}
+        self.errors: dict = {}
+
+    def ok(self, name: str) -> bool:
+        return name in self.results and name not in self.errors
+
+    def get(self, name: str, default=None):
+        return self.results.get(name, default)
+
+    def error(self, name: str) -> str | None:
+        err = self.errors.get(name)
+        if not err:
+            return None
+        if isinstance(err, dict):
+            return err.get("error_description") or err.get("error") or str(err)
+        return str(err)
+
+
+class BitrixBatch:
+    """
+    Agrupa llamadas REST y las envía con el método `batch` de Bitrix24
+    (máximo 50 comandos por request).
+
+    Un comando puede depender de otro anterior usando `BitrixBatch.ref(nombre, ...)`,
+    que genera una referencia `$result[nombre][...]` resuelta por Bitrix dentro del
+    mismo request. Si la dependencia quedó en un bloque anterior se resuelve localmente.
+
+        batch = BitrixBatch()
+        batch.add("lead", "crm.lead.add", {"fields": {...}})
+        batch.add("note", "crm.timeline.comment.add", {"fields": {"ENTITY_ID": batch.ref("lead"), ...}})
+        res = await batch.execute()
+    """
+
+    def __init__(self, halt: bool = False, member_id: str = None):
+        self.halt = halt
+        self.member_id = member_id
+        self._commands: list[tuple[str, str, dict]] = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    @staticmethod
+    def ref(name: str, *path) -> str:
+        """Referencia al resultado de un comando previo: $result[name][path...]."""
+        return f"$result[{name}]" + "".join(f"[{p}]" for p in path)
+
+    def add(self, name: str, method: str, params: dict = None) -> str:
+        """Agrega un comando. Las referencias solo pueden apuntar a comandos ya agregados."""
+        known = {n for n, _, _ in self._commands}
+        if name in known:
+            raise ValueError(f"Comando duplicado en batch: {name}")
+        for ref_name, _ in _RESULT_REF.findall(json.dumps(params or {}, default=str)):
+            if ref_name not in known:
+                raise ValueError(f"El comando '{name}' referencia '{ref_name}', que no fue agregado antes")
+        self._commands.append((name, method, params or {}))
+        return name
+
+    @staticmethod
+    def _resolve_refs(value, resolved: dict):
+        """Sustituye referencias a resultados de bloques anteriores por su valor real."""
+        if isinstance(value, dict):
+            return {k: BitrixBatch._resolve_refs(v, resolved) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [BitrixBatch._resolve_refs(v, resolved) for v in value]
+        if not isinstance(value, str) or "$result[" not in value:
+            return value
+
+        def lookup(match):
+            name, path = match.group(1), match.group(2)
+            if name not in resolved:
+                return match.group(0)  # Se resuelve en el servidor (mismo bloque)
+            current = resolved[name]
+            for key in re.findall(r"\[([^\]]*)\]", path):
+                if isinstance(current, list) and key.isdigit():
+                    current = current[int(key)] if int(key) < len(current) else ""
+                elif isinstance(current, dict):
+                    current = current.get(key, "")
+                else:
+                    current = ""
+            return str(current)
+
+        full = _RESULT_REF.fullmatch(value)
+        if full and full.group(1) in resolved:
+            # Referencia completa: conservar el tipo (int, dict...) del resultado
+            return _RESULT_REF.sub(lookup, value) if full.group(2) else resolved[full.group(1)]
+        return _RESULT_REF.sub(lookup, value)
+
+    async def execute(self) -> BatchResult:
+        """Ejecuta los comandos en bloques de BATCH_MAX_COMMANDS. Retorna un BatchResult."""
+        out = BatchResult()
+        for i in range(0, len(self._commands), BATCH_MAX_COMMANDS):
+            chunk = self._commands[i:i + BATCH_MAX_COMMANDS]
+            cmd = {}
+            for name, method, params in chunk:
+                params = self._resolve_refs(params, out.results)
+                query = urllib.parse.urlencode(_build_query(params))
+                cmd[name] = f"{method}?{query}" if query else method
+
+            res = await call_bitrix_method(
+                "batch", {"halt": 1 if self.halt else 0, "cmd": cmd}, member_id=self.member_id
+            )
+            if res.get("error"):
+                # Falla del request completo (token, límite...): marcar todo el bloque
+                for name, _, _ in chunk:
+                    out.errors[name] = res
+                if self.halt:
+                    break
+                continue
+
+            body = res.get("result") or {}
+            # Bitrix retorna [] en lugar de {} cuando no hay resultados/errores
+            out.results.update(body.get("result") or {})
+            out.errors.update(body.get("result_error") or {})
+
+            if self.halt and out.errors:
+                break
+        return out
+
+
 async def get_current_user_id() -> int:
     """Retorna el ID del usuario actual (el bot). Fallback a 1 (Daniel Posada) si falla."""
     try:
@@ -134,6 +311,6 @@ async def get_current_user_id() -> int:
         if user_id:
             return int(user_id)
     except Exception as e:
-        sys.stderr.write(f"  ⚠️ Error obteniendo user.current: {e}. Usando fallback ID=1\n")
+        logger.warning(f"⚠️ Error obteniendo user.current: {e}. Usando fallback ID=1")
     
     return int(os.getenv("DEFAULT_RESPONSIBLE_ID", 1))
@@ -1,138 +1,244 @@
 """
 Módulo de utilidades para Bitrix24: parseo de eventos y envío de respuestas.
-Usa httpx async para no bloquear el event loop.
+Usa el pool httpx por portal (app.http_pool) para no bloquear el event loop
+ni abrir una conexión TLS nueva en cada respuesta, y el limitador de tasa
+por portal (app.rate_limiter) con prioridad alta para las respuestas.
 """
-import httpx
+import logging
+import os
+import time
+import asyncio
 
+from app.http_pool import post_json
+from app.rate_limiter import get_rate_limiter, domain_of, HIGH, LOW, MAX_RETRIES
+from app.telemetry import REPLY_SEND_SECONDS, ERRORS
 
-import os
+logger = logging.getLogger(__name__)
 
 # ID del Bot (se puede sobreescribir con environment variable)
 BOT_ID = os.getenv("BOT_ID", "3242")
 
 
-def extract_event_data(data: dict) -> dict:
+_FALLBACK_FIELDS = ("SESSION_ID", "DIALOG_ID", "CHAT_ID")
+
+
+class BitrixEvent:
     """
-    Extrae los campos relevantes del evento aplanado de Bitrix24.
-    Las claves vienen en formato: data[PARAMS][FIELD], data[BOT][ID][FIELD], etc.
+    Evento de Bitrix24 parseado en una sola pasada sobre el formulario aplanado.
+    Expone vistas por sección: `params` (data[PARAMS]), `bot` (data[BOT][id]),
+    `user` (data[USER]) y `auth` (auth[...]).
     """
-    result = {}
+    __slots__ = ("event", "params", "bot_id", "bot", "user", "auth", "_fallback")
 
-    # Campos de PARAMS
-    params_prefix = "data[PARAMS]"
-    for key, value in data.items():
-        if key.startswith(params_prefix):
-            field = key[len(params_prefix) + 1:-1]
-            result[field] = value
-
-    # Detectar BOT_ID dinámicamente buscando en las claves de data
-    detected_bot_id = None
-    for key in data.keys():
-        if key.startswith("data[BOT][") and "]" in key:
-            # key es algo como 'data[BOT][3242][TOKEN]'
-            parts = key.split("[")
-            if len(parts) > 2:
-                detected_bot_id = parts[2].split("]")[0]
-                break
-    
-    bot_id = detected_bot_id or BOT_ID
-    result["BOT_ID"] = bot_id
+    def __init__(self):
+        self.event = None
+        self.params = {}
+        self.bot_id = None
+        self.bot = {}
+        self.user = {}
+        self.auth = {}
+        self._fallback = {}
 
-    # Campos de BOT (token, etc.) - buscar por bot_id
-    bot_prefix = f"data[BOT][{bot_id}]"
-    for key, value in data.items():
-        if key.startswith(bot_prefix):
-            rest = key[len(bot_prefix):]
-            if rest.startswith("[") and rest.endswith("]"):
-                field = rest[1:-1]
-                result[f"BOT_{field}"] = value
-
-    # Campos de USER
-    user_prefix = "data[USER]"
-    for key, value in data.items():
-        if key.startswith(user_prefix):
-            field = key[len(user_prefix) + 1:-1]
-            result[f"USER_{field}"] = value
+    def _field(self, name: str):
+        value = self.params.get(name)
+        if value is None:
+            value = self._fallback.get(name)
+        return value
 
-    # Auth del evento raíz
-    auth_prefix = "auth["
-    for key, value in data.items():
-        if key.startswith(auth_prefix):
-            field = key[len(auth_prefix):-1]
-            result[f"AUTH_{field}"] = value
+    @property
+    def dialog_id(self):
+        return self._field("DIALOG_ID")
 
-    # Búsqueda de respaldo para SESSION_ID y CHAT_ID en el nivel superior y CHAT_ENTITY_DATA_1
-    for key, value in data.items():
-        k_upper = key.upper()
-        if "SESSION_ID" in k_upper and "SESSION_ID" not in result:
-            result["SESSION_ID"] = value
-        if "DIALOG_ID" in k_upper and "DIALOG_ID" not in result:
-            result["DIALOG_ID"] = value
-        if "CHAT_ID" in k_upper and "CHAT_ID" not in result:
-             result["CHAT_ID"] = value
-
-    # Si es OpenLines, intentar extraer SESSION_ID de CHAT_ENTITY_DATA_1 (formato: N|NONE|0|N|N|SESSION_ID|...)
-    if result.get("CHAT_ENTITY_TYPE") == "LINES" and not result.get("SESSION_ID"):
-        entity_data = result.get("CHAT_ENTITY_DATA_1", "")
-        if entity_data:
-            parts = entity_data.split("|")
+    @property
+    def chat_id(self):
+        return self._field("CHAT_ID")
+
+    @property
+    def message(self):
+        return self.params.get("MESSAGE")
+
+    @property
+    def from_user_id(self):
+        return self.params.get("FROM_USER_ID")
+
+    @property
+    def user_name(self):
+        return self.user.get("NAME")
+
+    @property
+    def access_token(self):
+        return self.bot.get("access_token")
+
+    @property
+    def client_endpoint(self):
+        return self.bot.get("client_endpoint")
+
+    @property
+    def domain(self):
+        return self.auth.get("domain")
+
+    @property
+    def session_id(self):
+        """SESSION_ID explícito o, en OpenLines, el sexto campo de CHAT_ENTITY_DATA_1."""
+        session_id = self._field("SESSION_ID")
+        if not session_id and self.params.get("CHAT_ENTITY_TYPE") == "LINES":
+            parts = (self.params.get("CHAT_ENTITY_DATA_1") or "").split("|")
             if len(parts) > 5 and parts[5].isdigit():
-                result["SESSION_ID"] = int(parts[5])
+                return int(parts[5])
+        return session_id
+
+    def to_dict(self) -> dict:
+        """Representación plana compatible con `extract_event_data`."""
+        result = dict(self.params)
+        result["BOT_ID"] = self.bot_id
+        for k, v in self.bot.items():
+            result[f"BOT_{k}"] = v
+        for k, v in self.user.items():
+            result[f"USER_{k}"] = v
+        for k, v in self.auth.items():
+            result[f"AUTH_{k}"] = v
+        for name, value in self._fallback.items():
+            result.setdefault(name, value)
+        if result.get("CHAT_ENTITY_TYPE") == "LINES" and not result.get("SESSION_ID"):
+            session_id = self.session_id
+            if session_id:
+                result["SESSION_ID"] = session_id
+        return result
+
+
+def parse_event(data: dict) -> BitrixEvent:
+    """
+    Parsea el evento aplanado de Bitrix24 en una sola pasada.
+    Las claves vienen en formato: data[PARAMS][FIELD], data[BOT][ID][FIELD], auth[FIELD], etc.
+    """
+    ev = BitrixEvent()
+    ev.event = data.get("event")
+    params, user, auth, fallback = ev.params, ev.user, ev.auth, ev._fallback
+    bots = {}
+    first_bot_id = None
+    missing = len(_FALLBACK_FIELDS)
+
+    for key, value in data.items():
+        if key.startswith("data["):
+            if key.startswith("PARAMS]", 5):
+                params[key[13:-1]] = value
+            elif key.startswith("BOT][", 5):
+                close = key.find("]", 10)
+                if close > 10:
+                    bot_id = key[10:close]
+                    if first_bot_id is None:
+                        first_bot_id = bot_id
+                    # data[BOT][id][FIELD] -> FIELD
+                    if key.startswith("[", close + 1) and key.endswith("]"):
+                        bot = bots.get(bot_id)
+                        if bot is None:
+                            bot = bots[bot_id] = {}
+                        bot[key[close + 2:-1]] = value
+            elif key.startswith("USER]", 5):
+                user[key[11:-1]] = value
+        elif key.startswith("auth["):
+            auth[key[5:-1]] = value
+
+        # Búsqueda de respaldo para SESSION_ID/DIALOG_ID/CHAT_ID en cualquier clave
+        if missing and ("_I" in key or "_i" in key):
+            k_upper = key.upper()
+            for name in _FALLBACK_FIELDS:
+                if name in k_upper and name not in fallback:
+                    fallback[name] = value
+                    missing -= 1
+
+    # Los valores explícitos de PARAMS tienen prioridad sobre el respaldo
+    for name in _FALLBACK_FIELDS:
+        if name in params:
+            fallback.pop(name, None)
+
+    ev.bot_id = first_bot_id or BOT_ID
+    ev.bot = bots.get(ev.bot_id, {})
+    return ev
+
+
+def extract_event_data(data: dict) -> dict:
+    """
+    Extrae los campos relevantes del evento aplanado de Bitrix24 como dict plano
+    (PARAMS sin prefijo, BOT_*, USER_*, AUTH_*). Ver `parse_event` para la vista tipada.
+    """
+    return parse_event(data).to_dict()
 
-    return result
+
+async def _post_reply(url: str, payload: dict, label: str, ok_detail: str):
+    """Envía una respuesta a Bitrix24 y registra el resultado. Retorna `result` (o False)."""
+    limiter = await get_rate_limiter()
+    domain = domain_of(url)
+    method = url.rsplit("/", 1)[-1]
+    started = time.perf_counter()
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            if not await limiter.acquire(domain, HIGH, method):
+                logger.warning(f"🚦 [RateLimit] {label} descartado: {domain} saturado")
+                REPLY_SEND_SECONDS.labels(method, "throttled").observe(time.perf_counter() - started)
+                ERRORS.labels("reply").inc()
+                return False
+            res = await post_json(url, payload, timeout=15)
+            data = res.json()
+            if not await limiter.observe(domain, method, data) or attempt == MAX_RETRIES:
+                break
+        if data.get("result"):
+            REPLY_SEND_SECONDS.labels(method, "ok").observe(time.perf_counter() - started)
+            logger.info(f"✅ Msg enviado via {label} ({ok_detail}, Result: {data['result']})")
+            return data["result"]
+        logger.warning(f"⚠️ Fallo {label}: {data}")
+    except Exception as e:
+        logger.error(f"❌ Error HTTP {label}: {e}")
+    REPLY_SEND_SECONDS.labels(method, "error").observe(time.perf_counter() - started)
+    ERRORS.labels("reply").inc()
+    return False
 
 
 async def send_reply(access_token: str, client_endpoint: str, dialog_id: str, message: str, chat_id: str = None, session_id: int = None):
     """
     Envía un mensaje de respuesta al chat de Bitrix24.
-    Implementa un intento dual para asegurar visibilidad en OpenLines.
+    Implementa un intento dual para asegurar visibilidad en OpenLines; ambas
+    llamadas se hacen en paralelo sobre la conexión compartida del portal.
     """
-    success = False
-    
     # Intento 1: imbot.message.add (El más estándar para bots, suele ser el visible en el chat)
-    url_im = f"{client_endpoint}imbot.message.add"
     payload_im = {
         "DIALOG_ID": dialog_id,
         "MESSAGE": message,
         "auth": access_token,
     }
     if BOT_ID: payload_im["BOT_ID"] = BOT_ID
-
-    try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            res = await client.post(url_im, json=payload_im)
-            data = res.json()
-            if data.get("result"):
-                print(f"  ✅ Msg enviado via imbot.message.add (Dialog: {dialog_id}, MsgID: {data['result']})")
-                success = True
-            else:
-                print(f"  ⚠️ Fallo imbot.message.add: {data}")
-    except Exception as e:
-        print(f"  ❌ Error HTTP imbot: {e}")
+    attempts = [
+        _post_reply(f"{client_endpoint}imbot.message.add", payload_im, "imbot.message.add", f"Dialog: {dialog_id}")
+    ]
 
     # Intento 2: imopenlines.bot.session.message.send (Específico para OpenLines, marca sesión como respondida)
     if session_id:
-        url_ol = f"{client_endpoint}imopenlines.bot.session.message.send"
         payload_ol = {
             "SESSION_ID": session_id,
             "MESSAGE": message,
             "auth": access_token,
         }
         if chat_id: payload_ol["CHAT_ID"] = chat_id
-        
-        try:
-            async with httpx.AsyncClient(timeout=15) as client:
-                res = await client.post(url_ol, json=payload_ol)
-                data = res.json()
-                if data.get("result"):
-                    print(f"  ✅ Msg enviado via OpenLines (Session: {session_id}, Result: {data['result']})")
-                    success = True
-                else:
-                    print(f"  ⚠️ Fallo OpenLines: {data}")
-        except Exception as e:
-            print(f"  ❌ Error HTTP OpenLines: {e}")
-
-    return success
+        attempts.append(
+            _post_reply(f"{client_endpoint}imopenlines.bot.session.message.send", payload_ol, "OpenLines", f"Session: {session_id}")
+        )
+
+    results = await asyncio.gather(*attempts)
+    return any(results)
+
+
+async def send_bot_message(access_token: str, client_endpoint: str, dialog_id: str, message: str):
+    """Envía un mensaje con imbot.message.add y retorna su MESSAGE_ID (para editarlo luego)."""
+    payload = {"DIALOG_ID": dialog_id, "MESSAGE": message, "auth": access_token}
+    if BOT_ID: payload["BOT_ID"] = BOT_ID
+    return await _post_reply(f"{client_endpoint}imbot.message.add", payload, "imbot.message.add", f"Dialog: {dialog_id}")
+
+
+async def update_bot_message(access_token: str, client_endpoint: str, message_id, message: str) -> bool:
+    """Reemplaza el texto de un mensaje del bot (imbot.message.update)."""
+    payload = {"MESSAGE_ID": message_id, "MESSAGE": message, "auth": access_token}
+    if BOT_ID: payload["BOT_ID"] = BOT_ID
+    return bool(await _post_reply(f"{client_endpoint}imbot.message.update", payload, "imbot.message.update", f"Msg: {message_id}"))
 
 async def send_typing_indicator(access_token: str, client_endpoint: str, dialog_id: str, status: str = "on"):
     """
@@ -146,8 +252,14 @@ async def send_typing_indicator(access_token: str, client_endpoint: str, dialog_
         "auth": access_token,
     }
 
+    # El typing es cosmético: si el portal está saturado se omite en lugar de esperar
+    domain = domain_of(url)
+    limiter = await get_rate_limiter()
+    if not await limiter.acquire(domain, LOW, "imbot.chat.answer.typing", max_wait=0):
+        return
+
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            await client.post(url, json=payload)
+        res = await post_json(url, payload, timeout=10)
+        await limiter.observe(domain, "imbot.chat.answer.typing", res.json())
     except Exception as e:
-        print(f"  ⚠️ Error al enviar typing indicator ({status}): {e}")
+        logger.warning(f"⚠️ Error al enviar typing indicator ({status}): {e}")
@@ -0,0 +1,431 @@
+"""
+Serialización por chat entre instancias (reemplaza el lock de redis-py con
+polling de hasta 300 s).
+- Cola FIFO de espera en Redis (ZSET por número de ticket): el lock se entrega
+  al primero de la cola, no al que tenga la suerte de reintentar antes.
+- Al liberar se publica en `lock:chat:{id}:released` y los que esperan
+  despiertan por pub/sub (una sola conexión por proceso); el reintento
+  periódico (CHAT_LOCK_RECHECK_MS) queda solo como red de seguridad.
+- El lock es un lease corto (CHAT_LOCK_LEASE_MS) renovado por un heartbeat:
+  si la instancia que lo tiene muere, se libera en segundos. Un holder colgado
+  deja de renovarse tras CHAT_LOCK_MAX_HOLD segundos.
+- Camino rápido en proceso: los mensajes del mismo chat en esta instancia se
+  ordenan con un asyncio.Lock (FIFO) y, si la instancia ya tiene el lease y no
+  hay otras instancias en la cola, se lo pasa al siguiente sin liberarlo ni
+  volver a encolarse (hasta CHAT_LOCK_MAX_HANDOFFS seguidos).
+Sin Redis (MockRedis) solo se serializa dentro del proceso. Si Redis falla, esa
+adquisición se resuelve en proceso y Redis se reintenta tras un backoff
+(CHAT_LOCK_REDIS_RETRY_S, duplicándose hasta CHAT_LOCK_REDIS_RETRY_MAX_S).
+"""
+import logging
+import os
+import time
+import uuid
+import asyncio
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+from app.redis_client import get_redis
+from app.telemetry import CHAT_LOCK_WAIT_SECONDS
+
+CHAT_LOCK_WAIT_TIMEOUT = float(os.getenv("CHAT_LOCK_WAIT_TIMEOUT", "300"))
+CHAT_LOCK_LEASE_MS = int(os.getenv("CHAT_LOCK_LEASE_MS", "15000"))
+CHAT_LOCK_MAX_HOLD = float(os.getenv("CHAT_LOCK_MAX_HOLD", "600"))
+CHAT_LOCK_RECHECK_MS = int(os.getenv("CHAT_LOCK_RECHECK_MS", "1000"))
+# Un waiter que no reintenta en este tiempo se da por muerto y sale de la cola
+CHAT_LOCK_WAITER_TTL_MS = int(os.getenv("CHAT_LOCK_WAITER_TTL_MS", "5000"))
+CHAT_LOCK_MAX_HANDOFFS = int(os.getenv("CHAT_LOCK_MAX_HANDOFFS", "4"))
+# Pausa tras un error de Redis antes de volver a usarlo (backoff exponencial)
+CHAT_LOCK_REDIS_RETRY_S = float(os.getenv("CHAT_LOCK_REDIS_RETRY_S", "1"))
+CHAT_LOCK_REDIS_RETRY_MAX_S = float(os.getenv("CHAT_LOCK_REDIS_RETRY_MAX_S", "30"))
+KEY_PREFIX = "lock:chat"
+
+# KEYS: lock, queue (ticket), alive (vencimiento del waiter), seq
+# ARGV: token, lease_ms, waiter_ttl_ms
+# Retorna {1, 0} si se obtuvo el lock, o {0, posición} (1 = siguiente).
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local token = ARGV[1]
+local waiter_ttl = tonumber(ARGV[3])
+local dead = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)
+for _, w in ipairs(dead) do
+    redis.call('ZREM', KEYS[2], w)
+    redis.call('ZREM', KEYS[3], w)
+end
+if not redis.call('ZSCORE', KEYS[2], token) then
+    redis.call('ZADD', KEYS[2], redis.call('INCR', KEYS[4]), token)
+end
+redis.call('ZADD', KEYS[3], now + waiter_ttl, token)
+local head = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+if head == token and redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], token, 'PX', tonumber(ARGV[2]))
+    redis.call('ZREM', KEYS[2], token)
+    redis.call('ZREM', KEYS[3], token)
+    return {1, 0}
+end
+for i = 2, 4 do
+    redis.call('PEXPIRE', KEYS[i], waiter_ttl * 4)
+end
+return {0, redis.call('ZRANK', KEYS[2], token) + 1}
+"""
+
+# KEYS: lock, canal ; ARGV: token
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('PUBLISH', KEYS[2], '1')
+    return 1
+end
+return 0
+"""
+
+# KEYS: lock ; ARGV: token, lease_ms
+_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[2]))
+end
+return 0
+"""
+
+# Un waiter que se rinde sale de la cola y despierta al siguiente
+# KEYS: queue, alive, canal ; ARGV: token
+_LEAVE_LUA = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('PUBLISH', KEYS[3], '1')
+return 1
+"""
+
+
+class ChatLockTimeout(Exception):
+    """No se obtuvo el lock del chat dentro del tiempo de espera."""
+
+
+class _ReleaseNotifier:
+    """Una conexión pub/sub por proceso; despierta a los waiters del canal liberado."""
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._pubsub = None
+        self._events: dict[str, set] = {}
+        self._task: asyncio.Task | None = None
+
+    async def listen(self, channel: str) -> asyncio.Event:
+        event = asyncio.Event()
+        waiters = self._events.get(channel)
+        if waiters is None:
+            if self._pubsub is None:
+                self._pubsub = self._redis.pubsub()
+            # Registrar el canal solo si la suscripción tuvo éxito (si falla, el próximo listen reintenta)
+            await self._pubsub.subscribe(channel)
+            waiters = self._events[channel] = set()
+        waiters.add(event)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._reader())
+        return event
+
+    async def unlisten(self, channel: str, event: asyncio.Event):
+        waiters = self._events.get(channel)
+        if waiters is None:
+            return
+        waiters.discard(event)
+        if not waiters:
+            del self._events[channel]
+            try:
+                await self._pubsub.unsubscribe(channel)
+            except Exception as e:
+                logger.debug(f"[ChatLock] Error desuscribiendo {channel}: {e}")
+
+    async def _reader(self):
+        # Termina cuando no quedan canales; `listen` lo vuelve a lanzar
+        while self._events:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self._events:
+                    return
+                # Los waiters siguen reintentando cada CHAT_LOCK_RECHECK_MS
+                logger.warning(f"⚠️ [ChatLock] Error leyendo pub/sub: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if message and message.get("type") == "message":
+                for event in self._events.get(message["channel"], ()):
+                    event.set()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+
+
+class _ChatState:
+    """Estado en proceso de un chat: orden local, lease de Redis y heartbeat."""
+    __slots__ = ("lock", "waiters", "token", "heartbeat", "handoffs", "lost", "acquired_at")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # FIFO entre las corrutinas de esta instancia
+        self.waiters = 0
+        self.token: str | None = None
+        self.heartbeat: asyncio.Task | None = None
+        self.handoffs = 0
+        self.lost = False
+        self.acquired_at = 0.0
+
+
+class ChatLock:
+    """Lock de un chat para `async with`; `position` es la última posición conocida en la cola."""
+
+    def __init__(self, manager: "ChatLockManager", chat_id: str, timeout: float = None):
+        self._manager = manager
+        self.chat_id = str(chat_id)
+        self.timeout = CHAT_LOCK_WAIT_TIMEOUT if timeout is None else timeout
+        self.position = 0
+        self.waited = 0.0
+
+    async def __aenter__(self):
+        self.waited = await self._manager.acquire(self.chat_id, self.timeout, self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._manager.release(self.chat_id)
+
+
+class ChatLockManager:
+    def __init__(self, redis=None):
+        self._redis = redis
+        self._use_redis = hasattr(redis, "eval") and hasattr(redis, "pubsub")
+        self._notifier = _ReleaseNotifier(redis) if self._use_redis else None
+        # Tras un error de Redis se adquiere en proceso hasta `_redis_retry_at` (monotonic)
+        self._redis_failures = 0
+        self._redis_retry_at = 0.0
+        self._chats: dict[str, _ChatState] = {}
+        self._stats = defaultdict(float)
+
+    def lock(self, chat_id: str, timeout: float = None) -> ChatLock:
+        return ChatLock(self, chat_id, timeout)
+
+    def _keys(self, chat_id: str) -> tuple:
+        base = f"{KEY_PREFIX}:{chat_id}"
+        return base, f"{base}:queue", f"{base}:alive", f"{base}:seq", f"{base}:released"
+
+    def _discard_if_idle(self, chat_id: str, state: _ChatState):
+        if not state.lock.locked() and state.waiters == 0 and state.token is None:
+            if self._chats.get(chat_id) is state:
+                del self._chats[chat_id]
+
+    def _redis_available(self) -> bool:
+        return self._use_redis and time.monotonic() >= self._redis_retry_at
+
+    def _redis_failed(self, error: Exception):
+        """Pausa Redis con backoff exponencial; la adquisición en curso queda solo en proceso."""
+        self._redis_failures += 1
+        pause = min(CHAT_LOCK_REDIS_RETRY_S * 2 ** (self._redis_failures - 1), CHAT_LOCK_REDIS_RETRY_MAX_S)
+        self._redis_retry_at = time.monotonic() + pause
+        self._stats["redis_errors"] += 1
+        logger.warning(f"⚠️ [ChatLock] Redis no disponible ({error}), serializando solo en proceso; "
+                       f"se reintenta en {pause:.1f}s")
+
+    def _redis_recovered(self):
+        if self._redis_failures:
+            logger.info(f"✅ [ChatLock] Redis disponible de nuevo tras {self._redis_failures} errores")
+            self._redis_failures = 0
+
+    def _timeout(self, chat_id: str, position: int, started: float) -> ChatLockTimeout:
+        self._stats["timeouts"] += 1
+        return ChatLockTimeout(
+            f"Timeout esperando el lock del chat {chat_id} "
+            f"({time.monotonic() - started:.0f}s, posición {position} en la cola)"
+        )
+
+    # ─── Adquisición ──────────────────────────────────────────────
+
+    async def acquire(self, chat_id: str, timeout: float = CHAT_LOCK_WAIT_TIMEOUT,
+                      waiter: ChatLock = None) -> float:
+        """Espera el turno del chat. Retorna los segundos esperados o lanza ChatLockTimeout."""
+        started = time.monotonic()
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState()
+
+        position = state.waiters + (1 if state.lock.locked() else 0)
+        if waiter is not None:
+            waiter.position = position
+        state.waiters += 1
+        try:
+            await asyncio.wait_for(state.lock.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise self._timeout(chat_id, position, started) from None
+        finally:
+            state.waiters -= 1
+            self._discard_if_idle(chat_id, state)
+
+        path = "local"
+        if state.token is None and self._redis_available():
+            try:
+                state.token = await self._acquire_redis(chat_id, started + timeout, started, waiter)
+            except BaseException:
+                state.lock.release()
+                self._discard_if_idle(chat_id, state)
+                raise
+            if state.token is not None:
+                path = "redis"
+                state.lost = False
+                state.heartbeat = asyncio.create_task(self._heartbeat(chat_id, state))
+        state.acquired_at = time.monotonic()
+
+        waited = state.acquired_at - started
+        CHAT_LOCK_WAIT_SECONDS.labels(path).observe(waited)
+        self._stats[f"acquired_{path}"] += 1
+        if waited >= 0.001:
+            self._stats["contended"] += 1
+            self._stats["wait_ms_total"] += waited * 1000
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited * 1000)
+        return waited
+
+    async def _acquire_redis(self, chat_id: str, deadline: float, started: float,
+                             waiter: ChatLock = None) -> str | None:
+        """Entra en la cola FIFO de Redis y espera ser el primero con el lock libre."""
+        lock_key, queue_key, alive_key, seq_key, channel = self._keys(chat_id)
+        token = uuid.uuid4().hex
+        event = None
+        acquired = False
+        position = 0
+        try:
+            while True:
+                result = await self._redis.eval(
+                    _ACQUIRE_LUA, 4, lock_key, queue_key, alive_key, seq_key,
+                    token, CHAT_LOCK_LEASE_MS, CHAT_LOCK_WAITER_TTL_MS,
+                )
+                self._redis_recovered()
+                if int(result[0]) == 1:
+                    acquired = True
+                    return token
+                if int(result[1]) != position:
+                    position = int(result[1])
+                    if waiter is not None:
+                        waiter.position = position
+                    self._stats["max_position"] = max(self._stats["max_position"], position)
+                    logger.info(f"⏳ [ChatLock] Chat {chat_id} en cola: posición {position}")
+                if event is None:
+                    # Suscribirse antes de esperar: una liberación entre el eval y la espera
+                    # no se pierde porque se vuelve a evaluar enseguida
+                    event = await self._notifier.listen(channel)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timeout(chat_id, position, started)
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, CHAT_LOCK_RECHECK_MS / 1000))
+                    self._stats["wakeups"] += 1
+                except asyncio.TimeoutError:
+                    self._stats["rechecks"] += 1
+        except (ChatLockTimeout, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            self._redis_failed(e)
+            return None
+        finally:
+            if event is not None:
+                await self._notifier.unlisten(channel, event)
+            if not acquired and self._use_redis:
+                try:
+                    await self._redis.eval(_LEAVE_LUA, 3, queue_key, alive_key, channel, token)
+                except Exception:
+                    pass
+
+    async def _heartbeat(self, chat_id: str, state: _ChatState):
+        """Renueva el lease mientras se tenga el lock (hasta CHAT_LOCK_MAX_HOLD)."""
+        lock_key = self._keys(chat_id)[0]
+        token = state.token
+        while state.token == token:
+            await asyncio.sleep(CHAT_LOCK_LEASE_MS / 3000)
+            if time.monotonic() - state.acquired_at > CHAT_LOCK_MAX_HOLD:
+                logger.warning(f"⚠️ [ChatLock] Chat {chat_id} retenido más de {CHAT_LOCK_MAX_HOLD:.0f}s, "
+                               f"se deja vencer el lease")
+                state.lost = True
+                self._stats["expired_holds"] += 1
+                return
+            try:
+                renewed = await self._redis.eval(_RENEW_LUA, 1, lock_key, token, CHAT_LOCK_LEASE_MS)
+            except Exception as e:
+                logger.warning(f"⚠️ [ChatLock] Error renovando lease de {chat_id}: {e}")
+                continue
+            if not int(renewed):
+                logger.warning(f"⚠️ [ChatLock] Lease de {chat_id} perdido (otra instancia pudo tomarlo)")
+                state.lost = True
+                self._stats["lost_leases"] += 1
+                return
+
+    # ─── Liberación ───────────────────────────────────────────────
+
+    async def release(self, chat_id: str):
+        state = self._chats.get(chat_id)
+        if state is None or not state.lock.locked():
+            return
+        try:
+            if state.token is not None:
+                if (state.waiters and not state.lost and state.handoffs < CHAT_LOCK_MAX_HANDOFFS
+                        and not await self._remote_waiters(chat_id)):
+                    # Camino rápido: el siguiente de esta instancia hereda el lease
+                    state.handoffs += 1
+                    self._stats["handoffs"] += 1
+                else:
+                    await self._release_redis(chat_id, state)
+        finally:
+            state.lock.release()
+            self._discard_if_idle(chat_id, state)
+
+    async def _remote_waiters(self, chat_id: str) -> int:
+        """Waiters de otras instancias en la cola (si hay, el turno pasa por Redis)."""
+        try:
+            return int(await self._redis.zcard(self._keys(chat_id)[1]))
+        except Exception:
+            return 0
+
+    async def _release_redis(self, chat_id: str, state: _ChatState):
+        token, state.token, state.handoffs = state.token, None, 0
+        if state.heartbeat is not None:
+            state.heartbeat.cancel()
+            state.heartbeat = None
+        lock_key, _, _, _, channel = self._keys(chat_id)
+        try:
+            await self._redis.eval(_RELEASE_LUA, 2, lock_key, channel, token)
+        except Exception as e:
+            # El lease vence solo en CHAT_LOCK_LEASE_MS
+            logger.warning(f"⚠️ [ChatLock] Error liberando lock de {chat_id}: {e}")
+
+    async def close(self):
+        for chat_id, state in list(self._chats.items()):
+            if state.token is not None:
+                await self._release_redis(chat_id, state)
+        if self._notifier is not None:
+            await self._notifier.close()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis" if self._use_redis else "local",
+            "redis_paused_s": round(max(self._redis_retry_at - time.monotonic(), 0.0), 1),
+            "held": sum(1 for s in self._chats.values() if s.lock.locked()),
+            "waiting": sum(s.waiters for s in self._chats.values()),
+            "leases": sum(1 for s in self._chats.values() if s.token is not None),
+            **{k: round(v, 1) for k, v in self._stats.items()},
+        }
+
+
+_manager: ChatLockManager | None = None
+
+
+async def get_chat_lock_manager() -> ChatLockManager:
+    global _manager
+    if _manager is None:
+        _manager = ChatLockManager(await get_redis())
+    return _manager
@@ -0,0 +1,145 @@
+"""
+Coalescencia de mensajes por chat (debounce) antes de invocar al LLM.
+Los clientes de WhatsApp suelen enviar varios mensajes cortos seguidos; en lugar de
+lanzar un turno completo del agente por cada uno, los mensajes que llegan dentro de
+la ventana (o mientras el chat está ocupado) se fusionan en un único turno.
+"""
+import logging
+import os
+import time
+import asyncio
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+from app.bitrix import BOT_ID, parse_event
+
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "1500"))
+COALESCE_MAX_WAIT_MS = int(os.getenv("COALESCE_MAX_WAIT_MS", "5000"))
+MESSAGE_KEY = "data[PARAMS][MESSAGE]"
+
+
+@dataclass
+class _PendingTurn:
+    """Mensajes acumulados para un chat que aún no se han enviado al LLM."""
+    events: list = field(default_factory=list)
+    future: asyncio.Future = None
+    first_at: float = field(default_factory=time.monotonic)
+    timer: asyncio.Task = None
+
+
+def merge_events(events: list[dict]) -> dict:
+    """Fusiona varios eventos del mismo chat: usa el último como base y concatena los textos."""
+    if len(events) == 1:
+        return events[0]
+    merged = dict(events[-1])
+    texts = [e.get(MESSAGE_KEY) for e in events if e.get(MESSAGE_KEY)]
+    merged[MESSAGE_KEY] = "\n".join(texts)
+    return merged
+
+
+class ChatCoalescer:
+    """
+    Agrupa mensajes consecutivos del mismo DIALOG_ID en un solo turno.
+    - Ventana deslizante de COALESCE_WINDOW_MS desde el último mensaje,
+      acotada por COALESCE_MAX_WAIT_MS desde el primero.
+    - Si el chat está procesando un turno, los mensajes nuevos se acumulan y se
+      envían juntos apenas termina (en lugar de esperar el lock de Redis).
+    `submit` retorna cuando el turno que incluye el mensaje terminó, para que la
+    cola de ingesta confirme el evento solo después de procesarlo. Esa espera no
+    ocupa lectores ni slots del tenant: solo el turno (el handler) los toma.
+    """
+
+    def __init__(self, handler, window_ms: int = COALESCE_WINDOW_MS, max_wait_ms: int = COALESCE_MAX_WAIT_MS):
+        self._handler = handler
+        self._window = window_ms / 1000
+        self._max_wait = max_wait_ms / 1000
+        self._pending: dict[str, _PendingTurn] = {}
+        self._busy: set[str] = set()
+        self._timers: set[asyncio.Task] = set()
+        self._closed = False
+        self.merged_messages = 0
+        self.turns = 0
+
+    async def submit(self, data: dict):
+        """Agrega un evento al turno pendiente de su chat y espera a que se procese."""
+        event = parse_event(data)
+        dialog_id = event.dialog_id
+
+        # Mensajes sin chat o del propio bot no se fusionan
+        if not dialog_id or event.from_user_id == BOT_ID:
+            await self._handler(data)
+            return
+
+        turn = self._pending.get(dialog_id)
+        if turn is None:
+            turn = _PendingTurn(future=asyncio.get_running_loop().create_future())
+            self._pending[dialog_id] = turn
+        else:
+            self.merged_messages += 1
+        turn.events.append(data)
+
+        if dialog_id not in self._busy:
+            self._schedule(dialog_id, turn)
+
+        await asyncio.shield(turn.future)
+
+    def _schedule(self, dialog_id: str, turn: _PendingTurn):
+        """(Re)programa el envío del turno respetando la ventana y la espera máxima."""
+        if turn.timer:
+            turn.timer.cancel()
+        elapsed = time.monotonic() - turn.first_at
+        delay = max(min(self._window, self._max_wait - elapsed), 0)
+        turn.timer = asyncio.create_task(self._flush_after(dialog_id, delay))
+        self._timers.add(turn.timer)
+        turn.timer.add_done_callback(self._timers.discard)
+
+    async def _flush_after(self, dialog_id: str, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        turn = self._pending.pop(dialog_id, None)
+        if turn is None:
+            return
+
+        self._busy.add(dialog_id)
+        self.turns += 1
+        if len(turn.events) > 1:
+            logger.info(f"🧩 [Coalescer] {len(turn.events)} mensajes fusionados en un turno para {dialog_id}")
+        try:
+            await self._handler(merge_events(turn.events))
+            turn.future.set_result(None)
+        except Exception as e:
+            turn.future.set_exception(e)
+        except BaseException:
+            # Cancelado con el turno en curso (apagado): los submit que esperan no deben
+            # quedar colgados; sus eventos no se confirman y el stream los re-entrega
+            turn.future.cancel()
+            raise
+        finally:
+            self._busy.discard(dialog_id)
+            # Mensajes que llegaron mientras el chat estaba ocupado: enviarlos ya
+            queued = self._pending.get(dialog_id)
+            if queued is not None and not self._closed:
+                queued.first_at = 0
+                self._schedule(dialog_id, queued)
+
+    async def close(self):
+        """Cancela los turnos programados y en curso (apagado). Los submit pendientes terminan cancelados."""
+        self._closed = True
+        timers = list(self._timers)
+        for task in timers:
+            task.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        for turn in self._pending.values():
+            turn.future.cancel()
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": int(self._window * 1000),
+            "pending_chats": len(self._pending),
+            "busy_chats": len(self._busy),
+            "timers": len(self._timers),
+            "turns": self.turns,
+            "merged_messages": self.merged_messages,
+        }
@@ -1,5 +1,8 @@
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 class AIConfig:
     """
     Configuración central de IA. 
@@ -18,9 +21,9 @@ class AIConfig:
 
     @classmethod
     def print_summary(cls):
-        print(f"🤖 [Config] Provider: {cls.LLM_PROVIDER}")
-        print(f"🤖 [Config] Model: {cls.MODEL}")
-        print(f"🤖 [Config] Temperature: {cls.TEMPERATURE}")
-        print(f"🔑 [Config] API Key: {cls.get_masked_key()}")
+        logger.info(f"🤖 [Config] Provider: {cls.LLM_PROVIDER}")
+        logger.info(f"🤖 [Config] Model: {cls.MODEL}")
+        logger.info(f"🤖 [Config] Temperature: {cls.TEMPERATURE}")
+        logger.info(f"🔑 [Config] API Key: {cls.get_masked_key()}")
 
 config = AIConfig()
@@ -0,0 +1,159 @@
+"""
+Proyección en memoria de la configuración de Firestore, mantenida por los
+snapshot listeners (ver FirestoreConfigService.start_listener):
+- agents activos (query isActive == True) agrupados por tenant
+- config-secrets por dominio y el documento global settings/ai
+La primera entrega de cada listener carga la colección completa; las
+siguientes se aplican de forma incremental (ADDED / MODIFIED / REMOVED). Con
+todas las fuentes cargadas, la config de un (tenant, bot) sale de dicts en RAM,
+sin lecturas de Firestore ni de Redis.
+Los cambios se aplican en el event loop (el listener de Firestore corre en su
+propio hilo y solo encola), así las lecturas nunca ven un estado a medias.
+"""
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ("agents", "secrets", "ai")
+
+# Campos del agente que forman parte de la config (un cambio en otros, p.ej. updatedAt, se ignora)
+AGENT_FIELDS = ("tenantId", "botId", "isActive", "name", "role", "systemPrompt", "model",
+                "temperature", "provider", "openaiApiKey", "openai_api_key", "googleApiKey", "google_api_key")
+
+
+def agent_config(agent_payload: dict) -> dict:
+    """Campos del agente activo que entran en la config del tenant."""
+    if not agent_payload:
+        return {}
+    return {
+        "role": agent_payload.get("role"),
+        "systemPrompt": agent_payload.get("systemPrompt"),
+        "model": agent_payload.get("model"),
+        "temperature": agent_payload.get("temperature"),
+        "provider": agent_payload.get("provider"),
+        "openaiApiKey": agent_payload.get("openaiApiKey") or agent_payload.get("openai_api_key"),
+        "googleApiKey": agent_payload.get("googleApiKey") or agent_payload.get("google_api_key"),
+    }
+
+
+def merge_config(domain: str, ai_data: dict, agent_payload: dict, secrets_data: dict) -> dict:
+    """Config completa del tenant/bot (prioridad: secrets > agent > ai)."""
+    return {
+        "domain": domain,
+        **(ai_data or {}),
+        **agent_config(agent_payload),
+        **(secrets_data or {}),
+    }
+
+
+class ConfigProjection:
+    """Estado de Firestore proyectado en memoria y actualizado por eventos de cambio."""
+
+    def __init__(self):
+        self._agents: dict[str, dict[str, dict]] = defaultdict(dict)  # tenant -> doc_id -> agente activo
+        self._agent_tenant: dict[str, str] = {}  # doc_id -> tenant (para los REMOVED, que no traen datos útiles)
+        self._secrets: dict[str, dict] = {}
+        self._ai: dict = {}
+        self._loaded: set[str] = set()
+        self._stats = defaultdict(int)
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded.issuperset(SOURCES)
+
+    def load(self, source: str, docs: list[tuple]):
+        """Carga inicial de una fuente: `docs` = [(doc_id, data), ...]."""
+        if source == "ai":
+            self._ai = dict(docs[0][1] or {}) if docs else {}
+        elif source == "agents":
+            self._agents.clear()
+            self._agent_tenant.clear()
+            for doc_id, data in docs:
+                self._put_agent(doc_id, data)
+        else:
+            self._secrets = {doc_id: data or {} for doc_id, data in docs}
+        self._loaded.add(source)
+        self._stats[f"{source}_loaded"] = len(docs)
+        logger.info(f"🗂️ [Projection] {source}: {len(docs)} documentos cargados")
+        if self.ready:
+            logger.info("🗂️ [Projection] Config de Firestore proyectada en memoria")
+
+    def apply(self, source: str, changes: list[tuple]) -> set[str]:
+        """
+        Aplica cambios incrementales: `changes` = [(tipo, doc_id, data), ...] con
+        tipo ADDED | MODIFIED | REMOVED. Retorna los tenants cuya config cambió.
+        """
+        changed = set()
+        for kind, doc_id, data in changes:
+            self._stats[f"{source}_changes"] += 1
+            if source == "ai":
+                if (data or {}) != self._ai:
+                    self._ai = dict(data or {}) if kind != "REMOVED" else {}
+                    # settings/ai es global: afecta a todos los tenants conocidos
+                    changed.update(self._secrets, self._agents)
+            elif source == "agents":
+                before = self._pop_agent(doc_id)
+                if kind != "REMOVED":
+                    self._put_agent(doc_id, data)
+                after = (data or {}) if kind != "REMOVED" else None
+                if _agent_fields(before) != _agent_fields(after):
+                    changed.update(
+                        str(d["tenantId"]) for d in (before, after) if d and d.get("tenantId")
+                    )
+            else:
+                previous = self._secrets.pop(doc_id, None)
+                if kind != "REMOVED":
+                    self._secrets[doc_id] = data or {}
+                if previous != self._secrets.get(doc_id):
+                    changed.add(doc_id)
+        return changed
+
+    def _put_agent(self, doc_id: str, data: dict):
+        tenant_id = (data or {}).get("tenantId")
+        if not tenant_id or not data.get("isActive"):
+            return
+        self._agents[str(tenant_id)][doc_id] = data
+        self._agent_tenant[doc_id] = str(tenant_id)
+
+    def _pop_agent(self, doc_id: str) -> dict | None:
+        tenant_id = self._agent_tenant.pop(doc_id, None)
+        if tenant_id is None:
+            return None
+        agents = self._agents.get(tenant_id, {})
+        data = agents.pop(doc_id, None)
+        if not agents:
+            self._agents.pop(tenant_id, None)
+        return data
+
+    def active_agent(self, tenant_id: str, bot_id: str = None) -> dict:
+        """Mismo criterio que la query de Firestore: primer agente activo por ID de documento."""
+        agents = self._agents.get(tenant_id) or {}
+        for doc_id in sorted(agents):
+            data = agents[doc_id]
+            if not bot_id or str(data.get("botId")) == str(bot_id):
+                return data
+        return {}
+
+    def config_for(self, tenant_id: str, bot_id: str = None) -> dict:
+        """Config completa del tenant/bot desde memoria (requiere `ready`)."""
+        self._stats["lookups"] += 1
+        return merge_config(
+            tenant_id, self._ai, self.active_agent(tenant_id, bot_id), self._secrets.get(tenant_id)
+        )
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "loaded": sorted(self._loaded),
+            "tenants_with_agents": len(self._agents),
+            "active_agents": len(self._agent_tenant),
+            "secrets": len(self._secrets),
+            **self._stats,
+        }
+
+
+def _agent_fields(data: dict | None) -> tuple | None:
+    if not data:
+        return None
+    return tuple(data.get(field) for field in AGENT_FIELDS)
@@ -4,3 +4,7 @@ import contextvars
 # Se usa para que servicios como TokenManager sepan qué tenant está operando
 # sin tener que pasar el ID explícitamente en cada función.
 member_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("member_id", default="")
+
+# IDs de correlación del request en curso (los agrega app.log a cada registro)
+chat_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("chat_id", default="")
+session_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("session_id", default="")
@@ -1,18 +1,40 @@
+"""
+Configuración por tenant/bot desde Firestore, con caché en dos niveles:
+- L1 en proceso (app.local_cache) por (tenant, bot, versión): sin round trip
+  a Redis ni json.loads en cada sesión nueva.
+- L2 en Redis: `config:tenant:{tenant}:v{version}:bot:{bot|default}`.
+Cada tenant tiene una versión monótona (`config:tenant:{tenant}:version`);
+invalidar = INCR, así quedan obsoletas de una vez todas las claves de bot del
+tenant. La invalidación la dispara el listener de Firestore y se difunde por
+pub/sub (CONFIG_INVALIDATION_CHANNEL) a las demás instancias. Si se pierde un
+mensaje, la versión se relee de Redis cada CONFIG_VERSION_TTL segundos.
+Con CONFIG_PROJECTION, los listeners de agents, config-secrets y settings/ai
+mantienen una proyección en memoria (app.config_projection): una vez cargada,
+la config sale de ahí y la caché solo cubre el arranque. Cada instancia recibe
+los cambios de Firestore por su propio listener y los aplica localmente; la
+versión en Redis la sube una sola (la primera que ve el cambio), sin pub/sub.
+"""
+import logging
 import os
 import json
 import asyncio
-import sys
+import hashlib
+from collections import defaultdict
 import firebase_admin
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+logger = logging.getLogger(__name__)
 from firebase_admin import credentials, firestore
 from google.cloud import firestore as google_firestore
 from app.redis_client import get_redis
 from app.db_schema import Collections
+from app.local_cache import get_cache
+from app.config_projection import ConfigProjection, merge_config
+
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", "3600"))
+CONFIG_L1_TTL = float(os.getenv("CONFIG_L1_TTL", "300"))
+CONFIG_VERSION_TTL = float(os.getenv("CONFIG_VERSION_TTL", "30"))
+CONFIG_INVALIDATION_CHANNEL = "config:invalidate"
+CONFIG_PROJECTION = os.getenv("CONFIG_PROJECTION", "true").lower() in ("1", "true", "yes")
 
 class FirestoreConfigService:
     _instance = None
@@ -36,9 +58,9 @@ class FirestoreConfigService:
                     
                     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = temp_path
                     firebase_admin.initialize_app()
-                    print(f"🔐 [Firestore] Initialized using content from FIRESTORE_KEY_CONTENT")
+                    logger.info(f"🔐 [Firestore] Initialized using content from FIRESTORE_KEY_CONTENT")
                 except Exception as e:
-                    print(f"❌ Error initializing via FIRESTORE_KEY_CONTENT: {e}")
+                    logger.error(f"❌ Error initializing via FIRESTORE_KEY_CONTENT: {e}")
                     pass
             
             # 2. Try Standard File detection (Local Dev or if GOOGLE_APPLICATION_CREDENTIALS already set)
@@ -48,15 +70,15 @@ class FirestoreConfigService:
                 default_path = "firestore-key.json"
                 if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
                      firebase_admin.initialize_app()
-                     print(f"🔐 [Firestore] Initialized using existing GOOGLE_APPLICATION_CREDENTIALS")
+                     logger.info(f"🔐 [Firestore] Initialized using existing GOOGLE_APPLICATION_CREDENTIALS")
                 elif os.path.exists(default_path):
                     cred = credentials.Certificate(default_path)
                     firebase_admin.initialize_app(cred)
-                    print(f"🔐 [Firestore] Initialized using local file: {default_path}")
+                    logger.info(f"🔐 [Firestore] Initialized using local file: {default_path}")
             
             # 3. Fallback (GCP Environment / Mock)
             if not firebase_admin._apps:
-                print("⚠️ [Firestore] No explicit credentials found. Using default/anonymous.")
+                logger.warning("⚠️ [Firestore] No explicit credentials found. Using default/anonymous.")
                 firebase_admin.initialize_app()
         
         self._db = firestore.client() # Sync client for listeners
@@ -65,12 +87,22 @@ class FirestoreConfigService:
         try:
              # This will use the same GOOGLE_APPLICATION_CREDENTIALS or default auth
              self._async_db = google_firestore.AsyncClient()
-             print("✅ [Firestore] AsyncClient initialized successfully.")
+             logger.info("✅ [Firestore] AsyncClient initialized successfully.")
         except Exception as e:
-             print(f"❌ [Firestore] Failed to initialize AsyncClient: {e}")
+             logger.error(f"❌ [Firestore] Failed to initialize AsyncClient: {e}")
              self._async_db = None
 
         self._redis = None
+        self._l1 = get_cache("tenant_config", maxsize=512, ttl=CONFIG_L1_TTL)
+        self._versions = get_cache("tenant_config_version", maxsize=1024, ttl=CONFIG_VERSION_TTL)
+        self._applied: dict[str, int] = {}  # última versión vista por tenant (no expira)
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._watches = []
+        self._projection = ConfigProjection()
+        self._primed: set[str] = set()  # fuentes cuya carga inicial ya llegó
+        self._pubsub = None
+        self._pubsub_task: asyncio.Task | None = None
+        self._stats = defaultdict(int)
 
     @classmethod
     async def get_instance(cls):
@@ -80,10 +112,18 @@ class FirestoreConfigService:
             cls._instance._redis = await get_redis()
         return cls._instance
 
-    def _get_cache_key(self, tenant_id: str, bot_id: str = None) -> str:
-        if bot_id:
-            return f"config:tenant:{tenant_id}:bot:{bot_id}"
-        return f"config:tenant:{tenant_id}"
+    def _get_cache_key(self, tenant_id: str, bot_id: str = None, version: int = 0) -> str:
+        return f"config:tenant:{tenant_id}:v{version}:bot:{bot_id or 'default'}"
+
+    def _version_key(self, tenant_id: str) -> str:
+        return f"config:tenant:{tenant_id}:version"
+
+    async def _version(self, tenant_id: str) -> int:
+        version = self._versions.get(tenant_id)
+        if version is None:
+            version = int(await self._redis.get(self._version_key(tenant_id)) or 0)
+            version = await self._apply_version(tenant_id, version)
+        return version
 
     async def get_tenant_config(self, tenant_id: str, bot_id: str = None) -> dict:
         """
@@ -91,18 +131,35 @@ class FirestoreConfigService:
         1. installations/{tenant_id} -> para obtener el DOMINIO
         2. settings/ai -> Global AI Config
         3. agents (query) -> Active Agent (filtrado por tenantId y opcionalmente botId)
+        El dict retornado es compartido por la caché L1: no modificarlo.
         """
+        if self._projection.ready:
+            # Proyección de los listeners: sin lecturas de Firestore ni de Redis
+            self._stats["projection_hits"] += 1
+            return self._projection.config_for(tenant_id, bot_id)
+
         if not self._async_db:
-             print("❌ [Firestore] cannot get_tenant_config: AsyncClient not ready.")
+             logger.error("❌ [Firestore] cannot get_tenant_config: AsyncClient not ready.")
              return {}
 
-        cache_key = self._get_cache_key(tenant_id, bot_id)
+        version = await self._version(tenant_id)
+        l1_key = (tenant_id, bot_id or "", version)
+        config = self._l1.get(l1_key)
+        if config is not None:
+            return config
+
+        cache_key = self._get_cache_key(tenant_id, bot_id, version)
         cached = await self._redis.get(cache_key)
         
         if cached:
-            return json.loads(cached)
+            config = json.loads(cached)
+            self._l1.set(l1_key, config)
+            self._stats["l2_hits"] += 1
+            return config
 
-        print(f"📡 [Firestore] Cargando configuración completa para {tenant_id}...")
+        self._stats["misses"] += 1
+
+        logger.info(f"📡 [Firestore] Cargando configuración completa para {tenant_id}...")
         
         domain = tenant_id
 
@@ -114,7 +171,7 @@ class FirestoreConfigService:
                 doc = await doc_ref.get()
                 return doc.to_dict() if doc.exists else {}
             except Exception as e:
-                print(f"❌ Error fetching {collection}/{doc_id}: {e}")
+                logger.error(f"❌ Error fetching {collection}/{doc_id}: {e}")
                 return {}
 
         async def fetch_agent():
@@ -133,11 +190,11 @@ class FirestoreConfigService:
                      return doc.to_dict()
                 
             except Exception as e:
-                print(f"⚠️ Error buscando agente activo: {e}")
+                logger.warning(f"⚠️ Error buscando agente activo: {e}")
             return {}
 
         start_time = asyncio.get_event_loop().time()
-        print(f"📡 [Firestore] Iniciando carga paralela de documentos para {tenant_id}...")
+        logger.info(f"📡 [Firestore] Iniciando carga paralela de documentos para {tenant_id}...")
         
         results = await asyncio.gather(
             fetch_doc(Collections.INSTALLATIONS, domain),
@@ -147,80 +204,225 @@ class FirestoreConfigService:
         )
         
         end_time = asyncio.get_event_loop().time()
-        print(f"⏱️ [Firestore] Carga completada en {end_time - start_time:.3f}s")
+        logger.info(f"⏱️ [Firestore] Carga completada en {end_time - start_time:.3f}s")
         
         install_data, ai_data, secrets_data, agent_payload = results
 
         if not install_data:
-             print(f"⚠️ Installation Data no encontrada en installations/{domain}")
+             logger.warning(f"⚠️ Installation Data no encontrada en installations/{domain}")
         
         if not ai_data:
-             print("⚠️ [Firestore] Global AI Settings (settings/ai) not found!")
+             logger.warning("⚠️ [Firestore] Global AI Settings (settings/ai) not found!")
 
-        # Process Agent Data
-        agent_data = {}
         if agent_payload:
-            agent_data = {
-                "role": agent_payload.get("role"),
-                "systemPrompt": agent_payload.get("systemPrompt"),
-                "model": agent_payload.get("model"),
-                "temperature": agent_payload.get("temperature"),
-                "provider": agent_payload.get("provider"),
-                "openaiApiKey": agent_payload.get("openaiApiKey") or agent_payload.get("openai_api_key"),
-                "googleApiKey": agent_payload.get("googleApiKey") or agent_payload.get("google_api_key"),
-            }
-            print(f"🤖 [Firestore] Agente activo encontrado: {agent_payload.get('name')}")
+            logger.info(f"🤖 [Firestore] Agente activo encontrado: {agent_payload.get('name')}")
 
         # Combinar todo (Prioridad: secrets > agent > ai)
         # Eliminamos config_app y config_architect por optimización (no usados por el bot)
-        full_config = {
-            "domain": domain,
-            **ai_data,
-            **agent_data,
-            **secrets_data
-        }
+        full_config = merge_config(domain, ai_data, agent_payload, secrets_data)
         
-        # Guardar en Redis
-        await self._redis.set(cache_key, json.dumps(full_config), ex=3600)
-        print(f"✅ Config cached for {tenant_id} (Domain: {domain})")
+        # Guardar en Redis y en L1. Si el tenant se invalidó durante la carga, la
+        # entrada queda bajo la versión anterior y nadie la vuelve a leer.
+        await self._redis.set(cache_key, json.dumps(full_config), ex=CONFIG_CACHE_TTL)
+        self._l1.set(l1_key, full_config)
+        logger.info(f"✅ Config cached for {tenant_id} (Domain: {domain}, v{version})")
         
         return full_config
 
-    def start_listener(self):
+    async def start_listener(self):
         """
-        Inicia listeners en tiempo real en segundo plano.
+        Inicia listeners en tiempo real en segundo plano: el canal de invalidación
+        compartido (pub/sub) y los snapshot listeners de Firestore.
         """
+        self._loop = asyncio.get_running_loop()
+        if hasattr(self._redis, "pubsub"):
+            try:
+                self._pubsub = self._redis.pubsub()
+                await self._pubsub.subscribe(CONFIG_INVALIDATION_CHANNEL)
+                self._pubsub_task = asyncio.create_task(self._invalidation_reader())
+            except Exception as e:
+                self._pubsub = None
+                logger.warning(f"⚠️ [Config] No se pudo suscribir a {CONFIG_INVALIDATION_CHANNEL}: {e}")
         try:
             # 1. config-secrets (propaga por domain)
-            self._db.collection(Collections.CONFIG_SECRETS).on_snapshot(self._on_secrets_change)
-            print("👀 [Firestore] Listeners activos (Optimized: config-secrets only).")
+            sources = [("secrets", self._db.collection(Collections.CONFIG_SECRETS))]
+            if CONFIG_PROJECTION:
+                # 2. Agentes activos (un agente desactivado llega como REMOVED) y settings/ai
+                sources += [
+                    ("agents", self._db.collection(Collections.AGENTS).where(
+                        filter=google_firestore.FieldFilter("isActive", "==", True))),
+                    ("ai", self._db.collection("settings").document("ai")),
+                ]
+            for source, ref in sources:
+                self._watches.append(ref.on_snapshot(self._snapshot_handler(source)))
+            logger.info(f"👀 [Firestore] Listeners activos: {', '.join(s for s, _ in sources)}.")
         except Exception as e:
-            print(f"⚠️ No se pudieron activar los listeners de Firestore: {e}")
+            logger.warning(f"⚠️ No se pudieron activar los listeners de Firestore: {e}")
+
+    def _snapshot_handler(self, source: str):
+        """
+        Callback de on_snapshot para una fuente. Corre en el hilo del listener de
+        Firestore: solo extrae los datos y delega la aplicación al event loop.
+        """
+        def on_snapshot(doc_snapshot, changes, read_time):
+            if source not in self._primed:
+                # La primera entrega es el estado inicial completo, no un cambio
+                self._primed.add(source)
+                docs = [(doc.id, doc.to_dict()) for doc in doc_snapshot if doc.exists]
+                self._run_in_loop(self._load_projection, source, docs)
+                return
+            payload = [
+                (change.type.name, change.document.id,
+                 change.document.to_dict() if change.type.name != "REMOVED" else None)
+                for change in changes
+            ]
+            # Mismo valor en todas las instancias para el mismo cambio (update_time del documento)
+            stamp = "|".join(sorted(f"{c.document.id}@{c.document.update_time}" for c in changes))
+            self._run_in_loop(self._apply_projection, source, payload, f"{source}:{stamp}")
+        return on_snapshot
+
+    def _run_in_loop(self, handler, *args):
+        if self._loop is None or self._loop.is_closed():
+            return
+        future = asyncio.run_coroutine_threadsafe(handler(*args), self._loop)
+        future.add_done_callback(
+            lambda f: f.cancelled() or f.exception() is None
+            or logger.error(f"❌ [Config] Error aplicando cambios de Firestore: {f.exception()}")
+        )
+
+    async def _load_projection(self, source: str, docs: list):
+        self._projection.load(source, docs)
+
+    async def _apply_projection(self, source: str, changes: list, change_id: str):
+        """
+        Cambio recibido por el listener de esta instancia: se aplica solo aquí (las
+        demás instancias lo reciben por su propio listener, no hace falta pub/sub).
+        """
+        for tenant_id in self._projection.apply(source, changes):
+            logger.info(f"♻️ [Firestore] Cambió {source} para dominio {tenant_id}.")
+            self._stats["listener_changes"] += 1
+            await self._config_changed(tenant_id)
+            try:
+                await self._bump_shared_version(tenant_id, change_id)
+            except Exception as e:
+                logger.warning(f"⚠️ [Config] Error versionando la caché de {tenant_id}: {e}")
 
-    def _on_secrets_change(self, doc_snapshot, changes, read_time):
-        for doc in doc_snapshot:
-            domain = doc.id
-            print(f"♻️ [Firestore] Secretos cambiaron para dominio {domain}.")
-            self._update_cache_background(domain)
+    async def _bump_shared_version(self, tenant_id: str, change_id: str):
+        """Sube la versión de la caché en Redis una sola vez por cambio de Firestore (la primera instancia)."""
+        digest = hashlib.sha1(change_id.encode("utf-8")).hexdigest()[:16]
+        if not await self._redis.set(f"config:tenant:{tenant_id}:seen:{digest}", 1, nx=True, ex=600):
+            return
+        self._remember_version(tenant_id, await self._bump_version(tenant_id))
+
+    async def _bump_version(self, tenant_id: str) -> int:
+        if hasattr(self._redis, "incr"):
+            return int(await self._redis.incr(self._version_key(tenant_id)))
+        version = await self._version(tenant_id) + 1
+        await self._redis.set(self._version_key(tenant_id), version)
+        return version
+
+    def _remember_version(self, tenant_id: str, version: int):
+        """Versión ya aplicada localmente (no vuelve a disparar _config_changed al releerla)."""
+        self._applied[tenant_id] = max(version, self._applied.get(tenant_id, 0))
+        self._versions.set(tenant_id, self._applied[tenant_id])
+
+    async def invalidate(self, tenant_id: str) -> int:
+        """Invalida la config de todos los bots del tenant, en todas las instancias."""
+        version = await self._bump_version(tenant_id)
+        self._stats["invalidations"] += 1
+        self._remember_version(tenant_id, version)
+        await self._config_changed(tenant_id)
+        if self._pubsub is not None:
+            try:
+                await self._redis.publish(
+                    CONFIG_INVALIDATION_CHANNEL, json.dumps({"tenant": tenant_id, "version": version})
+                )
+            except Exception as e:
+                # Las demás instancias la verán al releer la versión (CONFIG_VERSION_TTL)
+                logger.warning(f"⚠️ [Config] Error publicando invalidación de {tenant_id}: {e}")
+        logger.info(f"🔄 [Config] Caché invalidado para tenant {tenant_id} (v{version}).")
+        return version
+
+    async def _apply_version(self, tenant_id: str, version: int) -> int:
+        """
+        Adopta la versión del tenant (por pub/sub, invalidación local o relectura
+        de Redis). Si avanzó, las entradas L1 quedan obsoletas y los prototipos de
+        agente del tenant se reconstruyen con la config nueva. Retorna la vigente.
+        """
+        known = self._applied.get(tenant_id)
+        if known is not None and version <= known:
+            # Ya aplicada (p.ej. el eco de la propia publicación) o lectura atrasada
+            self._versions.set(tenant_id, known)
+            return known
+        self._applied[tenant_id] = version
+        self._versions.set(tenant_id, version)
+        if known is not None:
+            await self._config_changed(tenant_id)
+        return version
+
+    async def _config_changed(self, tenant_id: str):
+        """Prototipos de agente a reconstruir y sesiones vivas avisadas (toman el prompt nuevo)."""
+        from app.agent_factory import get_agent_factory
+        from app.sessions import mark_config_changed
+        factory = await get_agent_factory()
+        factory.invalidate(tenant_id)
+        marked = mark_config_changed(tenant_id)
+        if marked:
+            logger.info(f"📣 [Config] {marked} sesiones vivas de {tenant_id} tomarán la config nueva")
+
+    async def _invalidation_reader(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ [Config] Error leyendo pub/sub: {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if not message or message.get("type") != "message":
+                continue
+            try:
+                data = json.loads(message["data"])
+                await self._apply_version(data["tenant"], int(data["version"]))
+                self._stats["remote_invalidations"] += 1
+            except Exception as e:
+                logger.warning(f"⚠️ [Config] Invalidación mal formada: {e}")
 
     async def warmup(self):
         """Pre-carga datos globales para evitar lag en el primer mensaje."""
         try:
             await self.get_tenant_config("warmup_test")
-            print("🔥 [Firestore] Warmup completado.")
+            logger.info("🔥 [Firestore] Warmup completado.")
         except:
              pass
 
-    def _update_cache_background(self, tenant_id: str):
-        """Dispara una actualización de caché fuera del hilo del listener."""
-        import redis
-        try:
-            r = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
-            # Forzamos borrado para que el siguiente request haga el fetch unificado
-            r.delete(self._get_cache_key(tenant_id))
-            print(f"🔄 [Redis] Caché invalidado para tenant: {tenant_id} por cambio en Firestore.")
-        except Exception as e:
-            print(f"❌ Error invalidando caché en background: {e}")
+    async def close(self):
+        for watch in self._watches:
+            try:
+                watch.unsubscribe()
+            except Exception:
+                pass
+        self._watches.clear()
+        if self._pubsub_task is not None:
+            self._pubsub_task.cancel()
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        l1 = self._l1.stats()
+        lookups = l1["hits"] + l1["misses"]
+        return {
+            "l1": l1,
+            **self._stats,
+            "hit_ratio": round((l1["hits"] + self._stats["l2_hits"]) / lookups, 3) if lookups else 0.0,
+            "tenants_tracked": len(self._applied),
+            "pubsub": self._pubsub is not None,
+            "projection": self._projection.stats(),
+        }
 
 _service = None
 
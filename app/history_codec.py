@@ -0,0 +1,144 @@
+"""
+Codecs binarios para los mensajes del historial en Redis (`chat:{id}:history`).
+Cada entrada lleva un encabezado versionado: 0xC1 (byte que msgpack nunca usa y
+que no puede iniciar un JSON) + id de codec. Las entradas sin encabezado son el
+JSON de versiones anteriores y se siguen leyendo de forma transparente.
+
+    HISTORY_CODEC=msgpack       (por defecto)
+    HISTORY_CODEC=msgpack+zstd  (requiere `zstandard`; diccionario opcional en HISTORY_ZSTD_DICT)
+    HISTORY_CODEC=json          (formato anterior)
+"""
+import logging
+import os
+import json
+import struct
+
+logger = logging.getLogger(__name__)
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional: sin él se usa msgpack sin comprimir
+    zstandard = None
+
+MAGIC = 0xC1
+CODEC_MSGPACK = 0x01
+CODEC_ZSTD = 0x02
+# Por debajo de este tamaño zstd no compensa su propio encabezado
+ZSTD_MIN_BYTES = int(os.getenv("HISTORY_ZSTD_MIN_BYTES", "96"))
+ZSTD_LEVEL = int(os.getenv("HISTORY_ZSTD_LEVEL", "3"))
+
+
+class JsonCodec:
+    """Formato original: JSON en texto, sin encabezado."""
+    name = "json"
+
+    def encode(self, entry: dict) -> bytes:
+        return json.dumps(entry, ensure_ascii=False).encode("utf-8")
+
+    def decode(self, raw: bytes) -> dict:
+        return json.loads(raw)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    _header = bytes((MAGIC, CODEC_MSGPACK))
+
+    def encode(self, entry: dict) -> bytes:
+        return self._header + msgpack.packb(entry, use_bin_type=True)
+
+    def decode(self, raw: bytes) -> dict:
+        return msgpack.unpackb(raw[2:], raw=False)
+
+
+class ZstdMsgpackCodec(MsgpackCodec):
+    """
+    msgpack comprimido con zstd. Con un diccionario compartido (entrenado sobre
+    historiales reales con scripts/bench_history_codec.py --train-dict) los
+    mensajes cortos también comprimen. Encabezado: magic, codec, dict_id (u32).
+    """
+    name = "msgpack+zstd"
+
+    def __init__(self, dict_data: bytes = None, level: int = ZSTD_LEVEL):
+        if zstandard is None:
+            raise RuntimeError("zstandard no está instalado")
+        self.dict = zstandard.ZstdCompressionDict(dict_data) if dict_data else None
+        self.dict_id = self.dict.dict_id() if self.dict else 0
+        self._header = bytes((MAGIC, CODEC_ZSTD)) + struct.pack(">I", self.dict_id)
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=self.dict, write_content_size=True)
+        self._decompressor = zstandard.ZstdDecompressor(dict_data=self.dict)
+
+    def encode(self, entry: dict) -> bytes:
+        packed = msgpack.packb(entry, use_bin_type=True)
+        if len(packed) < ZSTD_MIN_BYTES:
+            return MsgpackCodec._header + packed
+        return self._header + self._compressor.compress(packed)
+
+    def decode(self, raw: bytes) -> dict:
+        return msgpack.unpackb(self._decompressor.decompress(raw[6:]), raw=False)
+
+
+_json = JsonCodec()
+_msgpack = MsgpackCodec()
+# dict_id -> codec zstd capaz de leer entradas escritas con ese diccionario
+_zstd_codecs: dict[int, ZstdMsgpackCodec] = {}
+_codec = None
+
+
+def _load_zstd(dict_path: str = None) -> ZstdMsgpackCodec:
+    dict_data = None
+    if dict_path:
+        with open(dict_path, "rb") as f:
+            dict_data = f.read()
+    codec = ZstdMsgpackCodec(dict_data)
+    _zstd_codecs[codec.dict_id] = codec
+    return codec
+
+
+def get_history_codec():
+    """Codec de escritura configurado (HISTORY_CODEC); si zstd no está disponible cae a msgpack."""
+    global _codec
+    if _codec is None:
+        name = os.getenv("HISTORY_CODEC", "msgpack")
+        if name == "json":
+            _codec = _json
+        elif name == "msgpack+zstd":
+            try:
+                _codec = _load_zstd(os.getenv("HISTORY_ZSTD_DICT"))
+            except Exception as e:
+                logger.warning(f"⚠️ [HistoryCodec] zstd no disponible ({e}), usando msgpack")
+                _codec = _msgpack
+        else:
+            _codec = _msgpack
+    return _codec
+
+
+def encode_entry(entry: dict) -> bytes:
+    return get_history_codec().encode(entry)
+
+
+def decode_entry(raw) -> dict:
+    """Decodifica una entrada de cualquier versión (msgpack, msgpack+zstd o JSON legado)."""
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if not raw or raw[0] != MAGIC:
+        return _json.decode(raw)
+    codec_id = raw[1]
+    if codec_id == CODEC_MSGPACK:
+        return _msgpack.decode(raw)
+    if codec_id == CODEC_ZSTD:
+        dict_id = struct.unpack(">I", raw[2:6])[0]
+        codec = _zstd_codecs.get(dict_id)
+        if codec is None:
+            # Entradas escritas con otra configuración: cargar el diccionario configurado (o ninguno)
+            codec = _load_zstd(os.getenv("HISTORY_ZSTD_DICT") if dict_id else None)
+            if codec.dict_id != dict_id:
+                raise ValueError(f"Entrada comprimida con un diccionario zstd desconocido ({dict_id})")
+        return codec.decode(raw)
+    raise ValueError(f"Codec de historial desconocido: {codec_id}")
+
+
+def is_legacy(raw) -> bool:
+    """True si la entrada está en JSON (se re-codifica al migrar)."""
+    return isinstance(raw, str) or not raw or raw[0] != MAGIC
@@ -0,0 +1,125 @@
+"""
+Pool de conexiones HTTP por portal de Bitrix24.
+Reutiliza un `httpx.AsyncClient` por host (keep-alive y HTTP/2 vía `httpx[http2]`; sin `h2` cae a HTTP/1.1)
+para que las respuestas y el typing indicator no paguen un handshake TLS por llamada.
+Expone métricas de aciertos del pool, handshakes y latencia por método.
+"""
+import logging
+import os
+import time
+import asyncio
+from collections import defaultdict
+from urllib.parse import urlsplit
+import httpx
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  (habilita HTTP/2 en httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "120"))
+DEFAULT_TIMEOUT = 15
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_lock = asyncio.Lock()
+_stats = defaultdict(int)
+_latency: dict[str, dict] = {}
+
+
+def _host_of(url: str) -> str:
+    """Extrae el host de una URL o endpoint (https://portal.bitrix24.com/rest/)."""
+    return urlsplit(url).netloc or url.split("/")[0]
+
+
+async def _trace(event_name: str, info: dict):
+    """Callback de trazas de httpcore: cuenta conexiones nuevas y handshakes TLS."""
+    if event_name == "connection.connect_tcp.complete":
+        _stats["connections_opened"] += 1
+    elif event_name == "connection.start_tls.complete":
+        _stats["tls_handshakes"] += 1
+
+
+async def get_portal_client(url: str) -> httpx.AsyncClient:
+    """Retorna el cliente compartido para el host del portal, creándolo si no existe."""
+    host = _host_of(url)
+    client = _clients.get(host)
+    if client is not None and not client.is_closed:
+        _stats["pool_hits"] += 1
+        return client
+
+    async with _lock:
+        client = _clients.get(host)
+        if client is None or client.is_closed:
+            _stats["pool_misses"] += 1
+            client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=DEFAULT_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+                ),
+            )
+            _clients[host] = client
+        else:
+            _stats["pool_hits"] += 1
+    return client
+
+
+def _record_latency(method: str, elapsed_ms: float, ok: bool):
+    entry = _latency.get(method)
+    if entry is None:
+        entry = _latency[method] = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+    entry["count"] += 1
+    entry["total_ms"] += elapsed_ms
+    entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+    if not ok:
+        entry["errors"] += 1
+
+
+async def post_json(url: str, payload: dict, timeout: float = DEFAULT_TIMEOUT) -> httpx.Response:
+    """POST JSON usando el cliente del portal. Registra la latencia por método REST."""
+    client = await get_portal_client(url)
+    method = url.rstrip("/").rsplit("/", 1)[-1]
+    start = time.perf_counter()
+    ok = False
+    try:
+        response = await client.post(url, json=payload, timeout=timeout, extensions={"trace": _trace})
+        ok = response.status_code < 400
+        return response
+    finally:
+        _record_latency(method, (time.perf_counter() - start) * 1000, ok)
+
+
+def get_pool_stats() -> dict:
+    """Métricas del pool: hosts, aciertos, handshakes y latencia por método."""
+    return {
+        "http2": HTTP2_AVAILABLE,
+        "hosts": len(_clients),
+        **_stats,
+        "latency_ms": {
+            method: {
+                "count": e["count"],
+                "errors": e["errors"],
+                "avg": round(e["total_ms"] / e["count"], 1) if e["count"] else 0.0,
+                "max": round(e["max_ms"], 1),
+            }
+            for method, e in _latency.items()
+        },
+    }
+
+
+async def close_pools():
+    """Cierra todos los clientes del pool (al apagar el servidor)."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.warning(f"⚠️ [HTTP Pool] Error cerrando cliente: {e}")
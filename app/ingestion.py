@@ -0,0 +1,506 @@
+"""
+Cola de ingesta durable y acotada para eventos de Bitrix24.
+Los eventos aceptados por el webhook se escriben en un Redis Stream y un pool
+de workers los consume con límite de concurrencia por tenant.
+Si Redis no está disponible (MockRedis) se usa una cola en memoria equivalente.
+Con varias instancias, cada una tiene además su propia cola (`…:inbox:{instancia}`)
+a la que se reenvían los eventos de los chats cuya sesión tiene caliente
+(ver app.affinity).
+"""
+import logging
+import os
+import json
+import time
+import asyncio
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+from app.redis_client import get_redis, get_redis_stream, MockRedis
+from app.telemetry import ERRORS
+from app.affinity import AFFINITY_ENABLED, INSTANCE_ID, ChatAffinity
+
+STREAM_KEY = os.getenv("INGEST_STREAM_KEY", "ingest:bitrix:events")
+DEAD_LETTER_KEY = f"{STREAM_KEY}:dead"
+CONSUMER_GROUP = os.getenv("INGEST_GROUP", "bot-workers")
+# Turnos en paralelo (global y por tenant)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "16"))
+INGEST_MAX_PER_TENANT = int(os.getenv("INGEST_MAX_PER_TENANT", "4"))
+# Lectores del stream y eventos leídos sin confirmar (en curso o esperando turno de su tenant)
+INGEST_READERS = int(os.getenv("INGEST_READERS", "2"))
+INGEST_MAX_INFLIGHT = int(os.getenv("INGEST_MAX_INFLIGHT", "256"))
+INGEST_MAX_DEPTH = int(os.getenv("INGEST_MAX_DEPTH", "1000"))
+INGEST_CLAIM_IDLE_MS = int(os.getenv("INGEST_CLAIM_IDLE_MS", str(5 * 60 * 1000)))  # 5 min
+INGEST_MAX_DELIVERIES = int(os.getenv("INGEST_MAX_DELIVERIES", "3"))
+STREAM_MAXLEN = 10000
+READ_BLOCK_MS = 1000  # Debe ser menor que el socket_timeout (2s) del cliente Redis
+MAINTENANCE_INTERVAL = 5  # segundos
+DIALOG_KEY = "data[PARAMS][DIALOG_ID]"
+
+
+def tenant_of(data: dict) -> str:
+    """Determina el tenant (dominio) de un evento aplanado de Bitrix24."""
+    domain = data.get("auth[domain]")
+    if domain:
+        return domain
+    for key, value in data.items():
+        if key.endswith("[client_endpoint]") and value:
+            return value.replace("https://", "").split("/")[0]
+    return "unknown"
+
+
+class _RedisStreamBackend:
+    """Backend durable: Redis Stream + consumer group (XREADGROUP/XACK/XAUTOCLAIM)."""
+
+    durable = True
+
+    def __init__(self, redis, reader=None):
+        self._r = redis
+        # XREADGROUP BLOCK retiene la conexión: va por su propio pool (ver get_redis_stream)
+        self._reader = reader or redis
+        self.consumer = INSTANCE_ID
+        self.inbox = inbox_of(INSTANCE_ID)
+        # Lecturas de ambos streams en una misma llamada: se entregan de a una
+        self._buffered: deque = deque()
+
+    async def setup(self):
+        for stream in (STREAM_KEY, self.inbox):
+            try:
+                await self._r.xgroup_create(stream, CONSUMER_GROUP, id="0", mkstream=True)
+            except Exception as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def add(self, fields: dict):
+        return await self._r.xadd(STREAM_KEY, fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+    async def read(self):
+        """
+        Retorna (entry_ref, fields) o None si no hay eventos nuevos. `entry_ref` es
+        (stream, entry_id): la cola propia de la instancia se lee antes que la compartida.
+        """
+        if self._buffered:
+            return self._buffered.popleft()
+        res = await self._reader.xreadgroup(
+            CONSUMER_GROUP, self.consumer, {self.inbox: ">", STREAM_KEY: ">"}, count=1, block=READ_BLOCK_MS
+        )
+        for stream, entries in res or []:
+            for entry_id, fields in entries:
+                self._buffered.append(((stream, entry_id), fields))
+        return self._buffered.popleft() if self._buffered else None
+
+    def is_shared(self, entry_ref) -> bool:
+        return entry_ref[0] == STREAM_KEY
+
+    async def ack(self, entry_ref):
+        stream, entry_id = entry_ref
+        pipe = self._r.pipeline()
+        pipe.xack(stream, CONSUMER_GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        await pipe.execute()
+
+    async def forward(self, instance_id: str, fields: dict):
+        """Reenvía un evento a la cola propia de otra instancia."""
+        await self._r.xadd(inbox_of(instance_id), fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+    async def requeue_inbox(self, instance_id: str, drop: bool = False) -> int:
+        """
+        Devuelve a la cola compartida los eventos de la cola de `instance_id`
+        (entregados o no). Con `drop` borra además el stream y su grupo.
+        """
+        inbox = inbox_of(instance_id)
+        moved = 0
+        while True:
+            entries = await self._r.xrange(inbox, "-", "+", count=100)
+            if not entries:
+                break
+            pipe = self._r.pipeline()
+            for entry_id, fields in entries:
+                pipe.xadd(STREAM_KEY, fields, maxlen=STREAM_MAXLEN, approximate=True)
+                pipe.xdel(inbox, entry_id)
+            await pipe.execute()
+            moved += len(entries)
+        if drop:
+            await self._r.delete(inbox)
+        return moved
+
+    async def keepalive(self, entry_refs) -> int:
+        """
+        Re-reclama (XCLAIM JUSTID, sin sumar entregas) los eventos que esta instancia
+        está procesando: les reinicia el idle para que XAUTOCLAIM no los re-entregue
+        mientras el turno sigue en curso, por largo que sea.
+        """
+        by_stream = defaultdict(list)
+        for stream, entry_id in entry_refs:
+            by_stream[stream].append(entry_id)
+        for stream, ids in by_stream.items():
+            await self._r.xclaim(stream, CONSUMER_GROUP, self.consumer, 0, ids, justid=True)
+        return sum(len(ids) for ids in by_stream.values())
+
+    async def inbox_depth(self) -> int:
+        return await self._r.xlen(self.inbox)
+
+    async def reclaim(self) -> list:
+        """
+        Reclama eventos no confirmados de consumidores caídos (idle > INGEST_CLAIM_IDLE_MS).
+        Los que esta instancia tiene en curso no llegan a ese idle (ver `keepalive`).
+        """
+        res = await self._r.xautoclaim(
+            STREAM_KEY, CONSUMER_GROUP, self.consumer,
+            min_idle_time=INGEST_CLAIM_IDLE_MS, start_id="0-0", count=INGEST_WORKERS
+        )
+        claimed = res[1] if res and len(res) > 1 else []
+        out = []
+        for entry_id, fields in claimed:
+            if not fields:
+                # La entrada fue borrada del stream; solo queda limpiar el PEL
+                await self._r.xack(STREAM_KEY, CONSUMER_GROUP, entry_id)
+                continue
+            info = await self._r.xpending_range(
+                STREAM_KEY, CONSUMER_GROUP, min=entry_id, max=entry_id, count=1
+            )
+            deliveries = info[0]["times_delivered"] if info else 1
+            out.append(((STREAM_KEY, entry_id), fields, deliveries))
+        return out
+
+    async def dead_letter(self, entry_ref, fields: dict):
+        await self._r.xadd(DEAD_LETTER_KEY, fields, maxlen=STREAM_MAXLEN, approximate=True)
+        await self.ack(entry_ref)
+
+    async def depth(self) -> tuple[int, int]:
+        """Retorna (pendientes sin confirmar, lag sin entregar)."""
+        groups = await self._r.xinfo_groups(STREAM_KEY)
+        for g in groups:
+            if g.get("name") == CONSUMER_GROUP:
+                lag = g.get("lag")
+                if lag is None:
+                    # Redis < 7: aproximamos con la longitud del stream
+                    lag = max(await self._r.xlen(STREAM_KEY) - g.get("pending", 0), 0)
+                return g.get("pending", 0), lag
+        return 0, 0
+
+
+def inbox_of(instance_id: str) -> str:
+    """Stream con los eventos reenviados a una instancia por afinidad."""
+    return f"{STREAM_KEY}:inbox:{instance_id}"
+
+
+class _MemoryBackend:
+    """Backend en memoria (sin durabilidad entre reinicios) para entornos sin Redis."""
+
+    durable = False
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: dict[str, dict] = {}
+        self._seq = 0
+        self.consumer = "memory"
+
+    async def setup(self):
+        pass
+
+    async def add(self, fields: dict):
+        self._seq += 1
+        entry_id = f"{int(time.time() * 1000)}-{self._seq}"
+        await self._queue.put((entry_id, fields))
+        return entry_id
+
+    async def read(self):
+        try:
+            entry_id, fields = await asyncio.wait_for(self._queue.get(), timeout=READ_BLOCK_MS / 1000)
+        except asyncio.TimeoutError:
+            return None
+        self._pending[entry_id] = fields
+        return entry_id, fields
+
+    async def ack(self, entry_id):
+        self._pending.pop(entry_id, None)
+
+    def is_shared(self, entry_ref) -> bool:
+        return True
+
+    async def reclaim(self) -> list:
+        return []
+
+    async def keepalive(self, entry_refs) -> int:
+        return 0
+
+    async def dead_letter(self, entry_id, fields: dict):
+        await self.ack(entry_id)
+
+    async def depth(self) -> tuple[int, int]:
+        return len(self._pending), self._queue.qsize()
+
+
+class IngestionQueue:
+    """
+    Pipeline de ingesta: webhook -> stream -> pool de workers -> handler.
+    - Backpressure: `enqueue` rechaza eventos si la profundidad supera INGEST_MAX_DEPTH.
+    - Concurrencia: INGEST_READERS lectores reparten cada evento a su propia tarea;
+      como máximo INGEST_WORKERS turnos en paralelo e INGEST_MAX_PER_TENANT por
+      tenant. Un tenant saturado espera en su semáforo sin frenar la lectura de
+      los demás; lo leído sin confirmar se acota con INGEST_MAX_INFLIGHT.
+    - Durabilidad: los eventos se confirman (XACK) solo después de procesarse;
+      los no confirmados de una instancia caída se reclaman y re-entregan.
+    - Afinidad: con Redis, cada evento va a la instancia dueña del chat (la que
+      tiene la sesión en RAM); las colas propias de instancias caídas se adoptan.
+    """
+
+    def __init__(self):
+        self._backend = None
+        self._handler = None
+        self._workers: list[asyncio.Task] = []
+        self._maintenance_task: asyncio.Task | None = None
+        self._running = False
+        self._tenant_slots: dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(INGEST_MAX_PER_TENANT)
+        )
+        self._handler_slots = asyncio.Semaphore(INGEST_WORKERS)
+        self._admission = asyncio.Semaphore(INGEST_MAX_INFLIGHT)
+        self._tasks: set[asyncio.Task] = set()
+        self._inflight: dict[str, int] = defaultdict(int)
+        # Eventos leídos por esta instancia y aún sin confirmar (se mantienen vivos en el PEL)
+        self._active: set = set()
+        self._reclaimed: asyncio.Queue = asyncio.Queue()
+        self._affinity: ChatAffinity | None = None
+        self._inbox_depth = 0
+        # Métricas
+        self._pending = 0
+        self._lag = 0
+        self._counters = defaultdict(int)
+        self._last_lag_ms = 0.0
+        self._max_lag_ms = 0.0
+
+    async def start(self, handler):
+        """
+        Inicia el backend y los lectores. `handler` es una corutina handler(data); el
+        evento se confirma cuando retorna. Los límites de concurrencia los aplica
+        `limited` alrededor del turno.
+        """
+        if self._running:
+            return
+        self._handler = handler
+        r = await get_redis()
+        if isinstance(r, MockRedis):
+            self._backend = _MemoryBackend()
+            logger.warning("⚠️ [Ingestion] Redis no disponible. Usando cola en memoria (no durable).")
+        else:
+            # Una conexión por lector más una de holgura
+            self._backend = _RedisStreamBackend(r, await get_redis_stream(INGEST_READERS + 1))
+            if AFFINITY_ENABLED:
+                self._affinity = ChatAffinity(r, self._backend.consumer)
+        await self._backend.setup()
+        if self._affinity is not None:
+            await self._affinity.start()
+
+        self._running = True
+        self._workers = [asyncio.create_task(self._worker_loop(i)) for i in range(INGEST_READERS)]
+        self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+        logger.info(
+            f"📥 [Ingestion] {INGEST_READERS} lectores, {INGEST_WORKERS} turnos en paralelo "
+            f"(max {INGEST_MAX_PER_TENANT}/tenant, consumer={self._backend.consumer})"
+        )
+
+    async def stop(self):
+        """Detiene los workers. Los eventos no confirmados quedan en el stream para re-entrega."""
+        self._running = False
+        tasks = self._workers + list(self._tasks) + ([self._maintenance_task] if self._maintenance_task else [])
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._maintenance_task = None
+        if self._affinity is not None:
+            # Scale-down: liberar los chats y devolver la cola propia a la compartida
+            try:
+                if await self._affinity.stop():
+                    moved = await self._backend.requeue_inbox(self._backend.consumer)
+                    logger.info(f"🧲 [Ingestion] {moved} eventos de la cola propia devueltos a la compartida")
+            except Exception as e:
+                logger.warning(f"⚠️ [Ingestion] Error entregando chats al apagar: {e}")
+        logger.info("🛑 [Ingestion] Workers detenidos.")
+
+    async def enqueue(self, data: dict) -> bool:
+        """Encola un evento. Retorna False si la cola está saturada (backpressure)."""
+        if self._backend is None:
+            return False
+        if self._pending + self._lag >= INGEST_MAX_DEPTH:
+            self._counters["rejected"] += 1
+            logger.info(f"🚫 [Ingestion] Cola saturada ({self._pending + self._lag} eventos). Evento rechazado.")
+            return False
+
+        fields = {
+            "data": json.dumps(data, ensure_ascii=False),
+            "tenant": tenant_of(data),
+            "chat": data.get(DIALOG_KEY) or "",
+            "ts": str(int(time.time() * 1000)),
+        }
+        await self._backend.add(fields)
+        self._lag += 1
+        self._counters["enqueued"] += 1
+        return True
+
+    async def _worker_loop(self, idx: int):
+        """Lector: toma eventos del stream y los despacha sin esperar a que se procesen."""
+        while self._running:
+            await self._admission.acquire()
+            dispatched = False
+            try:
+                if not self._reclaimed.empty():
+                    entry_id, fields = self._reclaimed.get_nowait()
+                else:
+                    item = await self._backend.read()
+                    if item is None:
+                        continue
+                    entry_id, fields = item
+                    self._lag = max(self._lag - 1, 0)
+                task = asyncio.create_task(self._process(entry_id, fields))
+                self._tasks.add(task)
+                task.add_done_callback(self._task_done)
+                dispatched = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ [Ingestion] Error en lector {idx}: {e}")
+                await asyncio.sleep(1)
+            finally:
+                if not dispatched:
+                    self._admission.release()
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._admission.release()
+
+    async def _route(self, entry_id, fields: dict) -> bool:
+        """True si el evento se reenvió a la instancia dueña del chat (y se confirmó aquí)."""
+        chat = fields.get("chat")
+        if self._affinity is None or not chat:
+            return False
+        try:
+            owner = await self._affinity.route(chat)
+            if owner == self._affinity.instance_id:
+                return False
+            await self._backend.forward(owner, fields)
+        except Exception as e:
+            logger.warning(f"⚠️ [Ingestion] Error de afinidad para {chat}, se procesa aquí: {e}")
+            return False
+        self._counters["forwarded"] += 1
+        await self._backend.ack(entry_id)
+        return True
+
+    async def _process(self, entry_id, fields: dict):
+        self._active.add(entry_id)
+        try:
+            await self._process_entry(entry_id, fields)
+        finally:
+            self._active.discard(entry_id)
+
+    async def _process_entry(self, entry_id, fields: dict):
+        if await self._route(entry_id, fields):
+            return
+        tenant = fields.get("tenant") or "unknown"
+        enqueued_ms = int(fields.get("ts") or 0)
+        if enqueued_ms:
+            self._last_lag_ms = time.time() * 1000 - enqueued_ms
+            self._max_lag_ms = max(self._max_lag_ms, self._last_lag_ms)
+        try:
+            data = json.loads(fields["data"])
+            # Con el coalescer, retorna cuando terminó el turno que incluye este evento
+            await self._handler(data)
+            self._counters["processed"] += 1
+        except Exception as e:
+            # Igual que el fire-and-forget original: el error se registra y el evento
+            # se confirma. La re-entrega es solo para caídas de la instancia.
+            self._counters["failed"] += 1
+            ERRORS.labels("handler").inc()
+            logger.exception(f"❌ [Ingestion] Error procesando evento {entry_id} ({tenant}): {e}")
+
+        try:
+            await self._backend.ack(entry_id)
+        except Exception as e:
+            logger.warning(f"⚠️ [Ingestion] No se pudo confirmar evento {entry_id}: {e}")
+
+    def limited(self, handler):
+        """
+        Envuelve el handler de un turno (handle_message) con los límites de
+        concurrencia: INGEST_WORKERS en total e INGEST_MAX_PER_TENANT por tenant.
+        Se aplica al turno y no al evento: los mensajes que el coalescer fusiona
+        esperan su turno sin ocupar slots del tenant.
+        """
+        async def run(data: dict):
+            tenant = tenant_of(data)
+            async with self._tenant_slots[tenant], self._handler_slots:
+                self._inflight[tenant] += 1
+                try:
+                    return await handler(data)
+                finally:
+                    self._inflight[tenant] -= 1
+                    if not self._inflight[tenant]:
+                        del self._inflight[tenant]
+        return run
+
+    async def _maintenance_loop(self):
+        """Refresca métricas de profundidad y reclama eventos huérfanos."""
+        while self._running:
+            try:
+                self._pending, self._lag = await self._backend.depth()
+                if self._active:
+                    await self._backend.keepalive(list(self._active))
+                if self._affinity is not None:
+                    self._inbox_depth = await self._backend.inbox_depth()
+                    await self._adopt_dead_instances()
+                for entry_id, fields, deliveries in await self._backend.reclaim():
+                    if deliveries > INGEST_MAX_DELIVERIES:
+                        self._counters["dead_lettered"] += 1
+                        logger.info(f"☠️ [Ingestion] Evento {entry_id} excedió {INGEST_MAX_DELIVERIES} entregas. Enviado a {DEAD_LETTER_KEY}.")
+                        await self._backend.dead_letter(entry_id, fields)
+                        continue
+                    self._counters["redelivered"] += 1
+                    logger.info(f"♻️ [Ingestion] Re-entregando evento {entry_id} (entrega #{deliveries})")
+                    await self._reclaimed.put((entry_id, fields))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ [Ingestion] Error en mantenimiento: {e}")
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+
+    async def _adopt_dead_instances(self):
+        """Devuelve a la cola compartida los eventos de instancias caídas (una sola instancia lo hace)."""
+        for instance_id in await self._affinity.dead_instances():
+            if not await self._affinity.claim_adoption(instance_id):
+                continue
+            moved = await self._backend.requeue_inbox(instance_id, drop=True)
+            await self._affinity.forget(instance_id)
+            if moved:
+                self._counters["adopted"] += moved
+                logger.info(f"🧲 [Ingestion] {moved} eventos adoptados de la instancia {instance_id}")
+
+    def stats(self) -> dict:
+        """Métricas de la cola: profundidad, lag y contadores."""
+        return {
+            "backend": "redis_stream" if self._backend and self._backend.durable else "memory",
+            "readers": len(self._workers),
+            "workers": INGEST_WORKERS,
+            "in_process": len(self._tasks),
+            "pending": self._pending,
+            "undelivered": self._lag,
+            "depth": self._pending + self._lag,
+            "max_depth": INGEST_MAX_DEPTH,
+            "inbox": self._inbox_depth,
+            "affinity": self._affinity.stats() if self._affinity else None,
+            "inflight_by_tenant": dict(self._inflight),
+            "last_lag_ms": round(self._last_lag_ms, 1),
+            "max_lag_ms": round(self._max_lag_ms, 1),
+            **self._counters,
+        }
+
+
+_queue: IngestionQueue | None = None
+
+
+async def get_ingestion_queue() -> IngestionQueue:
+    """Retorna la cola de ingesta singleton."""
+    global _queue
+    if _queue is None:
+        _queue = IngestionQueue()
+    return _queue
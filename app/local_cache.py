@@ -0,0 +1,91 @@
+"""
+Caché L1 en memoria del proceso (LRU + TTL) delante de Redis.
+Para lecturas muy repetidas y casi inmutables (token/expiración, dominio,
+mapeo chat→tenant) que hoy cuestan un round trip a Redis en cada tool call.
+Cada caché cuenta aciertos/fallos y admite invalidación explícita.
+"""
+import os
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU acotado por `maxsize` con expiración por entrada."""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if self._data.pop(key, _MISSING) is not _MISSING:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self._data)
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+_caches: dict[str, TTLCache] = {}
+
+
+def get_cache(name: str, maxsize: int = 1024, ttl: float = 60) -> TTLCache:
+    """Retorna (o crea) la caché con nombre `name`. El TTL se puede ajustar con LOCAL_CACHE_{NAME}_TTL."""
+    cache = _caches.get(name)
+    if cache is None:
+        ttl = float(os.getenv(f"LOCAL_CACHE_{name.upper()}_TTL", ttl))
+        cache = _caches[name] = TTLCache(name, maxsize=maxsize, ttl=ttl)
+    return cache
+
+
+def cache_stats() -> dict:
+    """Aciertos/fallos de todas las cachés L1 del proceso."""
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,155 @@
+"""
+Logging estructurado del bot (reemplaza los shims de `print` a stderr).
+- Todo va a stderr (stdout está reservado para el protocolo MCP) a través de
+  una cola acotada: el hilo del event loop solo encola; un QueueListener en
+  otro hilo formatea y escribe. Si la cola se llena se descartan registros
+  (y se cuentan) en lugar de frenar el loop.
+- LOG_FORMAT=json (por defecto) o text.
+- LOG_LEVEL para el nivel general y LOG_LEVELS para niveles por módulo:
+  "app.agent=DEBUG,app.memory=WARNING,httpx=WARNING".
+- Cada registro lleva el contexto del request (tenant, chat_id, session_id).
+- Los volcados de depuración (eventos completos, respuestas del LLM) se
+  muestrean con LOG_DEBUG_SAMPLE (ver `debug_sampled`).
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+from app.context_vars import member_id_var, chat_id_var, session_id_var
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# httpx loguea cada request en INFO: silenciado salvo que se pida
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING,httpcore=WARNING")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "0.01"))
+
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+_listener: logging.handlers.QueueListener | None = None
+_stats = {"dropped": 0}
+
+
+class _ContextFilter(logging.Filter):
+    """Agrega el contexto del request al registro (se evalúa en el hilo/tarea que loguea)."""
+
+    def filter(self, record):
+        record.tenant = member_id_var.get() or None
+        record.chat_id = chat_id_var.get() or None
+        record.session_id = session_id_var.get() or None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in ("tenant", "chat_id", "session_id"):
+            value = getattr(record, key, None)
+            if value:
+                entry[key] = value
+        # Campos pasados con extra={...}
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and key not in entry and key not in ("tenant", "chat_id", "session_id"):
+                entry[key] = value
+        if record.exc_text or record.exc_info:
+            entry["exc"] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(name)s%(ctx)s | %(message)s")
+
+    def format(self, record):
+        ctx = [f"{k}={getattr(record, k)}" for k in ("tenant", "chat_id") if getattr(record, k, None)]
+        record.ctx = f" [{' '.join(ctx)}]" if ctx else ""
+        return super().format(record)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no bloquea: si la cola está llena, descarta y cuenta."""
+
+    def prepare(self, record):
+        # Mismo trabajo mínimo que QueueHandler pero sin formatear en el hilo que loguea:
+        # solo se resuelven el mensaje y la excepción (los args pueden no ser picklables/estables)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats["dropped"] += 1
+
+
+def _parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """Configura el logging del proceso (idempotente)."""
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+
+    handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, stream, respect_handler_level=True)
+    _listener.start()
+    # Vaciar la cola al salir del proceso
+    atexit.register(_listener.stop)
+
+
+def debug_sampled(logger: logging.Logger, rate: float = None) -> bool:
+    """True si corresponde emitir un volcado de depuración (nivel DEBUG activo y muestreo)."""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < (LOG_DEBUG_SAMPLE if rate is None else rate)
+
+
+def bind_request(chat_id=None, session_id=None):
+    """Fija los IDs de correlación del request actual (se heredan en las tareas que cree)."""
+    if chat_id is not None:
+        chat_id_var.set(str(chat_id))
+    if session_id is not None:
+        session_id_var.set(str(session_id))
+
+
+def get_log_stats() -> dict:
+    return {
+        "queued": _listener.queue.qsize() if _listener else 0,
+        "queue_size": LOG_QUEUE_SIZE,
+        "dropped": _stats["dropped"],
+        "format": LOG_FORMAT,
+        "level": LOG_LEVEL,
+    }
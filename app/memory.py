@@ -1,20 +1,80 @@
 """
-Módulo de memoria persistente usando Redis.
-Guarda los últimos N mensajes por chat_id con TTL automático.
+Módulo de memoria persistente usando Redis, con presupuesto de tokens.
+- Cada mensaje guarda el texto crudo del usuario, el contexto estructurado
+  (sesión, chat, usuario...) por separado y su conteo de tokens.
+- Cuando los turnos crudos superan MEMORY_RAW_TOKENS, los más antiguos se
+  pliegan en un resumen incremental (`chat:{id}:summary`).
+- El prompt se arma con el resumen + los turnos más recientes que quepan en
+  MEMORY_PROMPT_TOKENS.
+Las entradas se guardan en binario (app.history_codec); las JSON anteriores se
+leen igual y se re-codifican en segundo plano.
 """
+import logging
+import os
 import json
-from typing import List, Dict
-from app.redis_client import get_redis
-import sys
+import math
+import asyncio
+import uuid
+from typing import List
+from redis.exceptions import WatchError
+from app.redis_client import get_redis_binary
+from app.history_codec import encode_entry, decode_entry, is_legacy, get_history_codec
+from app.telemetry import FALLBACKS
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+logger = logging.getLogger(__name__)
 
-MAX_HISTORY = 10
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken es opcional: se usa una estimación por caracteres
+    _encoding = None
+
+# Límite duro de mensajes crudos (por si el plegado falla repetidamente)
+MAX_HISTORY = int(os.getenv("MEMORY_MAX_MESSAGES", "40"))
 HISTORY_TTL = 60 * 60 * 24 * 7  # 7 días
+# Tokens de turnos crudos antes de plegar los más antiguos en el resumen
+MEMORY_RAW_TOKENS = int(os.getenv("MEMORY_RAW_TOKENS", "1500"))
+# Presupuesto del historial (resumen + turnos recientes) dentro del prompt
+MEMORY_PROMPT_TOKENS = int(os.getenv("MEMORY_PROMPT_TOKENS", "1200"))
+# Presupuesto del historial vivo del LLM (incluye resultados de tools)
+MEMORY_LIVE_TOKENS = int(os.getenv("MEMORY_LIVE_TOKENS", "6000"))
+MEMORY_KEEP_MESSAGES = 4  # turnos recientes que nunca se pliegan
+SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "350"))
+# Modelo barato del mismo proveedor que el agente (app.config.LLM_PROVIDER)
+SUMMARY_MODELS = {"openai": "gpt-4o-mini", "google": "gemini-2.0-flash"}
+SUMMARY_MODEL = os.getenv("MEMORY_SUMMARY_MODEL")
+
+# Instrucciones fijas que antes viajaban en cada mensaje del usuario
+TURN_CONTEXT_NOTES = (
+    "# CONTEXTO DE CADA MENSAJE\n"
+    "Los mensajes del cliente pueden terminar con [FECHA Y HORA ACTUAL: ...] y [CONTEXTO ACTUAL: ...].\n"
+    "⚠️ NOTA: El `BITRIX_CHAT_ID` numérico es el que debes usar para herramientas del CRM.\n"
+    "⚠️ NOTA: IMPORTANTE - Al llamar a `manage_lead`, DEBES incluir el Nombre y el Teléfono/Email recolectados como argumentos explicitamente.\n"
+    "⚠️ NOTA: NO necesitas pasar `access_token` a las herramientas.\n"
+    "Si un mensaje no trae [CONTEXTO ACTUAL], sigue vigente el último recibido."
+)
+
+_SUMMARY_PROMPT = (
+    "Actualiza el resumen de una conversación entre un cliente y un asistente de viajes.\n"
+    "Conserva datos concretos: nombre, teléfono, email, destinos, fechas, número de personas, "
+    "presupuesto, productos cotizados, IDs de lead/deal y compromisos pendientes. "
+    "Omite saludos y repeticiones. Responde solo con el resumen, en viñetas breves, "
+    f"en menos de {SUMMARY_MAX_TOKENS} tokens."
+)
+
+_stats = {"folds": 0, "folded_messages": 0, "summary_fallbacks": 0, "summary_extractive": 0, "live_trims": 0,
+          "live_trimmed_messages": 0, "migrated_chats": 0, "migrated_entries": 0}
+_folding: set[str] = set()
+_migrating: set[str] = set()
+
+
+def count_tokens(text: str) -> int:
+    """Tokens de un texto (tiktoken si está instalado, si no ~4 caracteres por token)."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / 4)
 
 
 def _key(chat_id: str) -> str:
@@ -22,40 +82,332 @@ def _key(chat_id: str) -> str:
     return f"chat:{chat_id}:history"
 
 
+def _summary_key(chat_id: str) -> str:
+    return f"chat:{chat_id}:summary"
+
+
+def _tokens(msg: dict) -> int:
+    tokens = msg.get("tokens")
+    if tokens is None:
+        # Mensajes guardados antes del conteo
+        tokens = msg["tokens"] = count_tokens(msg.get("content", ""))
+    return tokens
+
+
+def format_turn_context(context: dict) -> str:
+    """Contexto estructurado como lo ve el LLM: `[CONTEXTO ACTUAL: K=V, ...]`."""
+    return f"[CONTEXTO ACTUAL: {', '.join(f'{k}={v}' for k, v in context.items())}]"
+
+
 async def get_chat_history(chat_id: str) -> List[dict]:
-    """Retorna la lista de mensajes (role, content) para un chat."""
-    r = await get_redis()
+    """Retorna la lista de mensajes (role, content, context, tokens) para un chat."""
+    r = await get_redis_binary()
     messages = await r.lrange(_key(chat_id), 0, -1)
-    return [json.loads(m) for m in messages]
+    if chat_id not in _migrating and get_history_codec().name != "json" and any(is_legacy(m) for m in messages):
+        _migrating.add(chat_id)
+        asyncio.create_task(_migrate_history(chat_id))
+    return [decode_entry(m) for m in messages]
+
+
+async def _migrate_history(chat_id: str):
+    """Re-codifica las entradas JSON legadas con el codec actual (WATCH: si el chat cambia, se reintenta en otra lectura)."""
+    r = await get_redis_binary()
+    key = _key(chat_id)
+    try:
+        async with r.pipeline(transaction=True) as pipe:
+            await pipe.watch(key)
+            messages = await pipe.lrange(key, 0, -1)
+            ttl = await pipe.ttl(key)
+            legacy = sum(1 for m in messages if is_legacy(m))
+            if not legacy:
+                return
+            entries = [m if not is_legacy(m) else encode_entry(decode_entry(m)) for m in messages]
+            pipe.multi()
+            pipe.delete(key)
+            pipe.rpush(key, *entries)
+            pipe.expire(key, ttl if ttl > 0 else HISTORY_TTL)
+            await pipe.execute()
+        _stats["migrated_chats"] += 1
+        _stats["migrated_entries"] += legacy
+    except WatchError:
+        pass
+    except Exception as e:
+        logger.warning(f"⚠️ [Memory] Error migrando historial de {chat_id}: {e}")
+    finally:
+        _migrating.discard(chat_id)
+
 
+async def get_summary(chat_id: str) -> dict:
+    """Resumen incremental de los turnos ya plegados: {text, tokens, folded}."""
+    r = await get_redis_binary()
+    raw = await r.get(_summary_key(chat_id))
+    return json.loads(raw) if raw else {"text": "", "tokens": 0, "folded": 0}
 
-async def add_message(chat_id: str, role: str, content: str):
-    """Guarda un mensaje y mantiene el límite de historial."""
-    r = await get_redis()
+
+async def add_message(chat_id: str, role: str, content: str, context: dict = None):
+    """
+    Guarda un mensaje (texto crudo + contexto aparte) y, si los turnos crudos
+    superan MEMORY_RAW_TOKENS, pliega los antiguos en el resumen en segundo plano.
+    """
+    r = await get_redis_binary()
     key = _key(chat_id)
-    msg = json.dumps({"role": role, "content": content}, ensure_ascii=False)
+    entry = {"role": role, "content": content, "tokens": count_tokens(content)}
+    if context:
+        entry["context"] = context
+    msg = encode_entry(entry)
 
     pipe = r.pipeline()
     pipe.rpush(key, msg)
     pipe.ltrim(key, -MAX_HISTORY, -1)
     pipe.expire(key, HISTORY_TTL)
-    await pipe.execute()
+    pipe.lrange(key, 0, -1)
+    *_, raw_messages = await pipe.execute()
 
+    total = sum(_tokens(decode_entry(m)) for m in raw_messages)
+    if total > MEMORY_RAW_TOKENS and len(raw_messages) > MEMORY_KEEP_MESSAGES and chat_id not in _folding:
+        _folding.add(chat_id)
+        asyncio.create_task(_fold_history(chat_id))
 
-async def format_history_str(chat_id: str) -> str:
-    """Retorna el historial como texto formateado para el prompt."""
-    history = await get_chat_history(chat_id)
-    if not history:
+
+def _select_fold(history: list) -> int:
+    """Cuántos mensajes antiguos plegar para dejar los crudos en ~la mitad del presupuesto."""
+    target = MEMORY_RAW_TOKENS // 2
+    total = sum(_tokens(m) for m in history)
+    count = 0
+    while total > target and len(history) - count > MEMORY_KEEP_MESSAGES:
+        total -= _tokens(history[count])
+        count += 1
+    # No separar un mensaje del cliente de la respuesta del bot
+    if 0 < count < len(history) - MEMORY_KEEP_MESSAGES and history[count - 1]["role"] == "user":
+        count += 1
+    return count
+
+
+async def _fold_history(chat_id: str):
+    """Pliega los turnos más antiguos en el resumen y los quita de la lista cruda."""
+    r = await get_redis_binary()
+    lock_key = f"lock:memory_fold:{chat_id}"
+    lock_token = uuid.uuid4().hex
+    try:
+        # Un solo plegado por chat entre instancias (el LTRIM depende del conteo)
+        if not await r.set(lock_key, lock_token, nx=True, px=60000):
+            return
+        history = await get_chat_history(chat_id)
+        count = _select_fold(history)
+        if count <= 0:
+            return
+        summary = await get_summary(chat_id)
+        text = await _summarize(summary["text"], history[:count])
+        new_summary = {"text": text, "tokens": count_tokens(text), "folded": summary["folded"] + count}
+
+        pipe = r.pipeline()
+        pipe.set(_summary_key(chat_id), json.dumps(new_summary, ensure_ascii=False), ex=HISTORY_TTL)
+        # Solo se agregan mensajes al final, así que los `count` primeros siguen siendo los plegados
+        pipe.ltrim(_key(chat_id), count, -1)
+        await pipe.execute()
+        _stats["folds"] += 1
+        _stats["folded_messages"] += count
+        logger.info(f"🗜️ [Memory] {count} mensajes plegados en el resumen de {chat_id} ({new_summary['tokens']} tokens)")
+    except Exception as e:
+        logger.warning(f"⚠️ [Memory] Error plegando historial de {chat_id}: {e}")
+    finally:
+        _folding.discard(chat_id)
+        try:
+            if await r.get(lock_key) == lock_token.encode():
+                await r.delete(lock_key)
+        except Exception:
+            pass
+
+
+def _transcript(messages: list) -> str:
+    lines = []
+    for msg in messages:
+        role_label = "Cliente" if msg["role"] == "user" else "Bot Viajes"
+        lines.append(f"{role_label}: {msg['content']}")
+    return "\n".join(lines)
+
+
+# (proveedor, modelo, cliente) del resumidor; False si no hay API key para el proveedor
+_summarizer = None
+
+
+def init_summarizer():
+    """
+    Resuelve el resumidor con el proveedor configurado para el agente y su API key.
+    Sin key, el resumen con LLM queda desactivado (se avisa una sola vez) y los
+    plegados usan directamente el resumen extractivo.
+    """
+    global _summarizer
+    if _summarizer is not None:
+        return _summarizer
+    from app.config import config as ai_config
+    from app.secrets_loader import get_secret
+    provider = ai_config.LLM_PROVIDER
+    # Mismo criterio que agent_factory._configure_provider: key global del proveedor y luego secrets
+    api_key = ai_config.API_KEY or get_secret(provider)
+    model = SUMMARY_MODEL or SUMMARY_MODELS.get(provider)
+    if not api_key or not model:
+        _summarizer = False
+        logger.warning(f"⚠️ [Memory] Sin API key de {provider}: resumen con LLM desactivado, se usa el extractivo")
+        return _summarizer
+    if provider == "openai":
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(api_key=api_key)
+    else:
+        from google import genai
+        client = genai.Client(api_key=api_key)
+    _summarizer = (provider, model, client)
+    logger.info(f"🧠 [Memory] Resumen de conversaciones con {provider}/{model}")
+    return _summarizer
+
+
+async def _llm_summary(previous: str, messages: list) -> str:
+    provider, model, client = _summarizer
+    request = f"RESUMEN ACTUAL:\n{previous or '(vacío)'}\n\nNUEVOS TURNOS:\n{_transcript(messages)}"
+    if provider == "openai":
+        response = await client.chat.completions.create(
+            model=model,
+            temperature=0,
+            max_tokens=SUMMARY_MAX_TOKENS,
+            messages=[
+                {"role": "system", "content": _SUMMARY_PROMPT},
+                {"role": "user", "content": request},
+            ],
+        )
+        return (response.choices[0].message.content or "").strip()
+    from google.genai import types
+    response = await client.aio.models.generate_content(
+        model=model,
+        contents=request,
+        config=types.GenerateContentConfig(
+            system_instruction=_SUMMARY_PROMPT, temperature=0, max_output_tokens=SUMMARY_MAX_TOKENS
+        ),
+    )
+    return (response.text or "").strip()
+
+
+async def _summarize(previous: str, messages: list) -> str:
+    """Resumen nuevo = resumen anterior + turnos plegados (LLM barato, con respaldo extractivo)."""
+    if init_summarizer():
+        try:
+            text = await _llm_summary(previous, messages)
+            if text:
+                return text
+        except Exception as e:
+            logger.warning(f"⚠️ [Memory] Resumen con LLM falló ({e}), usando resumen extractivo")
+        _stats["summary_fallbacks"] += 1
+        FALLBACKS.labels("memory_summary").inc()
+    else:
+        _stats["summary_extractive"] += 1
+    return _extractive_summary(previous, messages)
+
+
+def _extractive_summary(previous: str, messages: list) -> str:
+    """Respaldo sin LLM: una línea recortada por turno, conservando las más recientes."""
+    lines = previous.splitlines() if previous else []
+    for msg in messages:
+        role_label = "Cliente" if msg["role"] == "user" else "Bot"
+        content = " ".join(msg["content"].split())
+        lines.append(f"- {role_label}: {content[:160]}")
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > SUMMARY_MAX_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+async def format_history_str(chat_id: str, budget: int = MEMORY_PROMPT_TOKENS) -> str:
+    """
+    Retorna el historial como texto para el prompt: el resumen de lo plegado y
+    los turnos más recientes (solo texto crudo) que quepan en `budget` tokens.
+    """
+    history, summary = await asyncio.gather(get_chat_history(chat_id), get_summary(chat_id))
+    if not history and not summary["text"]:
         return ""
 
-    output = "\n--- HISTORIAL DE CONVERSACIÓN RECIENTE ---\n"
-    for msg in history:
-        role_label = "Cliente" if msg['role'] == 'user' else "Bot Viajes"
-        output += f"{role_label}: {msg['content']}\n"
+    remaining = budget - summary["tokens"]
+    recent = []
+    for msg in reversed(history):
+        tokens = _tokens(msg)
+        if tokens > remaining and recent:
+            break
+        recent.append(msg)
+        remaining -= tokens
+
+    output = ""
+    if summary["text"]:
+        output += f"\n--- RESUMEN DE LA CONVERSACIÓN ---\n{summary['text']}\n"
+    if recent:
+        output += f"\n--- HISTORIAL DE CONVERSACIÓN RECIENTE ---\n{_transcript(reversed(recent))}\n"
     output += "--- FIN HISTORIAL ---\n"
     return output
 
 
+def _message_tokens(msg) -> int:
+    """Tokens de un mensaje del historial del LLM (dict u objeto; incluye tool_calls)."""
+    if not isinstance(msg, dict):
+        msg = msg.model_dump() if hasattr(msg, "model_dump") else {"content": str(msg)}
+    content = msg.get("content")
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False, default=str) if content else ""
+    tokens = count_tokens(content) + 4
+    for call in msg.get("tool_calls") or []:
+        function = call.get("function") or {}
+        tokens += count_tokens(function.get("name", "")) + count_tokens(function.get("arguments", ""))
+    return tokens
+
+
+def _role(msg) -> str:
+    return msg.get("role") if isinstance(msg, dict) else getattr(msg, "role", None)
+
+
+def trim_live_history(llm, budget: int = MEMORY_LIVE_TOKENS) -> int:
+    """
+    Recorta el historial en memoria del LLM (mensajes + resultados de tools) a
+    `budget` tokens, quitando turnos completos desde el más antiguo. Los mensajes
+    system iniciales se conservan. Los turnos quitados siguen en Redis y terminan en el resumen.
+    Retorna cuántos mensajes se quitaron.
+    """
+    history = getattr(llm, "history", None)
+    if history is None:
+        return 0
+    messages = history.get()
+    # System prompt y mensaje de memoria (app.prompt_cache) se conservan
+    start = 0
+    while start < len(messages) and _role(messages[start]) == "system":
+        start += 1
+    sizes = [_message_tokens(m) for m in messages[start:]]
+    total = sum(sizes)
+    if total <= budget:
+        return 0
+
+    cut = 0
+    while total > budget and cut < len(sizes):
+        total -= sizes[cut]
+        cut += 1
+        # Cortar solo en el inicio de un turno del usuario (no dejar tool results huérfanos)
+        while cut < len(sizes) and _role(messages[start + cut]) != "user":
+            total -= sizes[cut]
+            cut += 1
+    # El último turno del usuario se conserva aunque por sí solo exceda el presupuesto
+    last_turn = max((i for i in range(len(sizes)) if _role(messages[start + i]) == "user"), default=0)
+    cut = min(cut, last_turn)
+    if cut <= 0:
+        return 0
+    history.set(messages[:start] + messages[start + cut:])
+    _stats["live_trims"] += 1
+    _stats["live_trimmed_messages"] += cut
+    return cut
+
+
+def get_memory_stats() -> dict:
+    return {
+        **_stats,
+        "tokenizer": "tiktoken" if _encoding is not None else "chars/4",
+        "raw_tokens_budget": MEMORY_RAW_TOKENS,
+        "prompt_tokens_budget": MEMORY_PROMPT_TOKENS,
+        "live_tokens_budget": MEMORY_LIVE_TOKENS,
+    }
+
+
 async def get_seed_messages(chat_id: str, max_messages: int = 6) -> list:
     """
     Retorna los últimos N mensajes para sembrar una nueva sesión
@@ -68,12 +420,12 @@ async def get_seed_messages(chat_id: str, max_messages: int = 6) -> list:
 
 
 async def clear_chat_history(chat_id: str):
-    """Elimina todo el historial y metadatos de un chat en Redis."""
-    r = await get_redis()
+    """Elimina todo el historial, el resumen y metadatos de un chat en Redis."""
+    r = await get_redis_binary()
     key = _key(chat_id)
-    await r.delete(key)
+    await r.delete(key, _summary_key(chat_id))
     # También lock si existiera (aunque suelen ser temporales)
-    # IMPORTANTE: No borrar el lock aquí si se está llamando create_new_session 
+    # IMPORTANTE: No borrar el lock aquí si se está llamando create_new_session
     # desde dentro de un 'async with chat_lock', porque causará LockNotOwnedError al salir.
     # await r.delete(f"lock:chat:{chat_id}")
-    print(f"🧹 [Redis] Historial eliminado para chat: {chat_id}")
+    logger.info(f"🧹 [Redis] Historial eliminado para chat: {chat_id}")
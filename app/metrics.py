@@ -1,95 +1,232 @@
+"""
+Métricas de uso (tokens, tools, salud del sistema) hacia Firestore.
+Los eventos no se escriben uno a uno: se acumulan en un buffer circular en
+memoria (METRICS_BUFFER_SIZE; si se llena se descartan los más viejos y se
+cuentan) y cada METRICS_FLUSH_SECONDS se agregan en contadores por
+tenant/modelo y tenant/tool (con histograma de duración) que se escriben en
+lotes con el cliente async. Al apagar se vacía el buffer.
+"""
+import logging
 import asyncio
 import time
 import psutil
 import os
+from collections import deque, defaultdict
 from datetime import datetime
 from firebase_admin import firestore
-import sys
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+logger = logging.getLogger(__name__)
 
 from app.firestore_config import get_firestore_config
 
+METRICS_BUFFER_SIZE = int(os.getenv("METRICS_BUFFER_SIZE", "10000"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "60"))
+# Documentos que se reintentan en el siguiente flush si falla la escritura
+METRICS_MAX_PENDING_DOCS = int(os.getenv("METRICS_MAX_PENDING_DOCS", "2000"))
+FIRESTORE_BATCH_LIMIT = 500
+# Límites superiores (ms) del histograma de duración de tools
+TOOL_DURATION_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def _bucket_label(duration_ms: float) -> str:
+    for bound in TOOL_DURATION_BUCKETS_MS:
+        if duration_ms <= bound:
+            return f"le{bound}"
+    return "inf"
+
+
 class MetricsService:
     _instance = None
     _db = None
 
-    def __init__(self):
+    def __init__(self, async_db=None):
         # El cliente de Firestore ya debería estar inicializado en firestore_config
         # Pero aseguramos obtener la instancia del servicio de config para reutilizar la conexión si es posible,
         # o inicializar uno nuevo si no hay.
         self._db = firestore.client()
+        self._async_db = async_db
+        self._buffer: deque = deque(maxlen=METRICS_BUFFER_SIZE)
+        self._pending: list = []
+        self._window_start = datetime.now()
+        self._flush_task: asyncio.Task | None = None
+        self._system_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._stats = defaultdict(float)
 
     @classmethod
     async def get_instance(cls):
         if cls._instance is None:
             # Asegurar que firestore esté inicializado
-            await get_firestore_config()
-            cls._instance = cls()
+            fs = await get_firestore_config()
+            cls._instance = cls(getattr(fs, "_async_db", None))
         return cls._instance
 
-    async def log_token_usage(self, tenant_id: str, prompt_tokens: int, completion_tokens: int, model: str, cost: float = 0.0):
-        """Registra el consumo de tokens en Firestore de forma asíncrona."""
+    # ─── Registro (no bloquea: solo agrega al buffer) ─────────────
+
+    def _record(self, event: tuple):
+        if len(self._buffer) == self._buffer.maxlen:
+            # deque con maxlen descarta el más viejo al agregar
+            self._stats["dropped_events"] += 1
+        self._buffer.append(event)
+        self._stats["recorded_events"] += 1
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+            except RuntimeError:
+                pass  # Sin loop: se escribirá en el próximo flush explícito
+
+    def record_tokens(self, tenant_id: str, prompt_tokens: int, completion_tokens: int, model: str, cost: float = 0.0):
         if not tenant_id:
             return
+        self._record(("tokens", tenant_id, model or "unknown", prompt_tokens or 0, completion_tokens or 0, cost or 0.0))
 
-        asyncio.create_task(self._log_token_usage_async(tenant_id, prompt_tokens, completion_tokens, model, cost))
-
-    async def _log_token_usage_async(self, tenant_id: str, prompt_tokens: int, completion_tokens: int, model: str, cost: float):
-        try:
-            timestamp = datetime.now()
-            doc_data = {
-                "tenantId": tenant_id,
-                "metricType": "tokens",
-                "promptTokens": prompt_tokens,
-                "completionTokens": completion_tokens,
-                "totalTokens": prompt_tokens + completion_tokens,
-                "model": model,
-                "cost": cost,
-                "timestamp": timestamp
-            }
-            # Guardar en colección particionada por fecha o general 'metrics'
-            # Para simplificar, usamos una colección 'metrics'
-            self._db.collection('metrics').add(doc_data)
-        except Exception as e:
-            print(f"❌ Error logging token usage: {e}")
+    def record_tool(self, tenant_id: str, tool_name: str, success: bool, duration_ms: float):
+        self._record(("tool_usage", tenant_id or "unknown", tool_name, bool(success), duration_ms))
+
+    async def log_token_usage(self, tenant_id: str, prompt_tokens: int, completion_tokens: int, model: str, cost: float = 0.0):
+        """Registra el consumo de tokens (se agrega y escribe en el próximo flush)."""
+        self.record_tokens(tenant_id, prompt_tokens, completion_tokens, model, cost)
 
     async def log_tool_usage(self, tenant_id: str, tool_name: str, success: bool, duration_ms: float):
         """Registra la ejecución de una herramienta."""
-        if not tenant_id:
-            tenant_id = "unknown"
-
-        asyncio.create_task(self._log_tool_usage_async(tenant_id, tool_name, success, duration_ms))
-
-    async def _log_tool_usage_async(self, tenant_id: str, tool_name: str, success: bool, duration_ms: float):
-        try:
-            timestamp = datetime.now()
-            doc_data = {
-                "tenantId": tenant_id,
-                "metricType": "tool_usage",
-                "toolName": tool_name,
-                "success": success,
-                "durationMs": duration_ms,
-                "timestamp": timestamp
-            }
-            self._db.collection('metrics').add(doc_data)
-        except Exception as e:
-            print(f"❌ Error logging tool usage: {e}")
+        self.record_tool(tenant_id, tool_name, success, duration_ms)
+
+    # ─── Agregación y escritura ───────────────────────────────────
+
+    def _aggregate(self, events: list, window_start: datetime, window_end: datetime) -> list[dict]:
+        tokens: dict[tuple, dict] = {}
+        tools: dict[tuple, dict] = {}
+        docs = []
+        for event in events:
+            kind = event[0]
+            if kind == "tokens":
+                _, tenant_id, model, prompt, completion, cost = event
+                doc = tokens.get((tenant_id, model))
+                if doc is None:
+                    doc = tokens[(tenant_id, model)] = {
+                        "tenantId": tenant_id, "metricType": "tokens", "model": model, "requests": 0,
+                        "promptTokens": 0, "completionTokens": 0, "totalTokens": 0, "cost": 0.0,
+                    }
+                doc["requests"] += 1
+                doc["promptTokens"] += prompt
+                doc["completionTokens"] += completion
+                doc["totalTokens"] += prompt + completion
+                doc["cost"] += cost
+            elif kind == "tool_usage":
+                _, tenant_id, tool_name, success, duration_ms = event
+                doc = tools.get((tenant_id, tool_name))
+                if doc is None:
+                    doc = tools[(tenant_id, tool_name)] = {
+                        "tenantId": tenant_id, "metricType": "tool_usage", "toolName": tool_name,
+                        "calls": 0, "errors": 0, "durationMsSum": 0.0, "durationMsMax": 0.0,
+                        "durationHistogram": defaultdict(int),
+                    }
+                doc["calls"] += 1
+                doc["errors"] += 0 if success else 1
+                doc["durationMsSum"] += duration_ms
+                doc["durationMsMax"] = max(doc["durationMsMax"], duration_ms)
+                doc["durationHistogram"][_bucket_label(duration_ms)] += 1
+            else:
+                docs.append(event[1])  # system_health: documento ya armado
+
+        for doc in tools.values():
+            doc["durationHistogram"] = dict(doc["durationHistogram"])
+            doc["durationMsAvg"] = round(doc["durationMsSum"] / doc["calls"], 1)
+        window = {"windowStart": window_start, "windowEnd": window_end, "timestamp": window_end}
+        return [{**doc, **window} for doc in [*tokens.values(), *tools.values()]] + docs
+
+    async def _write(self, docs: list) -> int:
+        """
+        Escribe los documentos en lotes de hasta 500 (máximo de Firestore por batch).
+        Se detiene en el primer lote que falla y retorna cuántos docs quedaron escritos.
+        """
+        db = self._async_db or self._db
+        written = 0
+        for i in range(0, len(docs), FIRESTORE_BATCH_LIMIT):
+            chunk = docs[i:i + FIRESTORE_BATCH_LIMIT]
+            try:
+                batch = db.batch()
+                collection = db.collection('metrics')
+                for doc in chunk:
+                    batch.set(collection.document(), doc)
+                if self._async_db is not None:
+                    await batch.commit()
+                else:
+                    # Cliente síncrono: fuera del event loop
+                    await asyncio.to_thread(batch.commit)
+            except Exception as e:
+                self._stats["flush_errors"] += 1
+                logger.error(f"❌ Error escribiendo métricas ({len(docs) - written} docs sin escribir): {e}")
+                break
+            written += len(chunk)
+            self._stats["batches"] += 1
+        return written
+
+    async def flush(self):
+        """Agrega lo acumulado desde el último flush y lo escribe."""
+        async with self._flush_lock:
+            events = list(self._buffer)
+            self._buffer.clear()
+            window_start, window_end = self._window_start, datetime.now()
+            self._window_start = window_end
+            docs = self._pending + self._aggregate(events, window_start, window_end)
+            self._pending = []
+            if not docs:
+                return
+            started = time.perf_counter()
+            try:
+                written = await self._write(docs)
+            finally:
+                self._stats["last_flush_ms"] = (time.perf_counter() - started) * 1000
+            self._stats["written_docs"] += written
+            if written == len(docs):
+                self._stats["flushed_events"] += len(events)
+                return
+            # Reintentar en el próximo flush solo los lotes no confirmados (los escritos
+            # no se repiten: duplicarían tokens y tool calls), sin crecer sin límite
+            unwritten = docs[written:]
+            self._pending = unwritten[-METRICS_MAX_PENDING_DOCS:]
+            self._stats["dropped_docs"] += len(unwritten) - len(self._pending)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Error en flush de métricas: {e}")
+
+    async def close(self):
+        """Detiene los loops y escribe lo que quede en el buffer."""
+        for task in (self._flush_task, self._system_task):
+            if task is not None and not task.done():
+                task.cancel()
+        await self.flush()
+        logger.info(f"📊 [Metrics] Buffer vaciado ({int(self._stats['written_docs'])} docs escritos)")
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "buffer_size": self._buffer.maxlen,
+            "pending_docs": len(self._pending),
+            **{k: round(v, 1) for k, v in self._stats.items()},
+        }
+
+    # ─── Salud del sistema ────────────────────────────────────────
 
     async def start_system_metrics_logger(self, interval_seconds: int = 60):
         """Inicia un loop en background para loguear CPU/RAM."""
-        asyncio.create_task(self._system_metrics_loop(interval_seconds))
+        self._system_task = asyncio.create_task(self._system_metrics_loop(interval_seconds))
 
     async def _system_metrics_loop(self, interval: int):
+        psutil.cpu_percent(interval=None)  # primera lectura: fija la referencia
         while True:
+            await asyncio.sleep(interval)
             try:
-                cpu_percent = psutil.cpu_percent(interval=1)
+                # interval=None: uso desde la lectura anterior, sin bloquear el loop
+                cpu_percent = psutil.cpu_percent(interval=None)
                 memory = psutil.virtual_memory()
-                
+
                 doc_data = {
                     "tenantId": "system",
                     "metricType": "system_health",
@@ -98,8 +235,17 @@ class MetricsService:
                     "memoryUsedMb": memory.used / (1024 * 1024),
                     "timestamp": datetime.now()
                 }
-                self._db.collection('metrics').add(doc_data)
+                self._record(("system_health", doc_data))
             except Exception as e:
-                print(f"❌ Error logging system metrics: {e}")
-            
-            await asyncio.sleep(interval)
+                logger.error(f"❌ Error logging system metrics: {e}")
+
+
+def record_token_usage(prompt_tokens: int, completion_tokens: int, model: str, tenant_id: str = None):
+    """Registra tokens si el servicio de métricas ya está inicializado (no-op si no)."""
+    service = MetricsService._instance
+    if service is None:
+        return
+    if tenant_id is None:
+        from app.context_vars import member_id_var
+        tenant_id = member_id_var.get() or "unknown"
+    service.record_tokens(tenant_id, prompt_tokens, completion_tokens, model)
@@ -127,6 +127,9 @@ class DriveFileUploadRequest(BaseModel):
 
 class CatalogProductSearchRequest(BaseModel):
     name: str = Field(..., description="Nombre o palabra clave del producto")
+    section_id: Optional[int] = Field(None, description="ID de la sección/categoría para acotar la búsqueda")
+    min_price: Optional[float] = Field(None, description="Precio mínimo")
+    max_price: Optional[float] = Field(None, description="Precio máximo")
 
 class CatalogProductListRequest(BaseModel):
     section_id: int = Field(..., description="ID de la sección/categoría")
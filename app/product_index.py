@@ -0,0 +1,347 @@
+"""
+Índice local del catálogo de productos por tenant para `catalog_product_search`.
+Antes cada búsqueda era un `crm.product.list` con filtro `%NAME` (LIKE en Bitrix):
+una llamada a la API por consulta, sensible a tildes y sin tolerancia a errores
+de tipeo. Ahora:
+- Se sincroniza en memoria desde `crm.product.list`: completo la primera vez (y
+  cada PRODUCT_INDEX_FULL_SYNC para recoger borrados) e incremental por
+  DATE_MODIFY en el resto.
+- La búsqueda normaliza (minúsculas, sin tildes), tokeniza y compara por
+  trigramas, con ranking (frase > palabra exacta > prefijo > parecido) y filtros
+  de sección y precio.
+- Si el índice está vencido se sirve igual y se resincroniza en segundo plano;
+  si nunca se sincronizó o pasó PRODUCT_INDEX_MAX_STALE se consulta la API en vivo.
+"""
+import logging
+import os
+import re
+import time
+import heapq
+import asyncio
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+
+logger = logging.getLogger(__name__)
+
+from app.telemetry import ERRORS, FALLBACKS
+
+PRODUCT_INDEX_TTL = int(os.getenv("PRODUCT_INDEX_TTL", "300"))
+PRODUCT_INDEX_MAX_STALE = int(os.getenv("PRODUCT_INDEX_MAX_STALE", "3600"))
+PRODUCT_INDEX_FULL_SYNC = int(os.getenv("PRODUCT_INDEX_FULL_SYNC", "21600"))
+PRODUCT_INDEX_WARMUP = os.getenv("PRODUCT_INDEX_WARMUP", "false").lower() in ("1", "true", "yes")
+# Similitud mínima (0-1) para considerar un producto como resultado
+PRODUCT_MIN_SCORE = float(os.getenv("PRODUCT_MIN_SCORE", "0.35"))
+
+PRODUCT_RESULT_CACHE = int(os.getenv("PRODUCT_RESULT_CACHE", "256"))
+
+PRODUCT_FIELDS = ["ID", "NAME", "PRICE", "CURRENCY_ID", "SECTION_ID", "ACTIVE", "DATE_MODIFY"]
+
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+_stats = defaultdict(float)
+
+
+def normalize(text: str) -> str:
+    """Minúsculas, sin tildes ni signos: 'Túnel  Ñandú-3' -> 'tunel nandu 3'."""
+    decomposed = unicodedata.normalize("NFKD", str(text or "").lower())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return _NON_ALNUM.sub(" ", stripped).strip()
+
+
+def tokenize(text: str) -> list[str]:
+    return normalize(text).split()
+
+
+def trigrams(token: str) -> set[str]:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _price(product: dict) -> float | None:
+    try:
+        return float(product.get("PRICE"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ProductIndex:
+    """
+    Catálogo de un tenant: productos por ID, tokens -> productos y trigramas ->
+    tokens. La similitud se calcula sobre el vocabulario (mucho menor que el
+    catálogo) y luego se reparte a los productos que contienen cada token.
+    """
+
+    def __init__(self, tenant_id: str):
+        self.tenant_id = tenant_id
+        self.products: dict[str, dict] = {}
+        self._tokens: dict[str, list[str]] = {}
+        self._by_token: dict[str, set[str]] = defaultdict(set)
+        self._by_trigram: dict[str, set[str]] = defaultdict(set)
+        self._grams: dict[str, frozenset] = {}
+        # Resultados recientes; se vacía con cada cambio del catálogo
+        self._results: OrderedDict = OrderedDict()
+        self.watermark: str | None = None      # DATE_MODIFY más reciente visto
+        self.synced_at = 0.0                   # última sincronización correcta (monotonic)
+        self.full_synced_at = 0.0
+        self._sync_task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self.products)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.synced_at if self.synced_at else float("inf")
+
+    # ─── Mantenimiento ────────────────────────────────────────────
+
+    def upsert(self, product: dict):
+        product_id = str(product.get("ID"))
+        self.remove(product_id)
+        self._results.clear()
+        if product.get("ACTIVE") == "N":
+            return
+        tokens = tokenize(product.get("NAME"))
+        self.products[product_id] = product
+        self._tokens[product_id] = tokens
+        for token in tokens:
+            if token not in self._grams:
+                grams = self._grams[token] = frozenset(trigrams(token))
+                for gram in grams:
+                    self._by_trigram[gram].add(token)
+            self._by_token[token].add(product_id)
+        modified = product.get("DATE_MODIFY")
+        if modified and (self.watermark is None or modified > self.watermark):
+            self.watermark = modified
+
+    def remove(self, product_id: str):
+        tokens = self._tokens.pop(product_id, None)
+        if tokens is None:
+            return
+        self.products.pop(product_id, None)
+        for token in tokens:
+            ids = self._by_token.get(token)
+            if ids is None:
+                continue
+            ids.discard(product_id)
+            if not ids:
+                # Ningún producto usa ya el token: sacarlo del vocabulario
+                del self._by_token[token]
+                for gram in self._grams.pop(token, ()):
+                    self._by_trigram[gram].discard(token)
+                    if not self._by_trigram[gram]:
+                        del self._by_trigram[gram]
+
+    def replace_all(self, products: list):
+        self.products.clear()
+        self._tokens.clear()
+        self._by_token.clear()
+        self._by_trigram.clear()
+        self._grams.clear()
+        self._results.clear()
+        self.watermark = None
+        for product in products:
+            self.upsert(product)
+
+    # ─── Búsqueda ─────────────────────────────────────────────────
+
+    def _similar_tokens(self, query_token: str) -> dict[str, float]:
+        """Tokens del vocabulario parecidos a `query_token` y su similitud (1 exacto, 0.9 prefijo, Dice de trigramas)."""
+        query_grams = trigrams(query_token)
+        shared = Counter()
+        for gram in query_grams:
+            for token in self._by_trigram.get(gram, ()):
+                shared[token] += 1
+        similar = {}
+        for token, common in shared.items():
+            if token == query_token:
+                score = 1.0
+            elif token.startswith(query_token):
+                score = 0.9
+            else:
+                score = 2 * common / (len(query_grams) + len(self._grams[token]))
+            if score >= PRODUCT_MIN_SCORE:
+                similar[token] = score
+        return similar
+
+    def search(self, query: str, section_id=None, min_price: float = None, max_price: float = None,
+               limit: int = 20) -> list[dict]:
+        """Productos que coinciden con `query`, del más al menos relevante."""
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+        key = (" ".join(query_tokens), section_id, min_price, max_price, limit)
+        cached = self._results.get(key)
+        if cached is not None:
+            self._results.move_to_end(key)
+            return cached
+        results = self._rank(query_tokens, section_id, min_price, max_price, limit)
+        self._results[key] = results
+        if len(self._results) > PRODUCT_RESULT_CACHE:
+            self._results.popitem(last=False)
+        return results
+
+    def _rank(self, query_tokens: list, section_id, min_price, max_price, limit: int) -> list[dict]:
+        # Puntaje por producto: promedio sobre los tokens de la consulta de su mejor coincidencia
+        scores = defaultdict(float)
+        for query_token in query_tokens:
+            best: dict[str, float] = {}
+            for token, score in self._similar_tokens(query_token).items():
+                for product_id in self._by_token[token]:
+                    if score > best.get(product_id, 0.0):
+                        best[product_id] = score
+            for product_id, score in best.items():
+                scores[product_id] += score
+
+        phrase = " ".join(query_tokens)
+        results = []
+        for product_id, total in scores.items():
+            score = total / len(query_tokens)
+            if score < PRODUCT_MIN_SCORE:
+                continue
+            product = self.products[product_id]
+            if section_id is not None and str(product.get("SECTION_ID")) != str(section_id):
+                continue
+            if min_price is not None or max_price is not None:
+                price = _price(product)
+                if price is None or (min_price is not None and price < min_price) \
+                        or (max_price is not None and price > max_price):
+                    continue
+            if len(query_tokens) > 1:
+                name = " ".join(self._tokens[product_id])
+                if phrase in name:
+                    score += 0.5 if name.startswith(phrase) else 0.3
+            results.append((score, product.get("NAME") or "", product))
+
+        return [product for _, _, product in heapq.nsmallest(limit, results, key=lambda r: (-r[0], r[1]))]
+
+
+class ProductCatalog:
+    """Índices de productos de todos los tenants, con su sincronización y fallback."""
+
+    def __init__(self):
+        self._indexes: dict[str, ProductIndex] = {}
+
+    def index(self, tenant_id: str) -> ProductIndex:
+        index = self._indexes.get(tenant_id)
+        if index is None:
+            index = self._indexes[tenant_id] = ProductIndex(tenant_id)
+        return index
+
+    # ─── Sincronización ───────────────────────────────────────────
+
+    async def _fetch_all(self, tenant_id: str, filter_: dict) -> list:
+        from app.auth import call_bitrix_method
+        products, start = [], 0
+        while start is not None:
+            result = await call_bitrix_method("crm.product.list", {
+                "order": {"ID": "ASC"},
+                "filter": filter_,
+                "select": PRODUCT_FIELDS,
+                "start": start,
+            }, member_id=tenant_id, priority="low")
+            if result.get("error"):
+                raise RuntimeError(result.get("error_description") or result["error"])
+            products.extend(result.get("result") or [])
+            start = result.get("next")
+        return products
+
+    async def sync(self, tenant_id: str, full: bool = False):
+        """Trae del CRM lo modificado desde la última marca (o todo el catálogo)."""
+        index = self.index(tenant_id)
+        full = full or index.watermark is None or \
+            time.monotonic() - index.full_synced_at > PRODUCT_INDEX_FULL_SYNC
+        started = time.perf_counter()
+        try:
+            if full:
+                products = await self._fetch_all(tenant_id, {})
+                index.replace_all(products)
+                index.full_synced_at = time.monotonic()
+                _stats["full_syncs"] += 1
+            else:
+                # >= para no perder cambios del mismo segundo; el upsert es idempotente
+                products = await self._fetch_all(tenant_id, {">=DATE_MODIFY": index.watermark})
+                for product in products:
+                    index.upsert(product)
+                _stats["incremental_syncs"] += 1
+            index.synced_at = time.monotonic()
+            elapsed = (time.perf_counter() - started) * 1000
+            logger.info(f"📦 [ProductIndex] {tenant_id}: sync {'completo' if full else 'incremental'} "
+                  f"({len(products)} cambios, {len(index)} productos) en {elapsed:.0f} ms")
+        except Exception as e:
+            _stats["sync_errors"] += 1
+            ERRORS.labels("product_sync").inc()
+            logger.warning(f"⚠️ [ProductIndex] Error sincronizando catálogo de {tenant_id}: {e}")
+
+    def _sync_in_background(self, index: ProductIndex):
+        if index._sync_task is None or index._sync_task.done():
+            index._sync_task = asyncio.create_task(self.sync(index.tenant_id))
+
+    async def warmup_all(self):
+        """Sincroniza el catálogo de cada tenant instalado."""
+        from app.token_manager import get_token_manager
+        for tenant_id in await (await get_token_manager()).list_tenants():
+            await self.sync(tenant_id, full=True)
+
+    # ─── Búsqueda ─────────────────────────────────────────────────
+
+    async def search(self, query: str, section_id=None, min_price: float = None, max_price: float = None,
+                     limit: int = 20, tenant_id: str = None) -> list[dict]:
+        if tenant_id is None:
+            from app.token_manager import get_token_manager
+            tenant_id = await (await get_token_manager()).get_member_id()
+        index = self.index(tenant_id)
+        _stats["searches"] += 1
+
+        if index.age > PRODUCT_INDEX_TTL:
+            self._sync_in_background(index)
+        if index.age > PRODUCT_INDEX_MAX_STALE:
+            _stats["fallbacks"] += 1
+            FALLBACKS.labels("product_search_live").inc()
+            return await self._live_search(query, section_id, min_price, max_price, limit, tenant_id)
+
+        started = time.perf_counter()
+        results = index.search(query, section_id, min_price, max_price, limit)
+        _stats["index_hits"] += 1
+        _stats["index_search_us"] += (time.perf_counter() - started) * 1e6
+        return results
+
+    async def _live_search(self, query, section_id, min_price, max_price, limit, tenant_id) -> list[dict]:
+        """Búsqueda por LIKE en Bitrix (como antes del índice)."""
+        from app.auth import call_bitrix_method
+        filter_ = {"%NAME": query}
+        if section_id is not None:
+            filter_["SECTION_ID"] = section_id
+        if min_price is not None:
+            filter_[">=PRICE"] = min_price
+        if max_price is not None:
+            filter_["<=PRICE"] = max_price
+        result = await call_bitrix_method("crm.product.list", {
+            "order": {"NAME": "ASC"},
+            "filter": filter_,
+            "select": PRODUCT_FIELDS,
+        }, member_id=tenant_id)
+        return (result.get("result") or [])[:limit]
+
+    def stats(self) -> dict:
+        hits = _stats["index_hits"]
+        return {
+            **{k: round(v, 1) for k, v in _stats.items() if k != "index_search_us"},
+            "avg_index_search_us": round(_stats["index_search_us"] / hits, 1) if hits else 0.0,
+            "tenants": {
+                tenant_id: {
+                    "products": len(index),
+                    "age_s": round(index.age, 1) if index.synced_at else None,
+                    "watermark": index.watermark,
+                }
+                for tenant_id, index in self._indexes.items()
+            },
+        }
+
+
+_catalog: ProductCatalog | None = None
+
+
+def get_product_catalog() -> ProductCatalog:
+    global _catalog
+    if _catalog is None:
+        _catalog = ProductCatalog()
+    return _catalog
@@ -0,0 +1,253 @@
+"""
+Ensamblado del prompt orientado a caché de prefijos del proveedor.
+El request se ordena de lo más estable a lo más volátil:
+
+    1. prompt del tenant (system)          -> igual para todos los chats del (tenant, bot)
+    2. schemas de las tools                -> mismo orden en cada request
+    3. memoria del chat (resumen/historial) -> mensaje aparte, cambia solo al plegar/recortar
+    4. turnos recientes                     -> solo se agregan al final
+    5. contexto volátil (fecha, ids)        -> al final del mensaje del usuario
+
+Así OpenAI reutiliza el prefijo cacheado automáticamente y, con
+GEMINI_EXPLICIT_CACHE, se crea un CachedContent de Gemini por (modelo, prompt, tools).
+También lleva la cuenta de tokens cacheados vs. totales según el `usage` del proveedor.
+"""
+import logging
+import os
+import time
+import hashlib
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+from google.genai import Client, types
+from mcp_agent.workflows.llm.augmented_llm_google import GoogleAugmentedLLM, GoogleCompletionTasks
+from app.tool_scheduler import ParallelToolExecutor
+from app.telemetry import LLM_REQUEST_SECONDS, ERRORS
+
+MEMORY_HEADER = "--- MEMORIA DE LA CONVERSACIÓN ---"
+GEMINI_EXPLICIT_CACHE = os.getenv("GEMINI_EXPLICIT_CACHE", "false").lower() in ("1", "true", "yes")
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "3600"))
+
+# tenant -> contadores de tokens de prompt
+_usage: dict[str, dict] = defaultdict(lambda: {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+_gemini_stats = {"caches_created": 0, "cache_errors": 0}
+
+
+# ─── Orden del historial ──────────────────────────────────────────
+
+def _is_memory(msg) -> bool:
+    if isinstance(msg, dict):
+        content = msg.get("content")
+    else:
+        parts = getattr(msg, "parts", None) or []
+        content = getattr(parts[0], "text", None) if parts else None
+    return isinstance(content, str) and content.startswith(MEMORY_HEADER)
+
+
+def _memory_message(llm, text: str):
+    content = f"{MEMORY_HEADER}\n{text.strip()}"
+    if isinstance(llm, GoogleAugmentedLLM):
+        return types.Content(role="user", parts=[types.Part(text=content)])
+    return {"role": "system", "content": content}
+
+
+def seed_history(llm, instruction: str, memory_text: str):
+    """
+    Siembra el historial de un LLM nuevo con la memoria del chat como mensaje
+    propio, después del system prompt del tenant (que queda idéntico entre chats).
+    """
+    if not memory_text:
+        return
+    if isinstance(llm, GoogleAugmentedLLM):
+        # En Gemini el prompt va en system_instruction; la memoria abre el historial
+        llm.history.set([_memory_message(llm, memory_text)])
+    else:
+        llm.history.set([{"role": "system", "content": instruction}, _memory_message(llm, memory_text)])
+
+
+def set_memory_message(llm, memory_text: str):
+    """Reemplaza (o inserta) el mensaje de memoria sin tocar el system prompt."""
+    messages = list(llm.history.get())
+    index = next((i for i, m in enumerate(messages[:2]) if _is_memory(m)), None)
+    if index is not None:
+        messages[index] = _memory_message(llm, memory_text)
+    elif isinstance(llm, GoogleAugmentedLLM):
+        messages.insert(0, _memory_message(llm, memory_text))
+    else:
+        start = 1 if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system" else 0
+        if not start:
+            messages.insert(0, {"role": "system", "content": llm.instruction})
+        messages.insert(1, _memory_message(llm, memory_text))
+    llm.history.set(messages)
+
+
+def set_system_prompt(llm, instruction: str):
+    """Cambia el system prompt de un LLM vivo sin perder su historial (cambió la config del bot)."""
+    llm.instruction = instruction
+    if isinstance(llm, GoogleAugmentedLLM):
+        return  # Gemini lo manda como system_instruction en cada request
+    messages = list(llm.history.get())
+    if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system":
+        messages[0] = {"role": "system", "content": instruction}
+        llm.history.set(messages)
+
+
+def with_volatile_context(user_message: str, context_line: str) -> str:
+    """Mensaje del usuario con el contexto volátil al final (no rompe el prefijo cacheado)."""
+    return f"{user_message}\n\n{context_line}" if context_line else user_message
+
+
+# ─── Métricas de tokens cacheados ─────────────────────────────────
+
+def record_usage(prompt_tokens: int, cached_tokens: int, tenant_id: str = None):
+    if not prompt_tokens:
+        return
+    if tenant_id is None:
+        from app.context_vars import member_id_var
+        tenant_id = member_id_var.get() or "unknown"
+    usage = _usage[tenant_id]
+    usage["requests"] += 1
+    usage["prompt_tokens"] += prompt_tokens
+    usage["cached_tokens"] += cached_tokens or 0
+
+
+def record_openai_usage(response):
+    """`usage.prompt_tokens_details.cached_tokens` de un ChatCompletion."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    record_usage(usage.prompt_tokens, getattr(details, "cached_tokens", 0) if details else 0)
+    from app.metrics import record_token_usage
+    record_token_usage(usage.prompt_tokens, usage.completion_tokens, getattr(response, "model", None))
+
+
+def record_gemini_usage(response):
+    """`usage_metadata.cached_content_token_count` de un GenerateContentResponse."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    record_usage(usage.prompt_token_count or 0, usage.cached_content_token_count or 0)
+    from app.metrics import record_token_usage
+    record_token_usage(usage.prompt_token_count or 0, usage.candidates_token_count or 0,
+                       getattr(response, "model_version", None))
+
+
+def get_prompt_cache_stats() -> dict:
+    tenants = {}
+    totals = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+    for tenant_id, usage in _usage.items():
+        tenants[tenant_id] = {
+            **usage,
+            "cached_ratio": round(usage["cached_tokens"] / usage["prompt_tokens"], 3) if usage["prompt_tokens"] else 0.0,
+        }
+        for k in totals:
+            totals[k] += usage[k]
+    return {
+        **totals,
+        "cached_ratio": round(totals["cached_tokens"] / totals["prompt_tokens"], 3) if totals["prompt_tokens"] else 0.0,
+        "gemini_explicit_cache": GEMINI_EXPLICIT_CACHE,
+        **_gemini_stats,
+        "tenants": tenants,
+    }
+
+
+# ─── Gemini: caché explícita por (modelo, prompt, tools) ──────────
+
+# hash -> (nombre del CachedContent, expira_en); None si el contenido no es cacheable
+_gemini_caches: dict[str, tuple | None] = {}
+
+
+def _gemini_cache_key(model: str, config: types.GenerateContentConfig) -> str:
+    digest = hashlib.sha256()
+    digest.update(model.encode())
+    digest.update(str(config.system_instruction).encode())
+    for tool in config.tools or []:
+        digest.update(tool.model_dump_json(exclude_none=True).encode())
+    return digest.hexdigest()[:32]
+
+
+async def _gemini_cached_content(request) -> str | None:
+    """Nombre del CachedContent para el prompt+tools del request (lo crea si no existe)."""
+    model, config = request.payload["model"], request.payload["config"]
+    key = _gemini_cache_key(model, config)
+    if key in _gemini_caches:
+        entry = _gemini_caches[key]
+        if entry is None or entry[1] > time.time():
+            return entry[0] if entry else None
+
+    from app.redis_client import get_redis
+    redis = await get_redis()
+    redis_key = f"gemini:cache:{key}"
+    name = await redis.get(redis_key)
+    if name:
+        _gemini_caches[key] = (name, time.time() + 60)
+        return name
+
+    try:
+        if request.config and request.config.vertexai:
+            client = Client(vertexai=True, project=request.config.project, location=request.config.location)
+        else:
+            client = Client(api_key=request.config.api_key)
+        cached = await client.aio.caches.create(model=model, config=types.CreateCachedContentConfig(
+            system_instruction=config.system_instruction,
+            tools=config.tools,
+            ttl=f"{GEMINI_CACHE_TTL}s",
+            display_name=f"aibot24-{key[:12]}",
+        ))
+    except Exception as e:
+        # Típicamente el prompt no alcanza el mínimo de tokens cacheables: no reintentar
+        _gemini_stats["cache_errors"] += 1
+        _gemini_caches[key] = None
+        logger.warning(f"⚠️ [PromptCache] No se pudo crear la caché de Gemini: {e}")
+        return None
+
+    _gemini_stats["caches_created"] += 1
+    # Renovar antes de que expire en Gemini
+    expires_in = max(GEMINI_CACHE_TTL - 300, 60)
+    _gemini_caches[key] = (cached.name, time.time() + expires_in)
+    await redis.set(redis_key, cached.name, ex=expires_in)
+    logger.info(f"🧊 [PromptCache] CachedContent de Gemini creado: {cached.name}")
+    return cached.name
+
+
+class _GeminiCacheExecutor:
+    """Envuelve el executor de mcp-agent: usa el CachedContent y registra el usage."""
+
+    def __init__(self, base):
+        self._base = base
+
+    def __getattr__(self, name):
+        return getattr(self._base, name)
+
+    async def execute(self, task, *args, **kwargs):
+        if task is not GoogleCompletionTasks.request_completion_task:
+            return await self._base.execute(task, *args, **kwargs)
+        return await self._complete(task, *args, **kwargs)
+
+    async def _complete(self, task, request, *args, **kwargs):
+        if GEMINI_EXPLICIT_CACHE:
+            name = await _gemini_cached_content(request)
+            if name:
+                # Con cached_content, system_instruction y tools viven en la caché
+                config = request.payload["config"].model_copy(
+                    update={"cached_content": name, "system_instruction": None, "tools": None}
+                )
+                request = request.model_copy(update={"payload": {**request.payload, "config": config}})
+        started = time.perf_counter()
+        response = await self._base.execute(task, request, *args, **kwargs)
+        LLM_REQUEST_SECONDS.labels("google", request.payload.get("model") or "unknown").observe(time.perf_counter() - started)
+        if isinstance(response, BaseException):
+            ERRORS.labels("llm").inc()
+        else:
+            record_gemini_usage(response)
+        return response
+
+
+class CachedGoogleAugmentedLLM(GoogleAugmentedLLM):
+    """GoogleAugmentedLLM con caché explícita opcional y métrica de tokens cacheados."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = _GeminiCacheExecutor(ParallelToolExecutor(self.executor))
@@ -0,0 +1,314 @@
+"""
+Limitador de tasa por portal de Bitrix24 (token bucket compartido en Redis).
+Bitrix24 aplica un leaky bucket de ~2 req/s por portal (ráfaga de 50) y responde
+QUERY_LIMIT_EXCEEDED al excederlo. Este módulo reparte ese presupuesto entre todas
+las instancias, con clases de prioridad (respuestas/transferencias antes que notas y
+enriquecimiento) y un backoff adaptativo según `time.operating` y los rechazos.
+"""
+import logging
+import os
+import time
+import asyncio
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+RATE_PER_SEC = float(os.getenv("BITRIX_RATE_PER_SEC", "2"))
+RATE_BURST = int(os.getenv("BITRIX_RATE_BURST", "50"))
+# Tokens que quedan reservados para clases de mayor prioridad
+RESERVE_NORMAL = int(os.getenv("BITRIX_RATE_RESERVE_NORMAL", "5"))
+RESERVE_LOW = int(os.getenv("BITRIX_RATE_RESERVE_LOW", "20"))
+MAX_WAIT_S = float(os.getenv("BITRIX_RATE_MAX_WAIT", "30"))
+MAX_RETRIES = int(os.getenv("BITRIX_RATE_MAX_RETRIES", "3"))
+# Límite de Bitrix: 480 s de ejecución por método cada 10 min
+OPERATING_LIMIT = float(os.getenv("BITRIX_OPERATING_LIMIT", "480"))
+OPERATING_SOFT_LIMIT = float(os.getenv("BITRIX_OPERATING_SOFT_LIMIT", "300"))
+OPERATING_MAX_DELAY_S = float(os.getenv("BITRIX_OPERATING_MAX_DELAY", "5"))
+# Tras un error de Redis se usa el bucket local durante este tiempo y luego se reintenta
+REDIS_RETRY_S = float(os.getenv("BITRIX_RATE_REDIS_RETRY", "5"))
+KEY_PREFIX = "ratelimit:bitrix"
+
+HIGH, NORMAL, LOW = "high", "normal", "low"
+_RESERVES = {HIGH: 0, NORMAL: RESERVE_NORMAL, LOW: RESERVE_LOW}
+
+# Prioridad por método cuando el llamador no la indica
+_HIGH_METHODS = (
+    "imbot.message.add",
+    "imbot.message.update",
+    "imopenlines.bot.session.message.send",
+    "imopenlines.bot.message.add",
+    "imopenlines.bot.session.transfer",
+    "imopenlines.bot.session.finish",
+    "im.notify",
+)
+_LOW_METHODS = (
+    "crm.timeline.comment.add",
+    "im.chat.updateTitle",
+    "imbot.chat.answer.typing",
+)
+
+# Devuelve 0 si se tomó el token, o los ms a esperar antes de reintentar.
+# Usa TIME de Redis para que todas las instancias compartan el mismo reloj.
+_ACQUIRE_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'penalty_until')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+local penalty = tonumber(state[3]) or 0
+if penalty > now then
+    return penalty - now
+end
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = math.ceil((reserve + 1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 60000)
+return wait
+"""
+
+# Bloquea el bucket durante ARGV[1] ms y lo vacía (Bitrix ya nos rechazó)
+_PENALIZE_LUA = """
+local t = redis.call('TIME')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local until_ms = now + tonumber(ARGV[1])
+local current = tonumber(redis.call('HGET', KEYS[1], 'penalty_until')) or 0
+if until_ms > current then
+    redis.call('HSET', KEYS[1], 'penalty_until', until_ms, 'tokens', 0, 'ts', now)
+end
+redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[1]) + 60000)
+return until_ms
+"""
+
+
+def priority_for(method: str) -> str:
+    """Prioridad por defecto de un método REST."""
+    if method.startswith(_HIGH_METHODS):
+        return HIGH
+    if method.startswith(_LOW_METHODS):
+        return LOW
+    return NORMAL
+
+
+def throttled_response(domain: str) -> dict:
+    """Error estilo Bitrix para una llamada descartada por el limitador (sin token tras `max_wait`)."""
+    return {
+        "error": "QUERY_LIMIT_EXCEEDED",
+        "error_description": f"Límite de peticiones de {domain} saturado, reintentar más tarde",
+    }
+
+
+def domain_of(url: str) -> str:
+    """Dominio del portal a partir de una URL o client_endpoint."""
+    return urlsplit(url).netloc or url.split("/")[0]
+
+
+class _LocalBucket:
+    """Fallback en memoria (sin Redis): mismo algoritmo, solo para este proceso."""
+    __slots__ = ("tokens", "ts", "penalty_until")
+
+    def __init__(self):
+        self.tokens = float(RATE_BURST)
+        self.ts = time.monotonic()
+        self.penalty_until = 0.0
+
+    def acquire(self, reserve: int) -> float:
+        now = time.monotonic()
+        if self.penalty_until > now:
+            return self.penalty_until - now
+        self.tokens = min(RATE_BURST, self.tokens + (now - self.ts) * RATE_PER_SEC)
+        self.ts = now
+        if self.tokens - 1 >= reserve:
+            self.tokens -= 1
+            return 0.0
+        return (reserve + 1 - self.tokens) / RATE_PER_SEC
+
+    def penalize(self, seconds: float):
+        now = time.monotonic()
+        self.penalty_until = max(self.penalty_until, now + seconds)
+        self.tokens = 0.0
+        self.ts = now
+
+
+class BitrixRateLimiter:
+    """
+    Token bucket por dominio compartido entre instancias vía Redis (script Lua atómico).
+    - `acquire(domain, priority)` espera hasta obtener un token; las prioridades bajas
+      no pueden consumir los tokens reservados para las altas.
+    - `observe(domain, method, data)` ajusta el ritmo según `time.operating` y
+      aplica backoff exponencial ante QUERY_LIMIT_EXCEEDED.
+    """
+
+    def __init__(self, redis=None):
+        self._redis = redis
+        self._use_redis = hasattr(redis, "eval")
+        self._redis_retry_at = 0.0  # monotonic: hasta entonces se usa el bucket local
+        self._redis_errors = 0
+        self._local: dict[str, _LocalBucket] = {}
+        self._strikes: dict[str, int] = defaultdict(int)
+        # (domain, method) -> (operating, operating_reset_at)
+        self._operating: dict[tuple, tuple] = {}
+        self._stats: dict[str, dict] = defaultdict(lambda: defaultdict(float))
+
+    def _key(self, domain: str) -> str:
+        return f"{KEY_PREFIX}:{domain}"
+
+    def _bucket(self, domain: str) -> _LocalBucket:
+        bucket = self._local.get(domain)
+        if bucket is None:
+            bucket = self._local[domain] = _LocalBucket()
+        return bucket
+
+    def _redis_available(self) -> bool:
+        return self._use_redis and time.monotonic() >= self._redis_retry_at
+
+    def _redis_failed(self, error: Exception):
+        """Pausa Redis REDIS_RETRY_S: mientras tanto el presupuesto es solo de esta instancia."""
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_S
+        self._redis_errors += 1
+        logger.warning(f"⚠️ [RateLimit] Redis no disponible ({error}), bucket local durante {REDIS_RETRY_S:g}s")
+
+    async def _try_acquire(self, domain: str, reserve: int) -> float:
+        """Intenta tomar un token. Retorna segundos a esperar (0 si se obtuvo)."""
+        if self._redis_available():
+            try:
+                wait_ms = await self._redis.eval(
+                    _ACQUIRE_LUA, 1, self._key(domain), RATE_PER_SEC, RATE_BURST, reserve
+                )
+                return int(wait_ms) / 1000
+            except Exception as e:
+                self._redis_failed(e)
+        return self._bucket(domain).acquire(reserve)
+
+    def _operating_delay(self, domain: str, method: str, priority: str) -> float:
+        """Retardo extra para métodos cerca del límite de tiempo de ejecución de Bitrix."""
+        if priority == HIGH or not method:
+            return 0.0
+        entry = self._operating.get((domain, method))
+        if not entry:
+            return 0.0
+        operating, reset_at = entry
+        if reset_at and reset_at <= time.time():
+            self._operating.pop((domain, method), None)
+            return 0.0
+        if operating < OPERATING_SOFT_LIMIT:
+            return 0.0
+        ratio = min((operating - OPERATING_SOFT_LIMIT) / max(OPERATING_LIMIT - OPERATING_SOFT_LIMIT, 1), 1.0)
+        delay = OPERATING_MAX_DELAY_S * ratio
+        return delay * 2 if priority == LOW else delay
+
+    async def acquire(self, domain: str, priority: str = NORMAL, method: str = None,
+                      max_wait: float = MAX_WAIT_S) -> bool:
+        """
+        Espera un token para `domain`. Retorna False si la espera superaría `max_wait`:
+        el llamador debe descartar la llamada (ver `throttled_response`), no hacerla igual.
+        """
+        stats = self._stats[domain]
+        stats["requests"] += 1
+        stats[f"requests_{priority}"] += 1
+        reserve = _RESERVES.get(priority, RESERVE_NORMAL)
+        waited = 0.0
+
+        delay = self._operating_delay(domain, method, priority)
+        if delay:
+            stats["throttled_operating"] += 1
+            await asyncio.sleep(delay)
+            waited += delay
+
+        while True:
+            wait = await self._try_acquire(domain, reserve)
+            if wait <= 0:
+                break
+            if waited + wait > max_wait:
+                stats["rejected"] += 1
+                self._record_wait(stats, waited)
+                return False
+            await asyncio.sleep(wait)
+            waited += wait
+
+        self._record_wait(stats, waited)
+        return True
+
+    def _record_wait(self, stats: dict, waited: float):
+        if waited > 0:
+            stats["waited"] += 1
+            stats["wait_ms_total"] += waited * 1000
+            stats["wait_ms_max"] = max(stats["wait_ms_max"], waited * 1000)
+
+    async def penalize(self, domain: str, seconds: float):
+        """Vacía el bucket de `domain` y lo bloquea `seconds` en todas las instancias."""
+        # La penalización local se aplica siempre: cubre las adquisiciones que caigan al bucket local
+        self._bucket(domain).penalize(seconds)
+        if self._redis_available():
+            try:
+                await self._redis.eval(_PENALIZE_LUA, 1, self._key(domain), int(seconds * 1000))
+            except Exception as e:
+                self._redis_failed(e)
+
+    async def observe(self, domain: str, method: str, data) -> bool:
+        """
+        Registra la respuesta de Bitrix. Retorna True si fue QUERY_LIMIT_EXCEEDED
+        (el llamador debe reintentar tras un nuevo `acquire`).
+        """
+        if not isinstance(data, dict):
+            return False
+        stats = self._stats[domain]
+
+        if data.get("error") == "QUERY_LIMIT_EXCEEDED":
+            self._strikes[domain] += 1
+            backoff = min(2 ** (self._strikes[domain] - 1), 16)
+            stats["limit_exceeded"] += 1
+            logger.info(f"🚦 [RateLimit] QUERY_LIMIT_EXCEEDED en {domain}, pausa de {backoff}s")
+            await self.penalize(domain, backoff)
+            return True
+
+        self._strikes.pop(domain, None)
+        timing = data.get("time")
+        if isinstance(timing, dict) and timing.get("operating") is not None:
+            operating = float(timing.get("operating") or 0)
+            stats["last_operating"] = operating
+            if operating >= OPERATING_SOFT_LIMIT:
+                self._operating[(domain, method)] = (operating, float(timing.get("operating_reset_at") or 0))
+            else:
+                self._operating.pop((domain, method), None)
+        return False
+
+    def stats(self) -> dict:
+        """Métricas de saturación por tenant (dominio)."""
+        out = {}
+        for domain, s in self._stats.items():
+            requests = s["requests"] or 1
+            out[domain] = {
+                **{k: round(v, 1) for k, v in s.items()},
+                "saturation": round(s["waited"] / requests, 3),
+                "avg_wait_ms": round(s["wait_ms_total"] / s["waited"], 1) if s["waited"] else 0.0,
+                "hot_methods": [m for (d, m) in self._operating if d == domain],
+            }
+        return {
+            "backend": "redis" if self._use_redis else "local",
+            "redis_errors": self._redis_errors,
+            "redis_paused_s": round(max(self._redis_retry_at - time.monotonic(), 0.0), 1),
+            "rate_per_sec": RATE_PER_SEC,
+            "burst": RATE_BURST,
+            "tenants": out,
+        }
+
+
+_rate_limiter: BitrixRateLimiter | None = None
+
+
+async def get_rate_limiter() -> BitrixRateLimiter:
+    """Retorna el limitador singleton (usa el Redis compartido si está disponible)."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        from app.redis_client import get_redis
+        _rate_limiter = BitrixRateLimiter(await get_redis())
+    return _rate_limiter
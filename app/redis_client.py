@@ -2,21 +2,19 @@
 Cliente Redis singleton para compartir conexión entre módulos.
 Usa REDIS_URL del entorno o fallback a localhost.
 """
+import logging
 import os
-import sys
 import asyncio
 import time
 import redis.asyncio as aioredis
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+logger = logging.getLogger(__name__)
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 _redis_client: aioredis.Redis | None = None
+_redis_binary_client: aioredis.Redis | None = None
+_redis_stream_client: aioredis.Redis | None = None
 
 
 class MockRedis:
@@ -28,6 +26,16 @@ class MockRedis:
     async def set(self, key, value, **kwargs):
         self._data[key] = value
         return True
+    async def delete(self, *keys):
+        return sum(1 for k in keys if self._data.pop(k, None) is not None)
+    async def hset(self, key, field=None, value=None, mapping=None):
+        h = self._data.setdefault(key, {})
+        if field is not None:
+            h[field] = value
+        h.update(mapping or {})
+        return True
+    async def hgetall(self, key):
+        return dict(self._data.get(key) or {})
     async def aclose(self):
         pass
 
@@ -35,7 +43,7 @@ from datetime import datetime
 
 def log(msg: str):
     now = datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{now}] {msg}")
+    logger.info(f"[{now}] {msg}")
 
 async def get_redis() -> aioredis.Redis:
     """Retorna el cliente Redis singleton con socket timeout para evitar bloqueos."""
@@ -60,9 +68,59 @@ async def get_redis() -> aioredis.Redis:
             _redis_client = MockRedis()
     return _redis_client
 
+async def get_redis_binary() -> aioredis.Redis:
+    """
+    Cliente Redis sin decode_responses, para valores binarios (historial
+    codificado con msgpack/zstd). Si Redis no está disponible retorna el mock.
+    """
+    global _redis_binary_client
+    if _redis_binary_client is None:
+        client = await get_redis()
+        if isinstance(client, MockRedis):
+            return client
+        _redis_binary_client = aioredis.from_url(
+            REDIS_URL,
+            decode_responses=False,
+            max_connections=10,
+            socket_timeout=2.0,
+            socket_connect_timeout=2.0,
+            retry_on_timeout=False
+        )
+    return _redis_binary_client
+
+async def get_redis_stream(max_connections: int) -> aioredis.Redis:
+    """
+    Cliente aparte para las lecturas bloqueantes (XREADGROUP BLOCK) de la cola de
+    ingesta: cada lector retiene una conexión mientras espera y no debe agotar el
+    pool compartido. BlockingConnectionPool: si están todas en uso se espera una
+    libre en lugar de fallar con "Too many connections".
+    """
+    global _redis_stream_client
+    if _redis_stream_client is None:
+        client = await get_redis()
+        if isinstance(client, MockRedis):
+            return client
+        pool = aioredis.BlockingConnectionPool.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            max_connections=max_connections,
+            timeout=5,
+            socket_timeout=2.0,
+            socket_connect_timeout=2.0,
+            retry_on_timeout=False
+        )
+        _redis_stream_client = aioredis.Redis(connection_pool=pool)
+    return _redis_stream_client
+
 async def close_redis():
     """Cierra la conexión Redis."""
-    global _redis_client
+    global _redis_client, _redis_binary_client, _redis_stream_client
+    if _redis_stream_client is not None:
+        await _redis_stream_client.aclose()
+        _redis_stream_client = None
+    if _redis_binary_client is not None:
+        await _redis_binary_client.aclose()
+        _redis_binary_client = None
     if _redis_client is not None:
         if hasattr(_redis_client, 'aclose'):
             await _redis_client.aclose()
@@ -0,0 +1,193 @@
+"""
+Caché read-through para datos de referencia de Bitrix24 (esquemas de campos,
+etapas, catálogos y secciones, tipos de calendario, plantillas de documentos).
+Cambian muy poco, pero las tools y los recursos `bitrix://` los pedían en cada
+llamada. Las entradas son por tenant y llevan:
+- TTL por método; pasado el TTL se sirven "stale" mientras se refrescan en
+  segundo plano (stale-while-revalidate, hasta REFERENCE_STALE_SECONDS más).
+- Versión por tenant (`refcache:{tenant}:version`): invalidar = INCR.
+Opcionalmente se precargan al arrancar (REFERENCE_WARMUP) para cada tenant instalado.
+"""
+import logging
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+from app.local_cache import get_cache
+
+KEY_PREFIX = "refcache"
+REFERENCE_STALE_SECONDS = int(os.getenv("REFERENCE_STALE_SECONDS", "86400"))
+REFERENCE_WARMUP = os.getenv("REFERENCE_WARMUP", "false").lower() in ("1", "true", "yes")
+
+# Métodos cacheables y su TTL (segundos)
+REFERENCE_TTLS = {
+    "crm.lead.fields": 6 * 3600,
+    "crm.deal.fields": 6 * 3600,
+    "crm.contact.fields": 6 * 3600,
+    "crm.company.fields": 6 * 3600,
+    "crm.status.list": 3600,
+    "crm.catalog.list": 6 * 3600,
+    "crm.productsection.list": 3600,
+    "calendar.type.get": 6 * 3600,
+    "crm.documentgenerator.template.list": 3600,
+}
+
+# Llamadas que se precargan por tenant (las que los agentes usan para "descubrir" el portal)
+WARMUP_CALLS = [
+    ("crm.lead.fields", {}),
+    ("crm.deal.fields", {}),
+    ("crm.contact.fields", {}),
+    ("crm.company.fields", {}),
+    ("crm.status.list", {"filter": {"ENTITY_ID": "STATUS"}, "order": {"SORT": "ASC"}}),
+    ("crm.status.list", {"filter": {"ENTITY_ID": "DEAL_STAGE"}, "order": {"SORT": "ASC"}}),
+    ("crm.catalog.list", {}),
+    ("calendar.type.get", {}),
+    ("crm.documentgenerator.template.list", {"filter": {"entityTypeId": 1}}),
+    ("crm.documentgenerator.template.list", {"filter": {"entityTypeId": 2}}),
+]
+
+_stats = defaultdict(int)
+_refreshing: set[str] = set()
+
+
+def _params_hash(params: dict) -> str:
+    return hashlib.sha1(json.dumps(params or {}, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class ReferenceCache:
+    """Read-through por (tenant, versión, método, params) con L1 en proceso y L2 en Redis."""
+
+    def __init__(self, redis=None):
+        self._redis = redis
+        # La versión se relee de Redis cada 30s: una invalidación tarda como mucho eso en otras instancias
+        self._versions = get_cache("refcache_version", maxsize=1024, ttl=30)
+        self._l1 = get_cache("reference", maxsize=2048, ttl=300)
+
+    async def _version(self, tenant_id: str) -> int:
+        version = self._versions.get(tenant_id)
+        if version is None:
+            version = int(await self._redis.get(f"{KEY_PREFIX}:{tenant_id}:version") or 0)
+            self._versions.set(tenant_id, version)
+        return version
+
+    def _key(self, tenant_id: str, version: int, method: str, params: dict) -> str:
+        return f"{KEY_PREFIX}:{tenant_id}:v{version}:{method}:{_params_hash(params)}"
+
+    async def get(self, method: str, params: dict = None, tenant_id: str = None, fetch=None) -> dict:
+        """
+        Respuesta de Bitrix para `method(params)` del tenant, desde la caché si está
+        vigente. `fetch` es la corrutina que llama a Bitrix (por defecto call_bitrix_method).
+        """
+        params = params or {}
+        ttl = REFERENCE_TTLS.get(method)
+        if tenant_id is None:
+            from app.token_manager import get_token_manager
+            tenant_id = await (await get_token_manager()).get_member_id()
+        if fetch is None:
+            from app.auth import call_bitrix_method
+            fetch = lambda m, p: call_bitrix_method(m, p, member_id=tenant_id)
+        if ttl is None or not tenant_id:
+            return await fetch(method, params)
+
+        key = self._key(tenant_id, await self._version(tenant_id), method, params)
+        entry = self._l1.get(key)
+        if entry is None:
+            raw = await self._redis.get(key)
+            entry = json.loads(raw) if raw else None
+
+        if entry is not None:
+            age = time.time() - entry["fetched_at"]
+            if age < ttl:
+                _stats["hits"] += 1
+                self._l1.set(key, entry, ttl=min(ttl - age, self._l1.ttl))
+                return entry["data"]
+            if age < ttl + REFERENCE_STALE_SECONDS:
+                # Servir lo que hay y refrescar en segundo plano
+                _stats["stale_hits"] += 1
+                if key not in _refreshing:
+                    _refreshing.add(key)
+                    asyncio.create_task(self._refresh(key, method, params, ttl, fetch))
+                return entry["data"]
+
+        _stats["misses"] += 1
+        return await self._load(key, method, params, ttl, fetch)
+
+    async def _load(self, key: str, method: str, params: dict, ttl: int, fetch) -> dict:
+        data = await fetch(method, params)
+        if isinstance(data, dict) and "result" in data and not data.get("error"):
+            entry = {"data": data, "fetched_at": time.time()}
+            self._l1.set(key, entry, ttl=min(ttl, self._l1.ttl))
+            await self._redis.set(key, json.dumps(entry, ensure_ascii=False), ex=ttl + REFERENCE_STALE_SECONDS)
+        return data
+
+    async def _refresh(self, key: str, method: str, params: dict, ttl: int, fetch):
+        try:
+            await self._load(key, method, params, ttl, fetch)
+            _stats["refreshes"] += 1
+        except Exception as e:
+            _stats["refresh_errors"] += 1
+            logger.warning(f"⚠️ [RefCache] Error refrescando {method}: {e}")
+        finally:
+            _refreshing.discard(key)
+
+    async def invalidate(self, tenant_id: str):
+        """Invalida todo el dato de referencia del tenant (en todas las instancias)."""
+        if hasattr(self._redis, "incr"):
+            version = await self._redis.incr(f"{KEY_PREFIX}:{tenant_id}:version")
+        else:
+            version = await self._version(tenant_id) + 1
+            await self._redis.set(f"{KEY_PREFIX}:{tenant_id}:version", version)
+        self._versions.set(tenant_id, int(version))
+        _stats["invalidations"] += 1
+        logger.info(f"🧹 [RefCache] Datos de referencia invalidados para {tenant_id} (v{version})")
+
+    async def warmup(self, tenant_id: str) -> int:
+        """Precarga WARMUP_CALLS para un tenant. Retorna cuántas quedaron en caché."""
+        from app.auth import call_bitrix_method
+        loaded = 0
+        for method, params in WARMUP_CALLS:
+            try:
+                await self.get(method, params, tenant_id=tenant_id,
+                               fetch=lambda m, p: call_bitrix_method(m, p, member_id=tenant_id, priority="low"))
+                loaded += 1
+            except Exception as e:
+                logger.warning(f"⚠️ [RefCache] Warmup de {method} falló para {tenant_id}: {e}")
+        return loaded
+
+    async def warmup_all(self):
+        """Precarga los datos de referencia de cada tenant instalado."""
+        from app.token_manager import get_token_manager
+        tenants = await (await get_token_manager()).list_tenants()
+        for tenant_id in tenants:
+            loaded = await self.warmup(tenant_id)
+            logger.info(f"🔥 [RefCache] Warmup {tenant_id}: {loaded}/{len(WARMUP_CALLS)} llamadas en caché")
+
+    def stats(self) -> dict:
+        lookups = _stats["hits"] + _stats["stale_hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "hit_ratio": round((_stats["hits"] + _stats["stale_hits"]) / lookups, 3) if lookups else 0.0,
+            "refreshing": len(_refreshing),
+        }
+
+
+_reference_cache: ReferenceCache | None = None
+
+
+async def get_reference_cache() -> ReferenceCache:
+    global _reference_cache
+    if _reference_cache is None:
+        from app.redis_client import get_redis
+        _reference_cache = ReferenceCache(await get_redis())
+    return _reference_cache
+
+
+async def cached_bitrix_call(method: str, params: dict = None) -> dict:
+    """Drop-in de call_bitrix_method para métodos de referencia (REFERENCE_TTLS)."""
+    cache = await get_reference_cache()
+    return await cache.get(method, params)
@@ -1,7 +1,9 @@
 
+import logging
 import os
 import yaml
-import sys
+
+logger = logging.getLogger(__name__)
 
 def get_secret(provider: str, key: str = "api_key"):
     """
@@ -24,6 +26,6 @@ def get_secret(provider: str, key: str = "api_key"):
                 secrets = yaml.safe_load(f)
                 return secrets.get(provider, {}).get(key)
     except Exception as e:
-        sys.stderr.write(f"⚠️ Error cargando secretos de yaml: {e}\n")
+        logger.warning(f"⚠️ Error cargando secretos de yaml: {e}")
 
     return None
@@ -0,0 +1,280 @@
+"""
+Snapshots de sesión para re-hidratar un chat sin reconstruirlo desde texto.
+Tras cada turno se guarda en Redis (`chat:{id}:snapshot`, mismo codec binario
+que el historial) el estado de la conversación del LLM:
+
+    v               versión del formato
+    provider        "openai" | "google" (el historial nativo no es intercambiable)
+    config_version  huella del prototipo (prompt, proveedor, modelo) del (tenant, bot)
+    messages        historial nativo multi-turno: turnos, tool calls y sus resultados
+    summary         mensaje de memoria (resumen) que acompañaba al historial
+    crm             IDs del CRM ya encontrados (lead, contacto, deal, empresa)
+    last_context    último [CONTEXTO ACTUAL] enviado al LLM
+    tail            huella del último mensaje del historial persistente
+
+Al crear una sesión (arranque en frío, desalojo o cambio de instancia) el
+historial se restaura tal cual en el LLM, así el modelo no repite tool calls y
+el system prompt no crece con un historial en texto. Si el snapshot falta, es
+de otro proveedor/config o quedó atrás del historial en Redis (otra instancia
+respondió después), se usa la semilla en texto de app.memory.
+"""
+import logging
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+from google.genai import types
+from app.redis_client import get_redis_binary
+from app.history_codec import encode_entry, decode_entry
+from app.memory import HISTORY_TTL, _key as _history_key
+from app.prompt_cache import MEMORY_HEADER, _is_memory, seed_history
+
+SESSION_SNAPSHOTS = os.getenv("SESSION_SNAPSHOTS", "true").lower() in ("1", "true", "yes")
+SESSION_SNAPSHOT_TTL = int(os.getenv("SESSION_SNAPSHOT_TTL", str(HISTORY_TTL)))
+SNAPSHOT_VERSION = 1
+CRM_HEADER = "--- DATOS CRM CONOCIDOS ---"
+
+# IDs del CRM en argumentos de tools y en sus resultados
+_CRM_PATTERNS = {
+    "lead_id": (
+        re.compile(r'"?\b(?:lead_id|LEAD_ID|leadId)"?\s*[:=]\s*"?(\d+)'),
+        re.compile(r"\bLead (?:nuevo ID: )?(\d+)"),
+        re.compile(r"GESTIÓN EXITOSA.*?\(ID: (\d+)\)"),
+    ),
+    "contact_id": (
+        re.compile(r'"?\b(?:contact_id|CONTACT_ID|contactId)"?\s*[:=]\s*"?(\d+)'),
+        re.compile(r"\bContacto (\d+)"),
+    ),
+    "deal_id": (
+        re.compile(r'"?\b(?:deal_id|DEAL_ID|dealId)"?\s*[:=]\s*"?(\d+)'),
+        re.compile(r"\b(?:Deal|Negociación) (\d+)"),
+    ),
+    "company_id": (
+        re.compile(r'"?\b(?:company_id|COMPANY_ID|companyId)"?\s*[:=]\s*"?(\d+)'),
+    ),
+}
+
+_stats = defaultdict(float)
+# Última escritura en curso por chat: las siguientes esperan a que termine (orden de turnos)
+_saves: dict[str, asyncio.Task] = {}
+SNAPSHOT_FLUSH_TIMEOUT = float(os.getenv("SESSION_SNAPSHOT_FLUSH_TIMEOUT", "5"))
+
+
+def _snapshot_key(chat_id: str) -> str:
+    return f"chat:{chat_id}:snapshot"
+
+
+def config_version(instruction: str, provider: str, model: str) -> str:
+    """Huella de la configuración del (tenant, bot) con la que se generó el historial."""
+    return hashlib.sha1(f"{provider}|{model}|{instruction}".encode("utf-8")).hexdigest()[:12]
+
+
+def entry_fingerprint(role: str, content: str) -> str:
+    return hashlib.sha1(f"{role}|{content}".encode("utf-8")).hexdigest()[:16]
+
+
+# ─── Serialización del historial nativo ───────────────────────────
+
+def _plain(value):
+    """Objetos del SDK (pydantic) y TypedDicts a tipos serializables, sin Nones."""
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    raise TypeError(f"Tipo no serializable en el historial: {type(value).__name__}")
+
+
+def _conversation(messages: list) -> list:
+    """Historial sin el system prompt ni el mensaje de memoria (se reconstruyen al restaurar)."""
+    start = 0
+    while start < len(messages):
+        msg = messages[start]
+        if (isinstance(msg, dict) and msg.get("role") == "system") or _is_memory(msg):
+            start += 1
+            continue
+        break
+    return messages[start:]
+
+
+def _memory_text(messages: list) -> str:
+    """Texto del mensaje de memoria actual, tal como lo ve el LLM (sin el bloque del CRM)."""
+    for msg in messages[:2]:
+        if not _is_memory(msg):
+            continue
+        text = msg.get("content") if isinstance(msg, dict) else msg.parts[0].text
+        return (text or "")[len(MEMORY_HEADER):].split(CRM_HEADER)[0].strip()
+    return ""
+
+
+def extract_crm_ids(messages: list, known: dict = None) -> dict:
+    """IDs del CRM mencionados en tool calls y resultados (el más reciente gana)."""
+    found = dict(known or {})
+    for msg in messages:
+        text = json.dumps(msg, ensure_ascii=False) if not isinstance(msg, str) else msg
+        if "tool" not in text and "function" not in text:
+            continue  # solo mensajes con tool calls o resultados
+        for field, patterns in _CRM_PATTERNS.items():
+            for pattern in patterns:
+                for match in pattern.finditer(text):
+                    found[field] = match.group(1)
+    return found
+
+
+def memory_text_for(summary: str, crm: dict) -> str:
+    """Contenido del mensaje de memoria al restaurar: resumen + IDs del CRM ya conocidos."""
+    parts = [summary] if summary else []
+    if crm:
+        parts.append(f"{CRM_HEADER}\n" + ", ".join(f"{k}={v}" for k, v in sorted(crm.items())))
+    return "\n".join(parts)
+
+
+def build_snapshot(session, last_entry: tuple) -> dict | None:
+    """Arma el snapshot de una sesión (en el event loop, dentro del lock del chat)."""
+    try:
+        messages = list(session.llm.history.get())
+        conversation = [_plain(m) for m in _conversation(messages)]
+    except Exception as e:
+        # Un mensaje no serializable invalida todo el snapshot (no dejar tool results huérfanos)
+        _stats["build_errors"] += 1
+        logger.debug(f"[Snapshot] Historial no serializable: {e}")
+        return None
+    session.crm = extract_crm_ids(conversation, session.crm)
+    return {
+        "v": SNAPSHOT_VERSION,
+        "provider": session.provider,
+        "config_version": session.config_version,
+        "messages": conversation,
+        "summary": _memory_text(messages),
+        "crm": session.crm,
+        "last_context": session.last_context,
+        "tail": entry_fingerprint(*last_entry),
+        "saved_at": time.time(),
+    }
+
+
+# ─── Redis ────────────────────────────────────────────────────────
+
+async def save_snapshot(chat_id: str, snapshot: dict):
+    try:
+        data = encode_entry(snapshot)
+        r = await get_redis_binary()
+        await r.set(_snapshot_key(chat_id), data, ex=SESSION_SNAPSHOT_TTL)
+        _stats["saved"] += 1
+        _stats["bytes_total"] += len(data)
+        _stats["bytes_last"] = len(data)
+    except Exception as e:
+        _stats["save_errors"] += 1
+        logger.warning(f"⚠️ [Snapshot] Error guardando snapshot de {chat_id}: {e}")
+
+
+def schedule_snapshot(chat_id: str, session, last_entry: tuple):
+    """
+    Captura el estado ahora (`last_entry` = (role, content) del último mensaje
+    guardado en app.memory) y lo escribe en segundo plano (no demora la respuesta).
+    """
+    if not SESSION_SNAPSHOTS:
+        return
+    snapshot = build_snapshot(session, last_entry)
+    if snapshot is None:
+        return
+    task = asyncio.create_task(_save_after(_saves.get(chat_id), chat_id, snapshot))
+    _saves[chat_id] = task
+    task.add_done_callback(lambda t: _saves.pop(chat_id, None) if _saves.get(chat_id) is t else None)
+
+
+async def _save_after(previous: asyncio.Task | None, chat_id: str, snapshot: dict):
+    # Dos turnos seguidos: el snapshot más nuevo no puede quedar pisado por el anterior
+    if previous is not None:
+        await asyncio.wait([previous])
+    await save_snapshot(chat_id, snapshot)
+
+
+async def flush_snapshots():
+    """Espera las escrituras pendientes (apagado), hasta SNAPSHOT_FLUSH_TIMEOUT segundos."""
+    if not _saves:
+        return
+    _, pending = await asyncio.wait(list(_saves.values()), timeout=SNAPSHOT_FLUSH_TIMEOUT)
+    if pending:
+        logger.warning(f"⚠️ [Snapshot] {len(pending)} snapshots sin escribir al apagar")
+
+
+async def load_snapshot(chat_id: str) -> dict | None:
+    """Snapshot al día con el historial persistente, o None (falta o quedó atrasado)."""
+    if not SESSION_SNAPSHOTS:
+        return None
+    try:
+        r = await get_redis_binary()
+        if not hasattr(r, "pipeline"):
+            return None  # MockRedis: sin historial persistente no hay con qué validar
+        pipe = r.pipeline(transaction=False)
+        pipe.get(_snapshot_key(chat_id))
+        pipe.lrange(_history_key(chat_id), -1, -1)
+        raw, last = await pipe.execute()
+        if not raw:
+            _stats["misses"] += 1
+            return None
+        snapshot = decode_entry(raw)
+        # Un último mensaje corrupto o de codec desconocido invalida el snapshot (semilla en texto)
+        entry = decode_entry(last[0]) if last else None
+    except Exception as e:
+        _stats["load_errors"] += 1
+        logger.warning(f"⚠️ [Snapshot] Error leyendo snapshot de {chat_id}: {e}")
+        return None
+
+    if entry is None or entry_fingerprint(entry["role"], entry["content"]) != snapshot.get("tail"):
+        # El historial avanzó sin este snapshot (otra instancia respondió o falló la escritura)
+        _stats["stale"] += 1
+        return None
+    return snapshot
+
+
+def is_compatible(snapshot: dict, provider: str, version: str) -> bool:
+    """El historial nativo solo se restaura con el mismo formato, proveedor y config del bot."""
+    if snapshot.get("v") != SNAPSHOT_VERSION or snapshot.get("provider") != provider:
+        _stats["incompatible"] += 1
+        return False
+    if snapshot.get("config_version") != version:
+        _stats["config_changed"] += 1
+        return False
+    return True
+
+
+def restore_snapshot(llm, instruction: str, snapshot: dict):
+    """Carga el historial nativo del snapshot en un LLM recién creado."""
+    memory_text = memory_text_for(snapshot.get("summary") or "", snapshot.get("crm") or {})
+    if snapshot["provider"] == "openai":
+        messages = list(snapshot["messages"])
+        seed_history(llm, instruction, memory_text)
+        base = llm.history.get() if memory_text else [{"role": "system", "content": instruction}]
+    else:
+        messages = [types.Content.model_validate(m) for m in snapshot["messages"]]
+        seed_history(llm, instruction, memory_text)
+        base = llm.history.get() if memory_text else []
+    llm.history.set(list(base) + messages)
+    _stats["restored"] += 1
+    _stats["restored_messages"] += len(messages)
+
+
+async def delete_snapshot(chat_id: str):
+    r = await get_redis_binary()
+    await r.delete(_snapshot_key(chat_id))
+
+
+def get_snapshot_stats() -> dict:
+    saved = _stats["saved"]
+    return {
+        "enabled": SESSION_SNAPSHOTS,
+        "pending_saves": len(_saves),
+        **{k: round(v, 1) for k, v in _stats.items()},
+        "bytes_avg": round(_stats["bytes_total"] / saved, 1) if saved else 0.0,
+    }
@@ -1,30 +1,29 @@
 """
-Gestión de sesiones de agente con locks distribuidos via Redis.
+Gestión de sesiones de agente con locks distribuidos via Redis (app.chat_lock).
 Las sesiones de agente se mantienen en RAM (no serializables),
 pero los locks y metadata usan Redis para soporte multi-instancia.
 """
+import logging
 import os
 import time
 import asyncio
+from collections import OrderedDict
 from dataclasses import dataclass, field
-import sys
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+logger = logging.getLogger(__name__)
 
 from mcp_agent.agents.agent import Agent
-from mcp_agent.workflows.llm.augmented_llm_google import GoogleAugmentedLLM
-from mcp_agent.workflows.llm.augmented_llm_openai import OpenAIAugmentedLLM
-from app.context import app, MCP_SERVER_NAME
-from app.firestore_config import get_firestore_config
 from app.memory import format_history_str, clear_chat_history
-from app.redis_client import get_redis
-from app.secrets_loader import get_secret
+from app.prompt_cache import set_system_prompt
+from app.session_snapshot import load_snapshot, is_compatible, restore_snapshot, delete_snapshot
+from app.chat_lock import get_chat_lock_manager
 
 SESSION_TTL_SECONDS = 30 * 60  # 30 minutos
+# Límites del cache de sesiones (LRU): cantidad y memoria aproximada
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "500"))
+SESSION_MEMORY_BUDGET_BYTES = int(float(os.getenv("SESSION_MEMORY_BUDGET_MB", "256")) * 1024 * 1024)
+# Costo fijo estimado de una sesión (LLM, params, dataclass) sin contar historial
+SESSION_BASE_BYTES = 2048
 
 
 @dataclass
@@ -33,8 +32,28 @@ class AgentSession:
     agent: Agent
     llm: object
     agent_app: object
+    # False si el Agent es el prototipo compartido del (tenant, bot): no se cierra con la sesión
+    owns_agent: bool = True
+    app_context_manager: object = None
+    # Instrucción base del prototipo (sin historial); se usa al recortar el historial vivo
+    instruction: str = ""
+    # Último contexto estructurado enviado al LLM: solo se repite si cambia
+    last_context: dict = None
+    # Proveedor y huella de config del prototipo (validan los snapshots, ver app.session_snapshot)
+    provider: str = ""
+    config_version: str = ""
+    # (tenant, bot) del prototipo; config_stale se marca cuando cambia su config en Firestore
+    tenant_id: str = ""
+    bot_id: str = None
+    config_stale: bool = False
+    # IDs del CRM ya encontrados en esta conversación (lead, contacto, deal...)
+    crm: dict = field(default_factory=dict)
     created_at: float = field(default_factory=time.time)
     last_used: float = field(default_factory=time.time)
+    # Bytes estimados (instrucción + historial del LLM); se recalcula tras cada turno
+    estimated_bytes: int = 0
+    # True mientras un turno usa la sesión: no se desaloja
+    busy: bool = False
 
     def is_expired(self) -> bool:
         return (time.time() - self.last_used) > SESSION_TTL_SECONDS
@@ -42,19 +61,40 @@ class AgentSession:
     def touch(self):
         self.last_used = time.time()
 
-
-# Cache en RAM: chat_id -> AgentSession (no serializable)
-_sessions: dict[str, AgentSession] = {}
+    def estimate_size(self) -> int:
+        """Aproximación barata del tamaño: texto de la instrucción y de cada mensaje del historial."""
+        size = SESSION_BASE_BYTES + len(getattr(self.llm, "instruction", None) or "")
+        history = getattr(self.llm, "history", None)
+        try:
+            messages = history.get() if history is not None else []
+        except Exception:
+            messages = []
+        for msg in messages:
+            size += len(str(msg))
+        self.estimated_bytes = size
+        return size
+
+    async def close(self):
+        """Libera los recursos propios de la sesión (el Agent compartido sigue vivo)."""
+        if self.owns_agent:
+            await self.agent.__aexit__(None, None, None)
+        if self.app_context_manager:
+            await self.app_context_manager.__aexit__(None, None, None)
+
+
+# Cache en RAM (LRU): chat_id -> AgentSession (no serializable)
+_sessions: OrderedDict[str, AgentSession] = OrderedDict()
 _global_lock = asyncio.Lock()
+_stats = {"evicted": 0, "rehydrated": 0, "restored": 0, "created": 0, "config_updated": 0, "config_rebuilt": 0}
 
 
 async def get_chat_lock(chat_id: str):
     """
-    Retorna un lock distribuido de Redis para un chat_id.
-    Compatible con `async with`.
+    Retorna el lock del chat (cola FIFO entre instancias, ver app.chat_lock).
+    Compatible con `async with`; lanza ChatLockTimeout si no llega el turno.
     """
-    r = await get_redis()
-    return r.lock(f"lock:chat:{chat_id}", timeout=600, blocking_timeout=300)
+    manager = await get_chat_lock_manager()
+    return manager.lock(chat_id)
 
 
 async def cleanup_expired_sessions():
@@ -65,158 +105,195 @@ async def cleanup_expired_sessions():
             session = _sessions.pop(cid, None)
             if session:
                 try:
-                    await session.agent.__aexit__(None, None, None)
-                    if session.app_context_manager:
-                        await session.app_context_manager.__aexit__(None, None, None)
+                    await session.close()
                     
                     # Limpiar Redis al terminar sesión (según requerimiento user)
                     await clear_chat_history(cid)
+                    await delete_snapshot(cid)
                 except Exception as e:
-                    print(f"  ⚠️ Error cerrando sesión {cid}: {e}")
-                print(f"  🧹 Sesión expirada limpiada para chat {cid}")
+                    logger.warning(f"⚠️ Error cerrando sesión {cid}: {e}")
+                logger.info(f"🧹 Sesión expirada limpiada para chat {cid}")
+
+    # Agents de prototipos reemplazados (TTL o cambio de config) que ya nadie usa
+    from app.agent_factory import get_agent_factory
+    factory = await get_agent_factory()
+    try:
+        await factory.close_retired({id(s.agent) for s in _sessions.values()})
+    except Exception as e:
+        logger.warning(f"⚠️ Error cerrando agentes retirados: {e}")
 
 
 async def create_new_session(chat_id: str) -> AgentSession:
-    """Crea una nueva sesión de agente para un chat_id."""
+    """
+    Crea una nueva sesión de agente para un chat_id.
+    El Agent (tools, prompt, proveedor) viene del prototipo compartido del
+    (tenant, bot) en app.agent_factory; la sesión solo agrega un LLM propio.
+    """
     # IMPORTANTE: No borrar el historial al iniciar sesión. 
     # Cloud Run apaga instancias (instancias a cero) frecuentemente.
     # Queremos que el bot recuerde lo anterior al re-encenderse por un nuevo mensaje.
     # await clear_chat_history(chat_id) 
-    
-    # --- CONFIGURACIÓN GLOBAL (Variables de Entorno / GitHub Secrets) ---
-    from app.config import config as ai_config
-    llm_provider = ai_config.LLM_PROVIDER
-    global_model = ai_config.MODEL
-    global_temp = ai_config.TEMPERATURE
-    global_api_key = ai_config.API_KEY
-
-    # Si no hay key en el entorno, intentamos el loader legacy por si acaso
-    if not global_api_key:
-        global_api_key = get_secret(llm_provider)
-
-    # --- CONFIGURACIÓN ESPECÍFICA (Firestore) ---
-    # Traemos el prompt y permitimos sobrescribir modelo/temp si el usuario lo desea en firestore
-    fs_service = await get_firestore_config()
     from app.context_vars import member_id_var
+    from app.agent_factory import get_agent_factory
     tenant_id = member_id_var.get() or os.getenv("BITRIX_MEMBER_ID")
     
     # Nuevo: Extraer bot_id para filtrar correctamente en Firestore (si hay múltiples bots por portal)
     bot_id = os.getenv("BITRIX_BOT_ID") 
-    
-    config = await fs_service.get_tenant_config(tenant_id, bot_id=bot_id) if tenant_id else None
-    
-    dynamic_prompt = ""
-    # Configuración de IA fija en el código (vía app.config)
-    ai_model = global_model
-    ai_temp = global_temp
-    
-    # Determinar Prompt desde Firestore (único dato dinámico por cliente)
-    if config:
-        if config.get('systemPrompt'):
-            dynamic_prompt = config.get('systemPrompt')
-            print(f"📜 [Sessions] Usando System Prompt desde Firestore para {tenant_id}")
-        elif config.get('role'):
-            from app.base_prompt import BASE_SYSTEM_PROMPT
-            role = config.get('role', 'Asistente Virtual')
-            dynamic_prompt = f"{BASE_SYSTEM_PROMPT}\n\n# CONFIGURACIÓN ESPECÍFICA DEL AGENTE\nRol: {role}"
-            print(f"🤖 [Sessions] Usando rol de Agente Activo para {tenant_id}")
-    
-    if not dynamic_prompt:
-        from app.prompts import get_system_prompt
-        dynamic_prompt = await get_system_prompt()
-        print(f"⚠️ [Sessions] Usando prompt local/default para {tenant_id}")
-
-    # --- ENSAMBLAJE ---
-    history_seed = await format_history_str(chat_id)
-    instruction = dynamic_prompt
-    if history_seed:
-        instruction = f"{dynamic_prompt}\n\n{history_seed}"
-
-    bot_name = os.getenv("BOT_NAME", "travel_assistant")
-    agent_version = os.getenv("AGENT_VERSION", "1.0.0")
 
     if tenant_id:
         os.environ["BITRIX_MEMBER_ID"] = tenant_id
 
-    travel_agent = Agent(
-        name=f"{bot_name}_v{agent_version}_{chat_id}",
-        instruction=instruction,
-        server_names=[], # Vaciamos para no buscar subprocesos
+    factory = await get_agent_factory()
+    proto, snapshot = await asyncio.gather(
+        factory.get_prototype(tenant_id, bot_id),
+        load_snapshot(chat_id),
     )
-
-    # NUEVO: Integración MCP TOTAL In-Process
-    try:
-        from mcp_server import mcp as bitrix_mcp_server
-        # Registramos el servidor completo directamente en el agente
-        # Esto le da acceso a .tools, .resources y .prompts de forma nativa
-        await travel_agent.use_server(bitrix_mcp_server)
-        print(f"🏛️ [Sessions] MCP Server '{bitrix_mcp_server.name}' vinculado exitosamente (In-Process)")
-    except Exception as e:
-        print(f"⚠️ [Sessions] Error integrando servidor MCP local: {e}")
-
-    # Reusar el AgentApp global (ahora es inmediato)
-    from app.context import get_agent_app
-    agent_app = await get_agent_app()
-    
-    # El Agent sí debe entrar en su contexto para inicializarse
-    await travel_agent.__aenter__()
-
-    # Configuración de LLM
-    api_key = global_api_key
-
-    if api_key:
-        masked_key = f"{api_key[:8]}...{api_key[-4:]}"
-        print(f"🔑 [Sessions] Usando API Key GLOBAL: {masked_key}")
-        
-        # Poner en environ por compatibilidad
-        env_var_name = "OPENAI_API_KEY" if llm_provider == "openai" else "GOOGLE_API_KEY"
-        os.environ[env_var_name] = api_key
-        
-        if llm_provider == "openai":
-            import openai
-            openai.api_key = api_key
-            os.environ["OPENAI_DEFAULT_MODEL"] = ai_model
-
-    else:
-        print("❌ [Sessions] CRITICAL: No se encontró API Key GLOBAL!!")
-    
-    llm_kwargs = {
-        "model": ai_model,
-        "temperature": ai_temp,
-        "api_key": api_key
-    }
-    
-    print(f"🔌 [Sessions] Attaching LLM ({llm_provider}): {ai_model} (T={ai_temp})")
-
-    if llm_provider == "openai":
-        factory = partial(OpenAIAugmentedLLM, **llm_kwargs)
-        llm = await travel_agent.attach_llm(llm_factory=factory)
+    _stats["created"] += 1
+    if snapshot is not None and is_compatible(snapshot, proto.provider, proto.config_version):
+        # Chat que vuelve tras desalojo/reinicio/cambio de instancia: historial nativo tal cual
+        llm = factory.create_llm(proto, chat_id)
+        restore_snapshot(llm, proto.instruction, snapshot)
+        _stats["restored"] += 1
     else:
-        factory = partial(GoogleAugmentedLLM, **llm_kwargs)
-        llm = await travel_agent.attach_llm(llm_factory=factory)
+        snapshot = None
+        history_seed = await format_history_str(chat_id)
+        llm = factory.create_llm(proto, chat_id, history_seed)
+        if history_seed:
+            # Sin snapshot utilizable: el contexto se recupera en texto desde app.memory
+            _stats["rehydrated"] += 1
 
+    from app.context import get_agent_app
     session = AgentSession(
-        agent=travel_agent,
+        agent=proto.agent,
         llm=llm,
-        agent_app=agent_app,
+        agent_app=await get_agent_app(),
+        owns_agent=False,
+        instruction=proto.instruction,
+        provider=proto.provider,
+        config_version=proto.config_version,
+        tenant_id=tenant_id or "",
+        bot_id=bot_id,
     )
+    if snapshot is not None:
+        session.crm = dict(snapshot.get("crm") or {})
+        session.last_context = snapshot.get("last_context")
 
-    print(f"  🆕 Nueva sesión creada para chat {chat_id} (provider: {llm_provider})")
+    logger.info(f"🆕 Nueva sesión creada para chat {chat_id} (provider: {proto.provider})")
+    return session
+
+
+def mark_config_changed(tenant_id: str) -> int:
+    """Marca las sesiones vivas del tenant para que tomen la config nueva en su próximo turno."""
+    marked = 0
+    for session in _sessions.values():
+        if session.tenant_id == tenant_id:
+            session.config_stale = True
+            marked += 1
+    return marked
+
+
+async def refresh_session_config(chat_id: str, session: AgentSession) -> AgentSession:
+    """
+    Aplica la config vigente del (tenant, bot) a una sesión marcada (se llama con
+    el lock del chat tomado). Con el mismo proveedor se cambia el system prompt y
+    los parámetros del LLM conservando el historial nativo; si cambió el
+    proveedor, el historial no es compatible y la sesión se recrea.
+    """
+    from app.agent_factory import get_agent_factory
+    session.config_stale = False
+    factory = await get_agent_factory()
+    proto = await factory.get_prototype(session.tenant_id or None, session.bot_id)
+    if proto.config_version == session.config_version:
+        return session
+
+    if proto.provider == session.provider:
+        session.llm.default_request_params = proto.request_params.model_copy(
+            update={"systemPrompt": proto.instruction}
+        )
+        set_system_prompt(session.llm, proto.instruction)
+        session.instruction = proto.instruction
+        session.config_version = proto.config_version
+        _stats["config_updated"] += 1
+        logger.info(f"📝 Sesión de chat {chat_id} actualizada con la config nueva del bot")
+        return session
+
+    await remove_session(chat_id)
+    try:
+        await session.close()
+    except Exception as e:
+        logger.warning(f"⚠️ Error cerrando sesión {chat_id} al cambiar de proveedor: {e}")
+    session = await create_new_session(chat_id)
+    await set_session(chat_id, session)
+    _stats["config_rebuilt"] += 1
     return session
 
 
 def get_session(chat_id: str) -> AgentSession:
-    """Busca una sesión existente en RAM."""
-    return _sessions.get(chat_id)
+    """Busca una sesión existente en RAM (y la marca como la más reciente)."""
+    session = _sessions.get(chat_id)
+    if session is not None:
+        _sessions.move_to_end(chat_id)
+    return session
 
 
 async def set_session(chat_id: str, session: AgentSession):
-    """Guarda una sesión en el cache RAM."""
+    """Guarda una sesión en el cache RAM y aplica los límites de capacidad/memoria."""
+    session.estimate_size()
     async with _global_lock:
         _sessions[chat_id] = session
+        _sessions.move_to_end(chat_id)
+        # La sesión recién guardada se usa enseguida en el turno (aún no está marcada busy)
+        await _enforce_limits(keep=chat_id)
+
+
+async def account_session(chat_id: str):
+    """Recalcula el tamaño de la sesión tras un turno y desaloja si se excede el presupuesto."""
+    session = _sessions.get(chat_id)
+    if session is None:
+        return
+    session.estimate_size()
+    async with _global_lock:
+        await _enforce_limits()
+
+
+def _total_bytes() -> int:
+    return sum(s.estimated_bytes for s in _sessions.values())
+
+
+async def _enforce_limits(keep: str = None):
+    """Desaloja las sesiones menos usadas hasta cumplir MAX_SESSIONS y el presupuesto de bytes.
+    Se llama con _global_lock tomado. Nunca desaloja sesiones busy ni la del chat `keep`.
+    El historial persistente NO se borra: si el chat vuelve, la sesión se re-hidrata desde app.memory."""
+    total = _total_bytes()
+    for cid in list(_sessions):
+        if len(_sessions) <= MAX_SESSIONS and total <= SESSION_MEMORY_BUDGET_BYTES:
+            break
+        session = _sessions[cid]
+        if session.busy or cid == keep:
+            continue
+        del _sessions[cid]
+        total -= session.estimated_bytes
+        _stats["evicted"] += 1
+        try:
+            await session.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Error cerrando sesión desalojada {cid}: {e}")
+        logger.info(f"♻️ Sesión desalojada (LRU) para chat {cid}")
 
 
 async def remove_session(chat_id: str):
     """Elimina una sesión del cache RAM."""
     async with _global_lock:
         return _sessions.pop(chat_id, None)
+
+
+def get_session_stats() -> dict:
+    """Gauges del cache de sesiones: cantidad viva, bytes estimados y contadores."""
+    return {
+        "live_sessions": len(_sessions),
+        "max_sessions": MAX_SESSIONS,
+        "estimated_bytes": _total_bytes(),
+        "budget_bytes": SESSION_MEMORY_BUDGET_BYTES,
+        "busy": sum(1 for s in _sessions.values() if s.busy),
+        **_stats,
+    }
@@ -0,0 +1,311 @@
+"""
+Entrega progresiva de respuestas a Bitrix24 (Open Lines).
+En lugar de esperar a que termine todo el loop agéntico, los deltas de texto del
+LLM se acumulan y se envían al chat en límites de párrafo/oración; las fases de
+tools se muestran como un aviso de progreso. Registra el tiempo hasta el primer
+byte visible (TTFVB) para comparar con la entrega al final.
+"""
+import logging
+import os
+import time
+import asyncio
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+from mcp_agent.workflows.llm.augmented_llm_openai import OpenAIAugmentedLLM, OpenAICompletionTasks
+
+from app.bitrix import send_reply, send_bot_message, update_bot_message, send_typing_indicator
+from app.prompt_cache import record_openai_usage
+from app.tool_scheduler import ParallelToolExecutor
+from app.telemetry import LLM_REQUEST_SECONDS, ERRORS, FALLBACKS
+
+# Opcional: en modo "chunks" cada bloque es un mensaje aparte en el chat
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+# "chunks": un mensaje por bloque (compatible con WhatsApp/Telegram vía Open Lines)
+# "edit":   un solo mensaje que se va editando con imbot.message.update
+STREAM_MODE = os.getenv("STREAM_MODE", "chunks")
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "120"))
+
+_SENTENCE_ENDS = (". ", "! ", "? ", ".\n", "!\n", "?\n")
+
+# Aviso de progreso por familia de tools (prefijo del nombre)
+_TOOL_PROGRESS = (
+    (("catalog_", "deal_add_products"), "🔎 Estoy revisando el catálogo, un momento..."),
+    (("calendar_",), "📅 Estoy revisando la agenda, un momento..."),
+    (("manage_lead", "lead_", "enrich_", "crm_", "contact_", "company_"), "📝 Estoy registrando tu información, un momento..."),
+    (("document_", "drive_"), "📄 Estoy preparando el documento, un momento..."),
+    (("session_transfer", "advisor_notify"), "👤 Te estoy comunicando con un asesor..."),
+)
+_DEFAULT_PROGRESS = "⏳ Un momento, estoy consultando la información..."
+
+# Métricas de tiempo hasta el primer byte visible (ms)
+_ttfvb = {"stream": deque(maxlen=1000), "final": deque(maxlen=1000)}
+_counters = {"turns_streamed": 0, "chunks_sent": 0, "progress_sent": 0, "stream_fallbacks": 0}
+
+
+def record_first_visible(ms: float, streamed: bool):
+    _ttfvb["stream" if streamed else "final"].append(ms)
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return round(ordered[min(int(len(ordered) * pct), len(ordered) - 1)], 1)
+
+
+def get_streaming_stats() -> dict:
+    return {
+        "enabled": STREAM_REPLIES,
+        "mode": STREAM_MODE,
+        **_counters,
+        "ttfvb_ms": {
+            kind: {"count": len(v), "p50": _percentile(v, 0.5), "p95": _percentile(v, 0.95)}
+            for kind, v in _ttfvb.items()
+        },
+    }
+
+
+def progress_label(tool_name: str) -> str:
+    for prefixes, label in _TOOL_PROGRESS:
+        if tool_name.startswith(prefixes):
+            return label
+    return _DEFAULT_PROGRESS
+
+
+def split_ready(buffer: str, min_chars: int = STREAM_MIN_CHARS) -> tuple[str, str, str]:
+    """
+    Separa del buffer la parte lista para enviar (hasta el último párrafo u oración
+    completa). Retorna (listo, resto, separador con el que continúa el texto).
+    """
+    cut = buffer.rfind("\n\n")
+    if cut > 0:
+        return buffer[:cut].strip(), buffer[cut + 2:], "\n\n"
+    if len(buffer) >= min_chars:
+        cut = max(buffer.rfind(end) for end in _SENTENCE_ENDS)
+        if cut > 0:
+            return buffer[:cut + 1].strip(), buffer[cut + 2:], buffer[cut + 1]
+    return "", buffer, ""
+
+
+class ProgressiveReply:
+    """
+    Destino de los deltas de un turno. Los envíos van por una cola con un solo
+    worker para que los bloques lleguen en orden sin frenar la lectura del stream.
+    """
+
+    def __init__(self, access_token: str, client_endpoint: str, dialog_id: str,
+                 chat_id: str = None, session_id: int = None, mode: str = STREAM_MODE):
+        self.access_token = access_token
+        self.client_endpoint = client_endpoint
+        self.dialog_id = dialog_id
+        self.chat_id = chat_id
+        self.session_id = session_id
+        self.mode = mode
+        self.started_at = time.monotonic()
+        self.first_visible_ms: float | None = None
+        self.streamed_text = ""
+        self._buffer = ""
+        self._separator = ""
+        # Bloques emitidos mientras el LLM aún generaba (no desde finish)
+        self._live_blocks = 0
+        self._message_id = None
+        self._progress_sent = False
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: asyncio.Task | None = None
+
+    @property
+    def delivered(self) -> bool:
+        return bool(self.streamed_text)
+
+    async def on_delta(self, text: str):
+        """Delta de texto del LLM: se envía al completar un párrafo u oración."""
+        self._buffer += text
+        ready, self._buffer, separator = split_ready(self._buffer)
+        if ready:
+            self._live_blocks += 1
+            self._enqueue(ready)
+            self._separator = separator
+
+    async def on_tool_start(self, tool_name: str):
+        """Inicio de una tool: se vacía el texto previo y se avisa del progreso (una vez por turno)."""
+        if self._buffer.strip():
+            self._live_blocks += 1
+            self._enqueue(self._buffer.strip())
+            self._buffer = ""
+            self._separator = "\n\n"
+        if not self._progress_sent and not self.streamed_text:
+            self._progress_sent = True
+            _counters["progress_sent"] += 1
+            self._enqueue(progress_label(tool_name), progress=True)
+        elif self.access_token and self.client_endpoint:
+            asyncio.create_task(send_typing_indicator(self.access_token, self.client_endpoint, self.dialog_id, "on"))
+
+    async def finish(self, full_text: str):
+        """
+        Cierra el turno: envía el resto del buffer o, si no salió ningún bloque durante
+        la generación, la respuesta completa como un solo mensaje.
+        """
+        if self._live_blocks:
+            if self._buffer.strip():
+                self._enqueue(self._buffer.strip())
+        elif full_text or self._buffer.strip():
+            # Sin stream (proveedor sin streaming, error o respuesta corta): un mensaje
+            self._enqueue((full_text or self._buffer).strip())
+        self._buffer = ""
+        if self._worker:
+            await self._queue.join()
+            self._worker.cancel()
+        if self._live_blocks:
+            _counters["turns_streamed"] += 1
+
+    def _enqueue(self, text: str, progress: bool = False):
+        if not progress:
+            self.streamed_text = f"{self.streamed_text}{self._separator or chr(10) * 2}{text}" if self.streamed_text else text
+            self._separator = ""
+        self._queue.put_nowait((text, progress))
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._send_loop())
+
+    async def _send_loop(self):
+        while True:
+            text, progress = await self._queue.get()
+            try:
+                if await self._deliver(text, progress) and self.first_visible_ms is None:
+                    self.first_visible_ms = (time.monotonic() - self.started_at) * 1000
+                    record_first_visible(self.first_visible_ms, streamed=self._live_blocks > 0 or self._progress_sent)
+                    logger.info(f"⚡ [Streaming] Primer byte visible en {self.first_visible_ms:.0f} ms ({self.dialog_id})")
+            except Exception as e:
+                logger.warning(f"⚠️ [Streaming] Error enviando bloque: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, text: str, progress: bool) -> bool:
+        if self.mode == "edit":
+            # Un solo mensaje: el aviso de progreso se reemplaza por el texto
+            body = text if progress else self.streamed_text
+            if self._message_id is None:
+                self._message_id = await send_bot_message(self.access_token, self.client_endpoint, self.dialog_id, body)
+                return bool(self._message_id)
+            return await update_bot_message(self.access_token, self.client_endpoint, self._message_id, body)
+
+        _counters["chunks_sent"] += 0 if progress else 1
+        return await send_reply(self.access_token, self.client_endpoint, self.dialog_id, text,
+                                chat_id=self.chat_id, session_id=self.session_id)
+
+
+# ─── Streaming de OpenAI dentro del loop de mcp-agent ─────────────
+
+_openai_clients: dict[tuple, AsyncOpenAI] = {}
+
+
+def _openai_client(config) -> AsyncOpenAI:
+    """Cliente AsyncOpenAI compartido por (api_key, base_url) para reusar conexiones."""
+    key = (config.api_key, getattr(config, "base_url", None))
+    client = _openai_clients.get(key)
+    if client is None:
+        client = _openai_clients[key] = AsyncOpenAI(
+            api_key=config.api_key,
+            base_url=getattr(config, "base_url", None),
+            default_headers=getattr(config, "default_headers", None),
+        )
+    return client
+
+
+class _StreamingExecutor:
+    """Envuelve el executor de mcp-agent: solo intercepta la llamada de completion (stream + usage)."""
+
+    def __init__(self, base, llm: "StreamingOpenAIAugmentedLLM"):
+        self._base = base
+        self._llm = llm
+
+    def __getattr__(self, name):
+        return getattr(self._base, name)
+
+    async def execute(self, task, *args, **kwargs):
+        if task is not OpenAICompletionTasks.request_completion_task:
+            return await self._base.execute(task, *args, **kwargs)
+        started = time.perf_counter()
+        if self._llm.stream_sink is not None:
+            response = await self._llm._stream_completion(task, *args, **kwargs)
+        else:
+            response = await self._base.execute(task, *args, **kwargs)
+        model = args[0].payload.get("model") if args else None
+        LLM_REQUEST_SECONDS.labels("openai", model or "unknown").observe(time.perf_counter() - started)
+        if isinstance(response, BaseException):
+            ERRORS.labels("llm").inc()
+        else:
+            record_openai_usage(response)
+        return response
+
+
+class StreamingOpenAIAugmentedLLM(OpenAIAugmentedLLM):
+    """
+    OpenAIAugmentedLLM que, si tiene un `stream_sink` (ProgressiveReply) asignado,
+    pide la completion con stream=True y reenvía los deltas mientras arma el
+    ChatCompletion que el loop de mcp-agent espera. Sin sink se comporta igual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream_sink: ProgressiveReply | None = None
+        self.executor = _StreamingExecutor(ParallelToolExecutor(self.executor), self)
+
+    async def pre_tool_call(self, tool_call_id, request):
+        if self.stream_sink is not None:
+            await self.stream_sink.on_tool_start(request.params.name)
+        return await super().pre_tool_call(tool_call_id, request)
+
+    async def _stream_completion(self, task, request, *args, **kwargs):
+        sink = self.stream_sink
+        emitted = False
+        try:
+            payload = {**request.payload, "stream": True, "stream_options": {"include_usage": True}}
+            stream = await _openai_client(request.config).chat.completions.create(**payload)
+
+            completion = {"id": "", "created": 0, "model": payload.get("model"), "usage": None}
+            content, tool_calls, finish_reason = [], {}, None
+            async for chunk in stream:
+                completion.update(id=chunk.id, created=chunk.created, model=chunk.model)
+                if chunk.usage:
+                    completion["usage"] = chunk.usage.model_dump()
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                delta = choice.delta
+                if delta.content:
+                    content.append(delta.content)
+                    emitted = True
+                    await sink.on_delta(delta.content)
+                for tc in delta.tool_calls or []:
+                    call = tool_calls.setdefault(tc.index, {"id": None, "type": "function",
+                                                            "function": {"name": "", "arguments": ""}})
+                    if tc.id:
+                        call["id"] = tc.id
+                    if tc.function and tc.function.name:
+                        call["function"]["name"] += tc.function.name
+                    if tc.function and tc.function.arguments:
+                        call["function"]["arguments"] += tc.function.arguments
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+
+            message = {"role": "assistant", "content": "".join(content) or None}
+            if tool_calls:
+                message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+            return ChatCompletion.model_validate({
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason or "stop"}],
+                "usage": completion["usage"] or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+        except Exception as e:
+            if emitted:
+                return e
+            # Nada visible todavía: reintentar por la ruta normal (sin stream)
+            _counters["stream_fallbacks"] += 1
+            FALLBACKS.labels("llm_stream").inc()
+            logger.warning(f"⚠️ [Streaming] Falló el stream ({e}); usando completion normal")
+            return await self.executor._base.execute(task, request, *args, **kwargs)
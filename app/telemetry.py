@@ -0,0 +1,172 @@
+"""
+Métricas en proceso expuestas en formato Prometheus (`GET /metrics`).
+Registro mínimo y sin dependencias: contadores e histogramas con labels, cuya
+API (`.labels(...).observe()/.inc()`) es la de prometheus_client. Cada
+observación es una búsqueda binaria sobre los buckets y un par de sumas en el
+event loop (sin locks ni I/O), así que se puede dejar activo en producción.
+
+Cubre el camino completo de un mensaje: parseo del webhook, espera del lock del
+chat, creación de sesión, latencia del LLM por proveedor/modelo, tools,
+llamadas REST a Bitrix por método y envío de la respuesta; más contadores de
+errores, fallbacks y refresh de tokens.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Buckets (segundos) pensados para el rango de cada operación
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+_registry: list = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, object] = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: se esperaban labels {self.labelnames}, llegaron {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._lines(values, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _lines(self, values, child):
+        return [f"{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _lines(self, values, child):
+        lines, cumulative = [], 0
+        for bound, count in zip((*self.buckets, float("inf")), child.counts):
+            cumulative += count
+            le = f'le="{"+Inf" if bound == float("inf") else repr(float(bound))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {repr(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Todas las métricas en formato de exposición de Prometheus (text/plain 0.0.4)."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# ─── Métricas del camino de un mensaje ────────────────────────────
+
+WEBHOOK_PARSE_SECONDS = Histogram(
+    "aibot_webhook_parse_seconds", "Parseo del webhook de Bitrix24 (body del request y evento)",
+    ("stage",), buckets=FAST_BUCKETS)
+CHAT_LOCK_WAIT_SECONDS = Histogram(
+    "aibot_chat_lock_wait_seconds", "Espera hasta obtener el lock del chat (local: turno dentro de la instancia; redis: cola entre instancias)",
+    ("path",), buckets=SLOW_BUCKETS)
+SESSION_CREATE_SECONDS = Histogram(
+    "aibot_session_create_seconds", "Creación de una sesión de agente nueva")
+LLM_REQUEST_SECONDS = Histogram(
+    "aibot_llm_request_seconds", "Latencia de cada request de completion al LLM",
+    ("provider", "model"), buckets=SLOW_BUCKETS)
+TOOL_SECONDS = Histogram(
+    "aibot_tool_seconds", "Ejecución de tools del MCP server", ("tool", "status"))
+BITRIX_REQUEST_SECONDS = Histogram(
+    "aibot_bitrix_request_seconds", "Llamadas REST a Bitrix24 por método (incluye reintentos)",
+    ("method", "status"))
+REPLY_SEND_SECONDS = Histogram(
+    "aibot_reply_send_seconds", "Envío de la respuesta a Bitrix24", ("method", "status"))
+
+ERRORS = Counter("aibot_errors", "Errores por componente", ("component",))
+FALLBACKS = Counter("aibot_fallbacks", "Caminos de respaldo tomados", ("kind",))
+TOKEN_REFRESHES = Counter("aibot_token_refreshes", "Refresh de tokens OAuth de Bitrix24", ("result",))
@@ -3,20 +3,39 @@ Gestor centralizado de tokens OAuth de Bitrix24.
 Fuente única de verdad para todos los tokens, con refresh automático.
 Usa Redis para compartir estado entre procesos (main y mcp_server).
 """
+import logging
 import os
-import sys
+import uuid
+import asyncio
 import httpx
 import json
 from datetime import datetime, timedelta
-import sys
 
-# Redirect all prints to stderr to avoid breaking MCP protocol
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
+logger = logging.getLogger(__name__)
 
 from app.auth import update_env_file
+from app.local_cache import get_cache
+from app.telemetry import TOKEN_REFRESHES
+
+# Margen con el que get_token considera vencido un token (ruta de la petición)
+TOKEN_EXPIRY_MARGIN = 300
+# El refresco proactivo renueva antes de llegar a ese margen
+TOKEN_PROACTIVE_MARGIN = int(os.getenv("TOKEN_PROACTIVE_MARGIN", "900"))
+TOKEN_PROACTIVE_INTERVAL = int(os.getenv("TOKEN_PROACTIVE_INTERVAL", "60"))
+TOKEN_REFRESH_LOCK_TTL_MS = int(os.getenv("TOKEN_REFRESH_LOCK_TTL_MS", "30000"))
+CHAT_MAP_TTL = 3600 * 24
+# Cada cuánto se renueva el TTL del mapeo chat→tenant en Redis mientras el chat sigue activo
+CHAT_MAP_REFRESH = int(os.getenv("CHAT_MAP_REFRESH", "3600"))
+# Campos del hash bitrix24:{domain}:auth (antes eran claves sueltas)
+AUTH_FIELDS = ("access_token", "refresh_token", "expires_at", "domain")
+
+# Libera el lock solo si sigue siendo nuestro
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 class TokenManager:
     """Gestiona tokens OAuth con Redis como backend y Firestore como fuente de verdad."""
@@ -24,6 +43,18 @@ class TokenManager:
     def __init__(self):
         self._redis = None
         self._http_client = None
+        # Singleflight: un solo refresh en vuelo por tenant dentro del proceso
+        self._inflight: dict[str, asyncio.Task] = {}
+        # Tenants vistos por este proceso (para el refresco proactivo)
+        self._known_tenants: set[str] = set()
+        self._proactive_task: asyncio.Task | None = None
+        self.refresh_count = 0
+        # Caché L1 del proceso delante de Redis
+        self._tokens_l1 = get_cache("tokens", maxsize=1024, ttl=30)
+        self._domains_l1 = get_cache("domains", maxsize=1024, ttl=300)
+        self._chats_l1 = get_cache("chat_tenant", maxsize=10000, ttl=300)
+        # Mapeos escritos en Redis por este proceso (con TTL completo) hace menos de CHAT_MAP_REFRESH
+        self._chats_written = get_cache("chat_tenant_written", maxsize=10000, ttl=CHAT_MAP_REFRESH)
     
     def _get_redis_key(self, member_id: str, suffix: str) -> str:
         return f"bitrix24:{member_id}:{suffix}"
@@ -46,12 +77,54 @@ class TokenManager:
         return val
 
     async def get_member_id_from_chat(self, chat_id: int) -> str:
-        """Busca el member_id asociado a un chat_id en Redis."""
+        """Busca el member_id asociado a un chat_id (L1 y luego Redis)."""
         if not chat_id:
             return None
+        chat_id = str(chat_id)
+        m_id = self._chats_l1.get(chat_id)
+        if m_id:
+            return m_id
+        redis = await self._get_redis()
+        m_id = self._get_val(await redis.get(f"map:chat_to_member:{chat_id}"))
+        if m_id:
+            self._chats_l1.set(chat_id, m_id)
+        return m_id
+
+    async def set_member_for_chat(self, chat_id, member_id: str):
+        """
+        Guarda el mapeo chat_id -> tenant. Solo se omite la escritura en Redis si este
+        proceso ya la hizo hace menos de CHAT_MAP_REFRESH (valor igual y TTL casi
+        completo); que L1 lo tenga no basta, porque pudo cargarse de Redis sin renovar
+        el TTL y la clave expiraría con el chat activo.
+        """
+        if not chat_id or not member_id:
+            return
+        chat_id = str(chat_id)
+        if self._chats_written.get(chat_id) == member_id:
+            return
         redis = await self._get_redis()
-        val = await redis.get(f"map:chat_to_member:{chat_id}")
-        return self._get_val(val)
+        await redis.set(f"map:chat_to_member:{chat_id}", member_id, ex=CHAT_MAP_TTL)
+        self._chats_l1.set(chat_id, member_id)
+        self._chats_written.set(chat_id, member_id)
+
+    def invalidate_chat(self, chat_id):
+        self._chats_l1.invalidate(str(chat_id))
+        self._chats_written.invalidate(str(chat_id))
+
+    def invalidate_tenant(self, member_id: str):
+        """Descarta token y dominio del tenant en L1 (la próxima lectura va a Redis)."""
+        self._tokens_l1.invalidate(member_id)
+        self._domains_l1.invalidate(member_id)
+
+    async def list_tenants(self) -> list[str]:
+        """Tenants instalados: los que tienen credenciales en Redis (`bitrix24:{m}:auth`)."""
+        redis = await self._get_redis()
+        if not hasattr(redis, "scan_iter"):
+            return sorted(self._known_tenants)
+        tenants = set(self._known_tenants)
+        async for key in redis.scan_iter(match=self._get_redis_key("*", "auth"), count=500):
+            tenants.add(key.split(":", 1)[1].rsplit(":", 1)[0])
+        return sorted(tenants)
 
     async def get_member_id(self) -> str:
         """Obtiene el member_id del contexto actual."""
@@ -97,16 +170,12 @@ class TokenManager:
         if not member_id:
             raise ValueError("No se pudo determinar el member_id para obtener el token")
 
-        redis = await self._get_redis()
-        
+        self._known_tenants.add(member_id)
+
         # 1. Intentar Redis
-        access = self._get_val(await redis.get(self._get_redis_key(member_id, "access_token")))
-        expires_at_str = self._get_val(await redis.get(self._get_redis_key(member_id, "expires_at")))
-        
-        if access and expires_at_str:
-            expires_at = float(expires_at_str)
-            if datetime.now().timestamp() + 300 < expires_at:
-                return access
+        access, expires_at = await self._read_cached_token(member_id)
+        if access and datetime.now().timestamp() + TOKEN_EXPIRY_MARGIN < expires_at:
+            return access
 
         # 2. Si no hay en Redis o expirado, intentar Firestore
         tokens = await self._fetch_from_firestore(member_id)
@@ -115,11 +184,11 @@ class TokenManager:
             await self._sync_to_redis(member_id, tokens)
             
             # Verificar si el de Firestore también expiró
-            if datetime.now().timestamp() + 300 < tokens['expires_at']:
+            if datetime.now().timestamp() + TOKEN_EXPIRY_MARGIN < tokens['expires_at']:
                 return tokens['access_token']
 
         # 3. Si todo falló o expiró, refrescar
-        sys.stderr.write(f"🔄 Refrescando token para tenant {member_id}...\n")
+        logger.info(f"🔄 Refrescando token para tenant {member_id}...")
         return await self._refresh_token(member_id)
 
     async def _fetch_from_firestore(self, domain: str) -> dict:
@@ -128,7 +197,7 @@ class TokenManager:
         fs = await get_firestore_config()
 
         if not fs._async_db:
-             print("❌ [TokenManager] AsyncClient not ready.")
+             logger.error("❌ [TokenManager] AsyncClient not ready.")
              return None
 
         # 1. Fetch Installation Data by Domain directly
@@ -146,28 +215,151 @@ class TokenManager:
                         'domain': data.get('domain', domain)
                     }
             else:
-                print(f"❌ [TokenManager] No se encontró instalación para el dominio: {domain}")
+                logger.error(f"❌ [TokenManager] No se encontró instalación para el dominio: {domain}")
         except Exception as e:
-            print(f"❌ [TokenManager] Error fetching from firestore: {e}")
+            logger.error(f"❌ [TokenManager] Error fetching from firestore: {e}")
             
         return None
 
+    async def _read_auth(self, member_id: str, use_local: bool = True) -> dict:
+        """
+        Credenciales del tenant desde el hash `bitrix24:{member_id}:auth` (un solo HGETALL).
+        Migra las claves sueltas de versiones anteriores si el hash aún no existe.
+        """
+        if use_local:
+            cached = self._tokens_l1.get(member_id)
+            if cached is not None:
+                return cached
+
+        redis = await self._get_redis()
+        auth_key = self._get_redis_key(member_id, "auth")
+        auth = await redis.hgetall(auth_key) or {}
+        if not auth:
+            legacy = {f: await redis.get(self._get_redis_key(member_id, f)) for f in AUTH_FIELDS}
+            auth = {f: v for f, v in legacy.items() if v}
+            if auth:
+                await redis.hset(auth_key, mapping=auth)
+        auth = {self._get_val(k): self._get_val(v) for k, v in auth.items()}
+
+        if auth:
+            self._cache_auth(member_id, auth)
+        return auth
+
+    def _cache_auth(self, member_id: str, auth: dict):
+        # Nunca servir desde L1 un token que get_token ya consideraría vencido
+        remaining = float(auth.get("expires_at") or 0) - datetime.now().timestamp() - TOKEN_EXPIRY_MARGIN
+        self._tokens_l1.set(member_id, auth, ttl=min(self._tokens_l1.ttl, remaining))
+        if auth.get("domain"):
+            self._domains_l1.set(member_id, auth["domain"])
+
+    async def get_domain(self, member_id: str) -> str | None:
+        """Dominio del portal del tenant (L1 y luego hash de Redis)."""
+        if not member_id:
+            return None
+        domain = self._domains_l1.get(member_id)
+        if domain:
+            return domain
+        return (await self._read_auth(member_id)).get("domain")
+
     async def _sync_to_redis(self, member_id: str, tokens: dict):
         redis = await self._get_redis()
-        await redis.set(self._get_redis_key(member_id, "access_token"), tokens['access_token'])
-        await redis.set(self._get_redis_key(member_id, "refresh_token"), tokens['refresh_token'])
-        await redis.set(self._get_redis_key(member_id, "expires_at"), str(int(tokens['expires_at'])))
+        auth = {
+            "access_token": tokens['access_token'],
+            "refresh_token": tokens['refresh_token'],
+            "expires_at": str(int(tokens['expires_at'])),
+        }
         if tokens.get('domain'):
-            await redis.set(self._get_redis_key(member_id, "domain"), tokens['domain'])
+            auth["domain"] = tokens['domain']
+        await redis.hset(self._get_redis_key(member_id, "auth"), mapping=auth)
+        self._tokens_l1.invalidate(member_id)
+        await self._read_auth(member_id, use_local=False)
 
-    async def force_refresh(self, member_id: str = None):
+    async def _read_cached_token(self, member_id: str, use_local: bool = True) -> tuple[str | None, float]:
+        """(access_token, expires_at) del tenant; expires_at es 0 si no existe."""
+        auth = await self._read_auth(member_id, use_local=use_local)
+        return auth.get("access_token"), float(auth.get("expires_at") or 0)
+
+    async def force_refresh(self, member_id: str = None, stale_token: str = None):
+        """
+        Fuerza un refresh. Si se indica `stale_token` (el que Bitrix rechazó) y otro
+        coroutine/instancia ya lo reemplazó, retorna el nuevo sin volver a refrescar.
+        """
         if not member_id:
             member_id = await self.get_member_id()
-        return await self._refresh_token(member_id)
+        self.invalidate_tenant(member_id)
+        access, expires_at = await self._read_cached_token(member_id, use_local=False)
+        if stale_token is None:
+            # Sin token de referencia: el actual es el que se considera vencido
+            stale_token = access
+        elif access and access != stale_token and datetime.now().timestamp() < expires_at:
+            return access
+        return await self._refresh_token(member_id, stale_token)
 
-    async def _refresh_token(self, member_id: str):
+    async def _refresh_token(self, member_id: str, stale_token: str = None, min_remaining: int = TOKEN_EXPIRY_MARGIN):
+        """
+        Singleflight: todos los que piden refresh para el tenant esperan la misma tarea.
+        `min_remaining`: segundos de vida por debajo de los cuales el token se renueva
+        (TOKEN_PROACTIVE_MARGIN en el refresco proactivo).
+        """
+        task = self._inflight.get(member_id)
+        if task is None:
+            task = asyncio.create_task(self._refresh_with_lock(member_id, stale_token, min_remaining))
+            self._inflight[member_id] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(member_id, None))
+        # shield: si un llamador se cancela, el refresh sigue para los demás
+        return await asyncio.shield(task)
+
+    def _is_fresh(self, access: str, expires_at: float, stale_token: str = None,
+                  min_remaining: int = TOKEN_EXPIRY_MARGIN) -> bool:
+        """Token válido fuera del margen y distinto del que se reportó como vencido."""
+        return bool(access) and access != stale_token and datetime.now().timestamp() + min_remaining < expires_at
+
+    async def _refresh_with_lock(self, member_id: str, stale_token: str = None,
+                                 min_remaining: int = TOKEN_EXPIRY_MARGIN):
+        """
+        Lock en Redis (SET NX PX) para que una sola instancia llame a oauth.bitrix.info.
+        Las demás esperan a que aparezca el token nuevo en Redis.
+        """
         redis = await self._get_redis()
-        refresh_token = self._get_val(await redis.get(self._get_redis_key(member_id, "refresh_token")))
+        lock_key = f"lock:token_refresh:{member_id}"
+        lock_id = uuid.uuid4().hex
+        deadline = asyncio.get_running_loop().time() + TOKEN_REFRESH_LOCK_TTL_MS / 1000
+
+        while True:
+            acquired = await redis.set(lock_key, lock_id, nx=True, px=TOKEN_REFRESH_LOCK_TTL_MS)
+            if acquired:
+                try:
+                    # Otra instancia pudo refrescar justo antes de que tomáramos el lock
+                    access, expires_at = await self._read_cached_token(member_id, use_local=False)
+                    if self._is_fresh(access, expires_at, stale_token, min_remaining):
+                        return access
+                    try:
+                        return await self._do_refresh(member_id)
+                    except Exception:
+                        TOKEN_REFRESHES.labels("error").inc()
+                        raise
+                finally:
+                    await self._release_lock(redis, lock_key, lock_id)
+
+            # Otra instancia está refrescando: esperar su resultado
+            await asyncio.sleep(0.2)
+            access, expires_at = await self._read_cached_token(member_id, use_local=False)
+            if self._is_fresh(access, expires_at, stale_token, min_remaining):
+                return access
+            if asyncio.get_running_loop().time() > deadline:
+                raise ValueError(f"Timeout esperando el refresh de token de otra instancia ({member_id})")
+
+    async def _release_lock(self, redis, lock_key: str, lock_id: str):
+        try:
+            if hasattr(redis, "eval"):
+                await redis.eval(_RELEASE_LOCK_LUA, 1, lock_key, lock_id)
+            elif hasattr(redis, "delete"):
+                await redis.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"⚠️ [TokenManager] Error liberando lock de refresh: {e}")
+
+    async def _do_refresh(self, member_id: str):
+        refresh_token = (await self._read_auth(member_id, use_local=False)).get("refresh_token")
         
         if not refresh_token:
             tokens = await self._fetch_from_firestore(member_id)
@@ -213,7 +405,44 @@ class TokenManager:
                 'expiresAt': int(new_tokens['expires_at'] * 1000) # Dashboard suele usar ms
             })
         
+        self.refresh_count += 1
+        TOKEN_REFRESHES.labels("ok").inc()
+        logger.info(f"🔑 [TokenManager] Token renovado para {member_id}")
         return new_tokens['access_token']
+
+    # ─── Refresco proactivo ───────────────────────────────────────
+
+    def start_proactive_refresh(self):
+        """Inicia el loop que renueva tokens antes de que la ruta de la petición los vea vencidos."""
+        if self._proactive_task is None or self._proactive_task.done():
+            self._proactive_task = asyncio.create_task(self._proactive_refresh_loop())
+
+    async def stop_proactive_refresh(self):
+        if self._proactive_task:
+            self._proactive_task.cancel()
+            try:
+                await self._proactive_task
+            except asyncio.CancelledError:
+                pass
+            self._proactive_task = None
+
+    async def _proactive_refresh_loop(self):
+        while True:
+            await asyncio.sleep(TOKEN_PROACTIVE_INTERVAL)
+            for member_id in list(self._known_tenants):
+                try:
+                    _access, expires_at = await self._read_cached_token(member_id, use_local=False)
+                    if expires_at and datetime.now().timestamp() + TOKEN_PROACTIVE_MARGIN >= expires_at:
+                        await self._refresh_token(member_id, min_remaining=TOKEN_PROACTIVE_MARGIN)
+                except Exception as e:
+                    logger.warning(f"⚠️ [TokenManager] Refresco proactivo falló para {member_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "known_tenants": len(self._known_tenants),
+            "refreshes": self.refresh_count,
+            "inflight": list(self._inflight),
+        }
 async def get_token_manager() -> TokenManager:
     global _token_manager
     if globals().get("_token_manager") is None:
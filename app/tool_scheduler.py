@@ -0,0 +1,145 @@
+"""
+Orden y traza de las tool calls de un mismo paso del LLM.
+El executor de mcp-agent ya lanza todas las tool calls de un paso a la vez
+(asyncio.gather); aquí se dividen en etapas para que las tools que escriben en
+el CRM sean barreras explícitas: esperan a que terminen las llamadas anteriores
+del paso y las siguientes esperan por ellas. Cada etapa se ejecuta con el
+execute_many del executor (conserva su contexto y su límite de actividades),
+con un tope adicional de concurrencia por tenant. Los resultados se devuelven
+en el orden original y cada paso deja una traza con el solapamiento logrado.
+"""
+import logging
+import os
+import time
+import asyncio
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+TOOL_MAX_PARALLEL_PER_TENANT = int(os.getenv("TOOL_MAX_PARALLEL_PER_TENANT", "4"))
+
+# Tools de solo lectura: pueden correr en paralelo entre sí.
+# Cualquier otra (manage_lead, lead_convert, deal_add_products, calendar_event_create,
+# session_transfer...) o una tool desconocida se trata como mutación y se ordena.
+READ_ONLY_TOOLS = frozenset({
+    "lead_get", "contact_get", "company_get", "deal_get", "deal_list",
+    "crm_fields_get", "crm_stages_list", "crm_activity_list", "task_list",
+    "calendar_event_list", "calendar_event_get", "calendar_availability_check",
+    "catalog_product_list", "catalog_product_get", "catalog_product_search",
+    "document_list", "document_download", "drive_file_list", "drive_file_download",
+    "session_crm_get", "session_operator_list", "session_queue_info", "session_history_read",
+})
+
+_semaphores: dict[str, asyncio.Semaphore] = {}
+_stats = defaultdict(float)
+
+
+def _tenant_semaphore(tenant_id: str) -> asyncio.Semaphore:
+    semaphore = _semaphores.get(tenant_id)
+    if semaphore is None:
+        semaphore = _semaphores[tenant_id] = asyncio.Semaphore(TOOL_MAX_PARALLEL_PER_TENANT)
+    return semaphore
+
+
+def tool_name_of(task) -> str | None:
+    """Nombre de la tool de una tarea de mcp-agent (partial de OpenAI o corrutina de Google)."""
+    tool_call = getattr(task, "keywords", {}).get("tool_call")
+    if tool_call is not None:
+        return tool_call.function.name
+    frame = getattr(task, "cr_frame", None)
+    function_call = frame.f_locals.get("function_call") if frame else None
+    return getattr(function_call, "name", None)
+
+
+def plan_stages(names: list) -> list[list[int]]:
+    """
+    Agrupa los índices en etapas que se ejecutan una tras otra: las lecturas
+    consecutivas comparten etapa y cada mutación va sola.
+    """
+    stages, current = [], []
+    for i, name in enumerate(names):
+        if name in READ_ONLY_TOOLS:
+            current.append(i)
+            continue
+        if current:
+            stages.append(current)
+            current = []
+        stages.append([i])
+    if current:
+        stages.append(current)
+    return stages
+
+
+async def run_tool_calls(tasks: list, execute_many, tenant_id: str = None) -> list:
+    """
+    Ejecuta las tool calls de un paso respetando etapas y el tope del tenant.
+    `execute_many` es el del executor de mcp-agent: cada etapa pasa por él.
+    """
+    if tenant_id is None:
+        from app.context_vars import member_id_var
+        tenant_id = member_id_var.get() or "unknown"
+    names = [tool_name_of(t) for t in tasks]
+    semaphore = _tenant_semaphore(tenant_id)
+    results: list = [None] * len(tasks)
+    spans: list = [None] * len(tasks)
+    started = time.perf_counter()
+
+    async def run(i: int):
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                task = tasks[i]
+                return await (task() if callable(task) else task)
+            finally:
+                spans[i] = (t0 - started, time.perf_counter() - started)
+
+    for stage in plan_stages(names):
+        # El executor captura las excepciones de cada tarea y las devuelve como resultado
+        for i, result in zip(stage, await execute_many([run(i) for i in stage])):
+            results[i] = result
+
+    _trace(tenant_id, names, spans, time.perf_counter() - started)
+    return results
+
+
+def _trace(tenant_id: str, names: list, spans: list, wall: float):
+    busy = sum(end - start for start, end in spans)
+    _stats["steps"] += 1
+    _stats["calls"] += len(names)
+    _stats["busy_ms"] += busy * 1000
+    _stats["wall_ms"] += wall * 1000
+    if len(names) < 2:
+        return
+    _stats["multi_call_steps"] += 1
+    _stats["multi_busy_ms"] += busy * 1000
+    _stats["multi_wall_ms"] += wall * 1000
+    timeline = ", ".join(
+        f"{name}[{start * 1000:.0f}-{end * 1000:.0f}ms]" for name, (start, end) in zip(names, spans)
+    )
+    logger.info(f"🧵 [Tools] {tenant_id}: {len(names)} calls en {wall * 1000:.0f} ms "
+          f"(secuencial {busy * 1000:.0f} ms, solapamiento x{busy / wall if wall else 1:.2f}): {timeline}")
+
+
+def get_tool_stats() -> dict:
+    multi_wall = _stats["multi_wall_ms"]
+    return {
+        "max_parallel_per_tenant": TOOL_MAX_PARALLEL_PER_TENANT,
+        **{k: round(v, 1) for k, v in _stats.items()},
+        # Tiempo de tools de los pasos con varias calls / tiempo real: 1.0 = sin solapamiento
+        "overlap": round(_stats["multi_busy_ms"] / multi_wall, 2) if multi_wall else 1.0,
+    }
+
+
+class ParallelToolExecutor:
+    """Envuelve el executor de mcp-agent: las tool calls de un paso se ordenan por etapas con run_tool_calls."""
+
+    def __init__(self, base):
+        self._base = base
+
+    def __getattr__(self, name):
+        return getattr(self._base, name)
+
+    async def execute_many(self, tasks, *args, **kwargs):
+        if not tasks or args or kwargs:
+            return await self._base.execute_many(tasks, *args, **kwargs)
+        return await run_tool_calls(list(tasks), self._base.execute_many)
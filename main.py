@@ -1,18 +1,25 @@
 """
 Bot Viajes — Webhook de Bitrix24 con agente AI (Gemini via mcp-agent).
 Punto de entrada principal del servidor FastAPI.
-Usa fire-and-forget para no bloquear al recibir eventos concurrentes.
+Los eventos se encolan en una cola de ingesta durable (app.ingestion) y se
+procesan en background por un pool de workers acotado.
 """
 # --- MONKEYPATCH START ---
 # Fix: mcp-agent filters env vars by default. We need to pass ALL env vars (Cloud Run injection).
+import logging
 import os
 import mcp.client.stdio
 
+# Logging estructurado a stderr (app.log); se configura antes de cualquier otro log
+from app.log import setup_logging, bind_request, debug_sampled
+setup_logging()
+logger = logging.getLogger(__name__)
+
 def _get_all_env() -> dict[str, str]:
     return os.environ.copy()
 
 mcp.client.stdio.get_default_environment = _get_all_env
-print("🔧 Monkeypatched mcp.client.stdio.get_default_environment to pass all env vars.")
+logger.info("🔧 Monkeypatched mcp.client.stdio.get_default_environment to pass all env vars.")
 # --- MONKEYPATCH END ---
 
 # Cargar variables de entorno solo si existe el archivo (local dev)
@@ -22,19 +29,30 @@ if os.path.exists(env_file):
     try:
         from dotenv import load_dotenv
         load_dotenv(env_file)
-        print("📁 .env cargado para desarrollo local")
+        logger.info("📁 .env cargado para desarrollo local")
     except Exception:
         pass
 
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 import uvicorn
+import hmac
+import time
 import asyncio
 
-from app.bitrix import BOT_ID, extract_event_data, send_reply
+from app.bitrix import BOT_ID, extract_event_data, parse_event, send_reply
+from app.coalescer import ChatCoalescer
+from app.telemetry import WEBHOOK_PARSE_SECONDS
 from app import agent
 
 server = FastAPI(title="Bot Viajes", version="1.0.0")
 
+# Secreto compartido de los endpoints de administración (/cache/*); sin él quedan deshabilitados
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Coalescencia de mensajes por chat (se inicializa en startup)
+_coalescer: ChatCoalescer | None = None
+
 
 @server.on_event("startup")
 async def startup():
@@ -48,14 +66,17 @@ async def startup():
     await get_redis()
     
     # 2. Init Tokens
-    await get_token_manager()
-    print("🚀 [Startup] TokenManager listo")
+    tm = await get_token_manager()
+    tm.start_proactive_refresh()
+    logger.info("🚀 [Startup] TokenManager listo")
     
     # 3. Init Config & Firestore
     from app.config import config
     config.print_summary()
+    from app.memory import init_summarizer
+    init_summarizer()
     fs = await get_firestore_config()
-    fs.start_listener()
+    await fs.start_listener()
     await fs.warmup()
     
     # 4. Init MCP AgentApp Global (El motor de la IA)
@@ -64,11 +85,31 @@ async def startup():
     
     # 5. Background Tasks
     asyncio.create_task(_global_session_cleanup_loop())
+
+    # Precarga opcional de datos de referencia (campos, etapas, catálogos...) por tenant
+    from app.reference_cache import REFERENCE_WARMUP, get_reference_cache
+    if REFERENCE_WARMUP:
+        reference_cache = await get_reference_cache()
+        asyncio.create_task(reference_cache.warmup_all())
+
+    # Sincronización opcional del índice de productos (si no, se sincroniza en la primera búsqueda)
+    from app.product_index import PRODUCT_INDEX_WARMUP, get_product_catalog
+    if PRODUCT_INDEX_WARMUP:
+        asyncio.create_task(get_product_catalog().warmup_all())
+
+    # 6. Cola de ingesta (workers que consumen eventos del webhook)
+    #    Los mensajes de un mismo chat se fusionan antes de llegar al LLM.
+    from app.ingestion import get_ingestion_queue
+    global _coalescer
+    ingestion = await get_ingestion_queue()
+    # Los slots de concurrencia (global y por tenant) se toman solo durante el turno
+    _coalescer = ChatCoalescer(ingestion.limited(handle_message))
+    await ingestion.start(_coalescer.submit)
     
     # Start System Metrics
     metrics = await MetricsService.get_instance()
     await metrics.start_system_metrics_logger()
-    print("✨ [SYSTEM READY] Bot totalmente cargado y pre-calentado.")
+    logger.info("✨ [SYSTEM READY] Bot totalmente cargado y pre-calentado.")
 
 async def _global_session_cleanup_loop():
     """Limpia sesiones expiradas cada 5 minutos en segundo plano."""
@@ -78,15 +119,52 @@ async def _global_session_cleanup_loop():
         try:
             await cleanup_expired_sessions()
         except Exception as e:
-            print(f"⚠️ Error en limpieza global: {e}")
+            logger.warning(f"⚠️ Error en limpieza global: {e}")
 
 
 @server.on_event("shutdown")
 async def shutdown():
     """Cierra servicios al apagar."""
+    # Detener workers primero: los eventos no confirmados quedan en el stream
+    from app.ingestion import get_ingestion_queue
+    ingestion = await get_ingestion_queue()
+    await ingestion.stop()
+    # Turnos fusionados aún programados o en curso (sus eventos quedan sin confirmar)
+    if _coalescer is not None:
+        await _coalescer.close()
+
+    # Liberar los leases de chat que tenga esta instancia (los demás no esperan a que venzan)
+    from app.chat_lock import get_chat_lock_manager
+    locks = await get_chat_lock_manager()
+    await locks.close()
+
+    from app.token_manager import get_token_manager
+    tm = await get_token_manager()
+    await tm.stop_proactive_refresh()
+
+    from app.firestore_config import get_firestore_config
+    fs = await get_firestore_config()
+    await fs.close()
+
+    from app.agent_factory import get_agent_factory
+    factory = await get_agent_factory()
+    await factory.close()
+
     from app.context import close_agent_app
     await close_agent_app()
-    print("🛑 Aplicación cerrada correctamente")
+
+    # Snapshots de sesión aún en escritura
+    from app.session_snapshot import flush_snapshots
+    await flush_snapshots()
+
+    # Escribir las métricas que queden en el buffer
+    from app.metrics import MetricsService
+    if MetricsService._instance is not None:
+        await MetricsService._instance.close()
+
+    from app.http_pool import close_pools
+    await close_pools()
+    logger.info("🛑 Aplicación cerrada correctamente")
 
 
 @server.get("/")
@@ -95,14 +173,166 @@ async def health_check():
     return {"status": "ok", "service": "aibot24-chat"}
 
 
+@server.get("/metrics")
+async def prometheus_metrics():
+    """Métricas en formato Prometheus (latencias del camino del mensaje, errores, fallbacks)."""
+    from app.telemetry import render
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@server.get("/stats/ingestion")
+async def ingestion_stats():
+    """Profundidad, lag y contadores de la cola de ingesta y de la coalescencia."""
+    from app.ingestion import get_ingestion_queue
+    ingestion = await get_ingestion_queue()
+    stats = ingestion.stats()
+    if _coalescer:
+        stats["coalescer"] = _coalescer.stats()
+    return stats
+
+
+@server.get("/stats/http")
+async def http_pool_stats():
+    """Aciertos del pool HTTP por portal, handshakes y latencia por método."""
+    from app.http_pool import get_pool_stats
+    return get_pool_stats()
+
+
+@server.get("/stats/sessions")
+async def session_stats():
+    """Sesiones de agente vivas, bytes estimados, desalojos del cache LRU, plegados de memoria y snapshots."""
+    from app.sessions import get_session_stats
+    from app.agent_factory import get_agent_factory
+    from app.memory import get_memory_stats
+    from app.session_snapshot import get_snapshot_stats
+    factory = await get_agent_factory()
+    return {**get_session_stats(), "factory": factory.stats(), "memory": get_memory_stats(),
+            "snapshots": get_snapshot_stats()}
+
+
+@server.get("/stats/locks")
+async def chat_lock_stats():
+    """Locks de chat: tenidos, en espera, traspasos locales, despertares por pub/sub y timeouts."""
+    from app.chat_lock import get_chat_lock_manager
+    locks = await get_chat_lock_manager()
+    return locks.stats()
+
+
+@server.get("/stats/prompt_cache")
+async def prompt_cache_stats():
+    """Tokens de prompt cacheados por el proveedor (ratio por tenant) y cachés explícitas de Gemini."""
+    from app.prompt_cache import get_prompt_cache_stats
+    return get_prompt_cache_stats()
+
+
+@server.get("/stats/tools")
+async def tool_stats():
+    """Tool calls por paso del LLM y solapamiento logrado al ejecutarlas en paralelo."""
+    from app.tool_scheduler import get_tool_stats
+    return get_tool_stats()
+
+
+@server.get("/stats/streaming")
+async def streaming_stats():
+    """Tiempo hasta el primer byte visible (stream vs. respuesta final) y bloques enviados."""
+    from app.streaming import get_streaming_stats
+    return get_streaming_stats()
+
+
+@server.get("/stats/cache")
+async def local_cache_stats():
+    """Aciertos/fallos de las cachés L1 en memoria (tokens, dominios, chat→tenant)."""
+    from app.local_cache import cache_stats
+    from app.token_manager import get_token_manager
+    tm = await get_token_manager()
+    return {"caches": cache_stats(), "tokens": tm.stats()}
+
+
+@server.get("/stats/reference")
+async def reference_cache_stats():
+    """Aciertos (frescos/stale), fallos y refrescos de la caché de datos de referencia."""
+    from app.reference_cache import get_reference_cache
+    cache = await get_reference_cache()
+    return cache.stats()
+
+
+@server.get("/stats/config")
+async def config_cache_stats():
+    """Config por tenant/bot: proyección de los listeners, aciertos L1/L2, cargas desde Firestore e invalidaciones."""
+    from app.firestore_config import get_firestore_config
+    fs = await get_firestore_config()
+    return fs.stats()
+
+
+def _is_admin(request: Request) -> bool:
+    """Valida el header X-Admin-Token contra ADMIN_TOKEN (comparación en tiempo constante)."""
+    token = request.headers.get("x-admin-token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+@server.post("/cache/config/invalidate")
+async def invalidate_config_cache(tenant: str, request: Request):
+    """Invalida la config cacheada de todos los bots de un tenant (en todas las instancias). Requiere X-Admin-Token."""
+    if not _is_admin(request):
+        logger.warning(f"🚫 Invalidación de config rechazada para {tenant} (X-Admin-Token inválido)")
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    from app.firestore_config import get_firestore_config
+    fs = await get_firestore_config()
+    version = await fs.invalidate(tenant)
+    return {"status": "ok", "tenant": tenant, "version": version}
+
+
+@server.get("/stats/products")
+async def product_index_stats():
+    """Búsquedas servidas por el índice local vs. API en vivo, syncs y tamaño del catálogo por tenant."""
+    from app.product_index import get_product_catalog
+    return get_product_catalog().stats()
+
+
+@server.post("/cache/reference/invalidate")
+async def invalidate_reference_cache(tenant: str, request: Request):
+    """Invalida los datos de referencia cacheados de un tenant (p.ej. tras cambiar etapas o campos). Requiere X-Admin-Token."""
+    if not _is_admin(request):
+        logger.warning(f"🚫 Invalidación de referencia rechazada para {tenant} (X-Admin-Token inválido)")
+        return JSONResponse({"status": "forbidden"}, status_code=403)
+    from app.reference_cache import get_reference_cache
+    cache = await get_reference_cache()
+    await cache.invalidate(tenant)
+    return {"status": "ok", "tenant": tenant}
+
+
+@server.get("/stats/metrics")
+async def metrics_pipeline_stats():
+    """Estado del buffer de métricas: eventos acumulados, descartados, docs escritos y errores de flush."""
+    from app.metrics import MetricsService
+    metrics = await MetricsService.get_instance()
+    return metrics.stats()
+
+
+@server.get("/stats/logs")
+async def log_stats():
+    """Cola del logger asíncrono: registros pendientes y descartados por saturación."""
+    from app.log import get_log_stats
+    return get_log_stats()
+
+
+@server.get("/stats/ratelimit")
+async def rate_limit_stats():
+    """Saturación del limitador de tasa por portal (esperas, rechazos, QUERY_LIMIT_EXCEEDED)."""
+    from app.rate_limiter import get_rate_limiter
+    limiter = await get_rate_limiter()
+    return limiter.stats()
+
+
 @server.post("/")
 async def bitrix_webhook(request: Request):
     """
     Endpoint para recibir eventos de Bitrix24.
-    Responde 200 OK INMEDIATAMENTE y procesa en background.
-    Esto evita timeouts de Bitrix y permite concurrencia total.
+    Encola el evento y responde 200 OK INMEDIATAMENTE; los workers de ingesta lo procesan.
+    Si la cola está saturada responde 503 (backpressure).
     """
     # Leer datos del evento
+    parse_started = time.perf_counter()
     try:
         form_data = await request.form()
         data = dict(form_data)
@@ -122,64 +352,60 @@ async def bitrix_webhook(request: Request):
                 data = {k: v[0] for k, v in parsed.items()}
                 event = data.get("event")
         except Exception as e:
-            print(f"Error parsing body: {e}")
+            logger.warning(f"⚠️ Error parsing body: {e}")
+    WEBHOOK_PARSE_SECONDS.labels("body").observe(time.perf_counter() - parse_started)
 
-    print(f"\n----- EVENTO BITRIX24: {event or 'DESCONOCIDO'} -----")
+    logger.info(f"📨 Evento Bitrix24: {event or 'DESCONOCIDO'}")
 
-    # Fire-and-forget: procesar en background, responder inmediato
+    # Encolar para procesamiento en background, responder inmediato
     if event == "ONIMBOTMESSAGEADD":
-        asyncio.create_task(_safe_handle_message(data))
+        from app.ingestion import get_ingestion_queue
+        ingestion = await get_ingestion_queue()
+        if not await ingestion.enqueue(data):
+            return JSONResponse({"status": "busy"}, status_code=503)
 
     else:
-        print(f"  ℹ️ Evento no procesado: {event}")
+        logger.info(f"ℹ️ Evento no procesado: {event}")
 
     return {"status": "ok"}
 
 
-async def _safe_handle_message(data: dict):
-    """Wrapper seguro para handle_message en background."""
-    try:
-        await handle_message(data)
-    except Exception as e:
-        print(f"  ❌ Error en background handle_message: {e}")
-        import traceback
-        traceback.print_exc()
-
-
 async def _safe_handle_join(data: dict):
     """Wrapper seguro para handle_join en background."""
     try:
         await handle_join(data)
     except Exception as e:
-        print(f"  ❌ Error en background handle_join: {e}")
+        logger.error(f"❌ Error en background handle_join: {e}")
 
 
 async def handle_message(data: dict):
     """Procesa un mensaje entrante: consulta Gemini y responde."""
-    extracted = extract_event_data(data)
-    print(f"  🔍 Extracted: {extracted}")
-
-    dialog_id = extracted.get("DIALOG_ID")
-    chat_id = extracted.get("CHAT_ID")
-    message = extracted.get("MESSAGE")
-    from_user_id = extracted.get("FROM_USER_ID")
-    user_name = extracted.get("USER_NAME", "Desconocido")
+    with WEBHOOK_PARSE_SECONDS.labels("event").time():
+        event = parse_event(data)
+    bind_request(chat_id=event.dialog_id, session_id=event.session_id)
+    if debug_sampled(logger):
+        logger.debug(f"🔍 Extracted: {event.to_dict()}")
+
+    dialog_id = event.dialog_id
+    chat_id = event.chat_id
+    message = event.message
+    from_user_id = event.from_user_id
+    user_name = event.user.get("NAME", "Desconocido")
     # Token del EVENTO para responder a Bitrix (no para tools)
-    event_token = extracted.get("BOT_access_token")
-    client_endpoint = extracted.get("BOT_client_endpoint")
-    session_id = extracted.get("SESSION_ID")
+    event_token = event.access_token
+    client_endpoint = event.client_endpoint
+    session_id = event.session_id
 
     # Ignorar mensajes del propio bot
     if from_user_id == BOT_ID:
-        print("  ⏭️ Mensaje del propio bot, ignorando.")
+        logger.info("⏭️ Mensaje del propio bot, ignorando.")
         return
 
-    print(f"  💬 De: {user_name} (ID: {from_user_id})")
-    print(f"  📝 Mensaje: {message}")
-    print(f"  🆔 Dialog: {dialog_id}")
+    logger.info(f"💬 De: {user_name} (ID: {from_user_id}), {len(message or '')} chars")
+    logger.debug(f"📝 Mensaje: {message}")
 
     if not dialog_id or not message:
-        print("  ⚠️ Faltan DIALOG_ID o MESSAGE en el evento.")
+        logger.warning("⚠️ Faltan DIALOG_ID o MESSAGE en el evento.")
         return
 
     # Guardar dominio (las tools usan TokenManager, no este token)
@@ -193,21 +419,26 @@ async def handle_message(data: dict):
     # Usar DOMAIN como identificador del tenant (no member_id)
     if domain:
         os.environ["BITRIX_MEMBER_ID"] = domain  # Legacy env var, ahora contiene domain
-        if extracted.get("BOT_ID"):
-             os.environ["BITRIX_BOT_ID"] = str(extracted.get("BOT_ID"))
+        if event.bot_id:
+             os.environ["BITRIX_BOT_ID"] = str(event.bot_id)
              
         from app.context_vars import member_id_var
         member_id_var.set(domain)  # Context var ahora usa domain
         
         # Guardar mapeo chat_id -> domain en Redis para que las tools puedan recuperarlo
         if chat_id:
-            from app.redis_client import get_redis
-            r = await get_redis()
-            await r.set(f"map:chat_to_member:{chat_id}", domain, ex=3600*24)
+            from app.token_manager import get_token_manager
+            tm = await get_token_manager()
+            await tm.set_member_for_chat(chat_id, domain)
 
     # Consultar LLM (tools usan TokenManager internamente)
     from app.config import config as ai_config
-    print(f"  🤖 Consultando AI ({ai_config.LLM_PROVIDER})...")
+    logger.info(f"🤖 Consultando AI ({ai_config.LLM_PROVIDER})...")
+    from app.streaming import STREAM_REPLIES, ProgressiveReply, record_first_visible
+    # Solo el LLM de OpenAI emite deltas; con Gemini la respuesta sale completa al final
+    streaming = STREAM_REPLIES and ai_config.LLM_PROVIDER == "openai"
+    reply = ProgressiveReply(event_token, client_endpoint, dialog_id, chat_id=chat_id, session_id=session_id) if streaming else None
+    started_at = time.monotonic()
     ai_response = await agent.get_response(
         message, 
         dialog_id, 
@@ -218,13 +449,17 @@ async def handle_message(data: dict):
         session_id=session_id,
         chat_id_num=chat_id,  # CORREGIDO: Usar el nombre de argumento correcto
         user_name=user_name,
-        user_id=from_user_id
+        user_id=from_user_id,
+        reply=reply,
     )
-    print(f"  💡 Respuesta: {ai_response[:100]}...")
+    logger.info(f"💡 Respuesta: {ai_response[:100]}...")
 
     # Responder a Bitrix (USA token del evento, no TokenManager)
-    await send_reply(event_token, client_endpoint, dialog_id, ai_response, chat_id=chat_id, session_id=session_id)
-    print("------------------------------------\n")
+    if reply is not None:
+        # Solo queda por enviar lo que no salió durante el stream
+        await reply.finish(ai_response)
+    elif await send_reply(event_token, client_endpoint, dialog_id, ai_response, chat_id=chat_id, session_id=session_id):
+        record_first_visible((time.monotonic() - started_at) * 1000, streamed=False)
 
 
 async def handle_join(data: dict):
@@ -234,7 +469,7 @@ async def handle_join(data: dict):
     access_token = extracted.get("BOT_access_token")
     client_endpoint = extracted.get("BOT_client_endpoint")
 
-    print(f"  🤝 Bot se unió al chat: {dialog_id}")
+    logger.info(f"🤝 Bot se unió al chat: {dialog_id}")
 
     if dialog_id and access_token and client_endpoint:
         welcome = "¡Hola! 👋 Soy Bot Viajes (ID: 3040), tu asistente virtual. ¿En qué puedo ayudarte hoy?"
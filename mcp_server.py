@@ -5,8 +5,7 @@ como Resources, y plantillas de orquestación como Prompts.
 
 Uso: python mcp_server.py  (se comunica por STDIO con mcp-agent)
 """
-import sys
-import os
+import logging
 import sys
 import os
 
@@ -14,6 +13,11 @@ import os
 base_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, base_dir)
 
+# Logging estructurado a stderr: stdout queda libre para el protocolo JSON-RPC de MCP
+from app.log import setup_logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
 # Cargar variables de entorno solo si existe el archivo (local dev)
 # En producción (Cloud Run), las variables se inyectan directamente al entorno.
 env_file = os.path.join(base_dir, ".env")
@@ -21,20 +25,12 @@ if os.path.exists(env_file):
     try:
         from dotenv import load_dotenv
         load_dotenv(env_file)
-        sys.stderr.write("📁 .env cargado para desarrollo local (subproceso)\n")
+        logger.info("📁 .env cargado para desarrollo local (subproceso)")
     except Exception:
         pass
 
-# Override print to use stderr globally for this process
-# This prevents any print() call (including from libraries) from breaking 
-# the MCP JSON-RPC protocol on stdout.
-_print = print
-def print(*args, **kwargs):
-    kwargs.setdefault('file', sys.stderr)
-    _print(*args, **kwargs)
-
 # Debug logs para el subproceso
-sys.stderr.write(f"🔧 MCP Server BaseDir: {base_dir}\n")
+logger.info(f"🔧 MCP Server BaseDir: {base_dir}")
 
 # Mask sensitive values in logs
 redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
@@ -42,8 +38,8 @@ if redis_url:
     masked_redis = redis_url.split('@')[-1] if '@' in redis_url else '***'
 else:
     masked_redis = 'None'
-sys.stderr.write(f"🔧 MCP Server REDIS_URL: {masked_redis}\n")
-sys.stderr.write(f"🔧 MCP Server BITRIX_DOMAIN: {os.getenv('BITRIX_DOMAIN')}\n")
+logger.info(f"🔧 MCP Server REDIS_URL: {masked_redis}")
+logger.info(f"🔧 MCP Server BITRIX_DOMAIN: {os.getenv('BITRIX_DOMAIN')}")
 
 from mcp.server.fastmcp import FastMCP
 from app.models import (
@@ -55,6 +51,7 @@ from app.models import (
     ManageLeadRequest, LeadConvertRequest, EnrichmentFields
 )
 from app.metrics import MetricsService
+from app.telemetry import TOOL_SECONDS, ERRORS
 import time
 import functools
 
@@ -64,19 +61,26 @@ def track_tool_usage(func):
         start_time = time.time()
         success = True
         try:
-            return await func(*args, **kwargs)
+            result = await func(*args, **kwargs)
+            # Las tools atrapan sus excepciones y devuelven "Error ..." / "Error técnico ..."
+            if isinstance(result, str) and result.startswith("Error"):
+                success = False
+            return result
         except Exception:
             success = False
             raise
         finally:
             duration = (time.time() - start_time) * 1000
+            TOOL_SECONDS.labels(func.__name__, "ok" if success else "error").observe(duration / 1000)
+            if not success:
+                ERRORS.labels("tool").inc()
             try:
                 ms = await MetricsService.get_instance()
                 from app.context_vars import member_id_var
                 tenant = member_id_var.get() or "unknown"
                 await ms.log_tool_usage(tenant, func.__name__, success, duration)
             except Exception as e:
-                sys.stderr.write(f"⚠️ Metrics error: {e}\n")
+                logger.warning(f"⚠️ Metrics error: {e}")
     return wrapper
 
 # ─── Inicializar servidor ─────────────────────────────────────────
@@ -95,7 +99,7 @@ async def _set_context(chat_id=None):
             member_id_var.set(m_id)
             # También poner en os.environ para tools legacy que usen os.getenv
             os.environ["BITRIX_MEMBER_ID"] = m_id
-            sys.stderr.write(f"🌐 Contexto establecido para chat {chat_id}: {m_id}\n")
+            logger.info(f"🌐 Contexto establecido para chat {chat_id}: {m_id}")
 
 # ═══════════════════════════════════════════════════════════════════
 # TOOLS — Funciones de acción que modifican o consultan Bitrix24
@@ -113,8 +117,7 @@ async def manage_lead(req: ManageLeadRequest) -> str:
         from tools.crm.manage_lead import manage_lead as _fn
         return await _fn(**req.model_dump(exclude_unset=True))
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en manage_lead: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en manage_lead: {e}")
         return f"Error técnico en manage_lead: {e}"
 
 @mcp.tool()
@@ -125,8 +128,7 @@ async def crm_add_note(req: CRMNoteRequest) -> str:
         from tools.crm.crm_add_note import crm_add_note as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en crm_add_note: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en crm_add_note: {e}")
         return f"Error técnico en crm_add_note: {e}"
 
 
@@ -139,8 +141,7 @@ async def lead_get(lead_id: int) -> str:
         from tools.crm.lead_get import lead_get as _fn
         return await _fn(lead_id=lead_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en lead_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en lead_get: {e}")
         return f"Error técnico en lead_get: {e}"
 
 @mcp.tool()
@@ -152,8 +153,7 @@ async def lead_convert(req: LeadConvertRequest) -> str:
         from tools.crm.lead_convert import lead_convert as _fn
         return await _fn(**req.model_dump(exclude_unset=True))
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en lead_convert: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en lead_convert: {e}")
         return f"Error técnico en lead_convert: {e}"
 
 @mcp.tool()
@@ -167,8 +167,7 @@ async def enrich_entity(entity_id: int, entity_type: str, fields: EnrichmentFiel
         all_fields.update(fields.model_extra or {})
         return await _fn(entity_id=entity_id, entity_type=entity_type, fields=all_fields)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en enrich_entity: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en enrich_entity: {e}")
         return f"Error técnico en enrich_entity: {e}"
 @mcp.tool()
 @track_tool_usage
@@ -179,8 +178,7 @@ async def lead_qualify(lead_id: int) -> str:
         from tools.crm.lead_qualify import lead_qualify as _fn
         return await _fn(lead_id=lead_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en lead_qualify: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en lead_qualify: {e}")
         return f"Error técnico en lead_qualify: {e}"
 
 
@@ -194,8 +192,7 @@ async def contact_get(contact_id: int) -> str:
         from tools.crm.contact_get import contact_get as _fn
         return await _fn(contact_id=contact_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en contact_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en contact_get: {e}")
         return f"Error técnico en contact_get: {e}"
 
 
@@ -209,8 +206,7 @@ async def deal_get(deal_id: int) -> str:
         from tools.deal.deal_get import deal_get as _fn
         return await _fn(deal_id=deal_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en deal_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en deal_get: {e}")
         return f"Error técnico en deal_get: {e}"
 
 @mcp.tool()
@@ -221,8 +217,7 @@ async def deal_list(filter_status: str = None, limit: int = 10) -> str:
         from tools.deal.deal_list import deal_list as _fn
         return await _fn(filter_status=filter_status, limit=limit)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en deal_list: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en deal_list: {e}")
         return f"Error técnico en deal_list: {e}"
 
 
@@ -234,8 +229,7 @@ async def deal_move_stage(deal_id: int, stage_id: str) -> str:
         from tools.deal.deal_move_stage import deal_move_stage as _fn
         return await _fn(deal_id=deal_id, stage_id=stage_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en deal_move_stage: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en deal_move_stage: {e}")
         return f"Error técnico en deal_move_stage: {e}"
 
 @mcp.tool()
@@ -246,8 +240,7 @@ async def company_get(company_id: int) -> str:
         from tools.crm.company_get import company_get as _fn
         return await _fn(company_id=company_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en company_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en company_get: {e}")
         return f"Error técnico en company_get: {e}"
 
 # ─── CRM / Metadata ───────────────────────────────────────────────
@@ -260,8 +253,7 @@ async def crm_fields_get(entity_type: str) -> str:
         from tools.crm.crm_fields_get import crm_fields_get as _fn
         return await _fn(entity_type=entity_type)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en crm_fields_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en crm_fields_get: {e}")
         return f"Error técnico en crm_fields_get: {e}"
 
 @mcp.tool()
@@ -272,8 +264,7 @@ async def crm_stages_list(entity_type: str = "DEAL") -> str:
         from tools.crm.crm_stages_list import crm_stages_list as _fn
         return await _fn(entity_type=entity_type)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en crm_stages_list: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en crm_stages_list: {e}")
         return f"Error técnico en crm_stages_list: {e}"
 
 # ─── Calendar ─────────────────────────────────────────────────────
@@ -293,8 +284,7 @@ async def calendar_availability_check(start_time: str, end_time: str) -> str:
         from tools.calendar.calendar_availability_check import calendar_availability_check as _fn
         return await _fn(start_time=start_time, end_time=end_time)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en calendar_availability_check: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en calendar_availability_check: {e}")
         return f"Error técnico en calendar_availability_check: {e}"
 
 @mcp.tool()
@@ -305,8 +295,7 @@ async def calendar_event_create(req: CalendarEventCreateRequest) -> str:
         from tools.calendar.calendar_event_create import calendar_event_create as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en calendar_event_create: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en calendar_event_create: {e}")
         return f"Error técnico en calendar_event_create: {e}"
 
 @mcp.tool()
@@ -317,8 +306,7 @@ async def calendar_event_update(req: CalendarEventUpdateRequest) -> str:
         from tools.calendar.calendar_event_update import calendar_event_update as _fn
         return await _fn(**req.model_dump(exclude_unset=True))
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en calendar_event_update: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en calendar_event_update: {e}")
         return f"Error técnico en calendar_event_update: {e}"
 
 @mcp.tool()
@@ -329,8 +317,7 @@ async def calendar_event_delete(event_id: int) -> str:
         from tools.calendar.calendar_event_delete import calendar_event_delete as _fn
         return await _fn(event_id=event_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en calendar_event_delete: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en calendar_event_delete: {e}")
         return f"Error técnico en calendar_event_delete: {e}"
 
 @mcp.tool()
@@ -341,8 +328,7 @@ async def calendar_event_get(event_id: int) -> str:
         from tools.calendar.calendar_event_get import calendar_event_get as _fn
         return await _fn(event_id=event_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en calendar_event_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en calendar_event_get: {e}")
         return f"Error técnico en calendar_event_get: {e}"
 
 # ─── Catalog / Products ──────────────────────────────────────────
@@ -355,8 +341,7 @@ async def catalog_product_list(req: CatalogProductListRequest) -> str:
         from tools.catalog.catalog_product_list import catalog_product_list as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en catalog_product_list: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en catalog_product_list: {e}")
         return f"Error técnico en catalog_product_list: {e}"
 
 @mcp.tool()
@@ -374,8 +359,7 @@ async def catalog_product_search(req: CatalogProductSearchRequest) -> str:
         from tools.catalog.catalog_product_search import catalog_product_search as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en catalog_product_search: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en catalog_product_search: {e}")
         return f"Error técnico en catalog_product_search: {e}"
 
 @mcp.tool()
@@ -386,8 +370,7 @@ async def deal_add_products(req: DealAddProductsRequest) -> str:
         from tools.catalog.deal_add_products import deal_add_products as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en deal_add_products: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en deal_add_products: {e}")
         return f"Error técnico en deal_add_products: {e}"
 
 
@@ -408,8 +391,7 @@ async def document_generate(req: DocumentGenerateRequest) -> str:
         from tools.document.document_generate import document_generate as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en document_generate: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en document_generate: {e}")
         return f"Error técnico en document_generate: {e}"
 
 @mcp.tool()
@@ -436,8 +418,7 @@ async def drive_resolve_workspace(req: DriveResolveWorkspaceRequest) -> str:
         from tools.drive.drive_resolve_workspace import drive_resolve_workspace as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en drive_resolve_workspace: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en drive_resolve_workspace: {e}")
         return f"Error técnico en drive_resolve_workspace: {e}"
 
 @mcp.tool()
@@ -455,8 +436,7 @@ async def drive_file_upload(req: DriveFileUploadRequest) -> str:
         from tools.drive.drive_file_upload import drive_file_upload as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en drive_file_upload: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en drive_file_upload: {e}")
         return f"Error técnico en drive_file_upload: {e}"
 
 @mcp.tool()
@@ -483,8 +463,7 @@ async def lead_reactivate_by_client(lead_id: int) -> str:
         from tools.crm.lead_reactivate_by_client import lead_reactivate_by_client as _fn
         return await _fn(lead_id=lead_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en lead_reactivate_by_client: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en lead_reactivate_by_client: {e}")
         return f"Error técnico en lead_reactivate_by_client: {e}"
 
 @mcp.tool()
@@ -495,8 +474,7 @@ async def deal_update_probability_client(deal_id: int, probability: int) -> str:
         from tools.deal.deal_update_probability_client import deal_update_probability_client as _fn
         return await _fn(deal_id=deal_id, probability=probability)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en deal_update_probability_client: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en deal_update_probability_client: {e}")
         return f"Error técnico en deal_update_probability_client: {e}"
 
 # ─── Openlines ────────────────────────────────────────────────────
@@ -511,8 +489,7 @@ async def session_transfer(req: SessionTransferRequest) -> str:
         from tools.openlines.session_transfer import session_transfer as _fn
         return await _fn(**req.model_dump(exclude_unset=True))
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en session_transfer: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en session_transfer: {e}")
         return f"Error técnico en session_transfer: {e}"
 
 @mcp.tool()
@@ -524,8 +501,7 @@ async def chat_send_progress(req: ChatProgressRequest) -> str:
         from tools.openlines.chat_send_progress import chat_send_progress as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en chat_send_progress: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en chat_send_progress: {e}")
         return f"Error técnico en chat_send_progress: {e}"
 
 @mcp.tool()
@@ -536,8 +512,7 @@ async def advisor_notify(req: NotifyAdvisorRequest) -> str:
         from tools.openlines.advisor_notify import advisor_notify as _fn
         return await _fn(**req.model_dump())
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en advisor_notify: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en advisor_notify: {e}")
         return f"Error técnico en advisor_notify: {e}"
 
 @mcp.prompt()
@@ -573,8 +548,7 @@ async def session_crm_get(chat_id: int) -> str:
         from tools.openlines.session_crm_get import session_crm_get as _fn
         return await _fn(chat_id=chat_id)
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en session_crm_get: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en session_crm_get: {e}")
         return f"Error técnico en session_crm_get: {e}"
 
 @mcp.tool()
@@ -610,8 +584,7 @@ async def task_create(req: TaskCreateRequest) -> str:
         from tools.task.task_create import task_create as _fn
         return await _fn(**req.model_dump(exclude_unset=True))
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en task_create: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en task_create: {e}")
         return f"Error técnico en task_create: {e}"
 
 @mcp.tool()
@@ -631,8 +604,7 @@ async def crm_activity_add(req: CRMActivityAddRequest) -> str:
         from tools.activity.crm_activity_add import crm_activity_add as _fn
         return await _fn(**req.model_dump(exclude_unset=True))
     except Exception as e:
-        import traceback
-        sys.stderr.write(f"  ❌ Error en crm_activity_add: {e}\n{traceback.format_exc()}\n")
+        logger.exception(f"❌ Error en crm_activity_add: {e}")
         return f"Error técnico en crm_activity_add: {e}"
 
 @mcp.tool()
@@ -0,0 +1,161 @@
+"""
+Micro-benchmark del parser de eventos de Bitrix24 (app.bitrix.parse_event).
+Compara el parser de una sola pasada contra la implementación anterior de
+cinco pasadas sobre un payload ONIMBOTMESSAGEADD de OpenLines, y verifica que
+ambos producen el mismo resultado. Con --extra N agrega N campos de relleno
+para comprobar que el costo se mantiene plano cuando Bitrix agrega campos.
+
+Uso: python scripts/bench_event_parser.py [--extra 200] [--iterations 20000]
+"""
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.bitrix import BOT_ID, extract_event_data, parse_event
+
+# Payload representativo de ONIMBOTMESSAGEADD (OpenLines / WhatsApp), tokens anonimizados
+SAMPLE_EVENT = {
+    "event": "ONIMBOTMESSAGEADD",
+    "event_handler_id": "41",
+    "data[BOT][3242][access_token]": "a1b2c3d4e5f6000071c9e2f20000000100000000000000000000000000000000",
+    "data[BOT][3242][expires]": "1767225600",
+    "data[BOT][3242][expires_in]": "3600",
+    "data[BOT][3242][scope]": "imbot,imopenlines,crm,task,calendar,disk",
+    "data[BOT][3242][domain]": "viajesyviajes.bitrix24.com",
+    "data[BOT][3242][server_endpoint]": "https://oauth.bitrix.info/rest/",
+    "data[BOT][3242][status]": "L",
+    "data[BOT][3242][client_endpoint]": "https://viajesyviajes.bitrix24.com/rest/",
+    "data[BOT][3242][member_id]": "5f1e2d3c4b5a69788796a5b4c3d2e1f0",
+    "data[BOT][3242][user_id]": "3242",
+    "data[BOT][3242][client_id]": "local.65f0c0ffee0000.12345678",
+    "data[BOT][3242][application_token]": "0123456789abcdef0123456789abcdef",
+    "data[BOT][3242][AUTH][access_token]": "a1b2c3d4e5f6000071c9e2f20000000100000000000000000000000000000000",
+    "data[BOT][3242][BOT_ID]": "3242",
+    "data[BOT][3242][BOT_CODE]": "travel_assistant",
+    "data[PARAMS][FROM_USER_ID]": "1068",
+    "data[PARAMS][MESSAGE]": "Hola, quiero cotizar un viaje a Cartagena para 2 personas en junio",
+    "data[PARAMS][TO_CHAT_ID]": "52841",
+    "data[PARAMS][MESSAGE_TYPE]": "L",
+    "data[PARAMS][SYSTEM]": "N",
+    "data[PARAMS][ATTACH]": "",
+    "data[PARAMS][PARAMS]": "",
+    "data[PARAMS][FILES]": "",
+    "data[PARAMS][CHAT_ENTITY_TYPE]": "LINES",
+    "data[PARAMS][CHAT_ENTITY_ID]": "whatsappbyedna|24|573158273960|1068",
+    "data[PARAMS][CHAT_ENTITY_DATA_1]": "Y|DEAL|10382|N|N|88211|1718000000|0|0|0",
+    "data[PARAMS][CHAT_ENTITY_DATA_2]": "LEAD|0|COMPANY|0|CONTACT|51922|DEAL|10382",
+    "data[PARAMS][CHAT_ENTITY_DATA_3]": "",
+    "data[PARAMS][COMMAND_CONTEXT]": "TEXTAREA",
+    "data[PARAMS][MESSAGE_ID]": "9123456",
+    "data[PARAMS][CHAT_TYPE]": "L",
+    "data[PARAMS][LANGUAGE]": "es",
+    "data[PARAMS][DIALOG_ID]": "chat52841",
+    "data[PARAMS][CHAT_ID]": "52841",
+    "data[USER][ID]": "1068",
+    "data[USER][NAME]": "María Fernanda",
+    "data[USER][FIRST_NAME]": "María",
+    "data[USER][LAST_NAME]": "Fernanda",
+    "data[USER][WORK_POSITION]": "",
+    "data[USER][GENDER]": "F",
+    "data[USER][IS_BOT]": "N",
+    "data[USER][IS_CONNECTOR]": "Y",
+    "data[USER][IS_NETWORK]": "N",
+    "data[USER][IS_EXTRANET]": "Y",
+    "ts": "1718000123",
+    "auth[access_token]": "f6e5d4c3b2a1000071c9e2f20000000100000000000000000000000000000000",
+    "auth[expires]": "1767225600",
+    "auth[expires_in]": "3600",
+    "auth[scope]": "imbot,imopenlines,crm,task,calendar,disk",
+    "auth[domain]": "viajesyviajes.bitrix24.com",
+    "auth[server_endpoint]": "https://oauth.bitrix.info/rest/",
+    "auth[status]": "L",
+    "auth[client_endpoint]": "https://viajesyviajes.bitrix24.com/rest/",
+    "auth[member_id]": "5f1e2d3c4b5a69788796a5b4c3d2e1f0",
+    "auth[user_id]": "1",
+    "auth[application_token]": "0123456789abcdef0123456789abcdef",
+}
+
+
+def legacy_extract_event_data(data: dict) -> dict:
+    """Implementación anterior (cinco pasadas) conservada como referencia."""
+    result = {}
+    params_prefix = "data[PARAMS]"
+    for key, value in data.items():
+        if key.startswith(params_prefix):
+            result[key[len(params_prefix) + 1:-1]] = value
+
+    detected_bot_id = None
+    for key in data.keys():
+        if key.startswith("data[BOT][") and "]" in key:
+            parts = key.split("[")
+            if len(parts) > 2:
+                detected_bot_id = parts[2].split("]")[0]
+                break
+    bot_id = detected_bot_id or BOT_ID
+    result["BOT_ID"] = bot_id
+
+    bot_prefix = f"data[BOT][{bot_id}]"
+    for key, value in data.items():
+        if key.startswith(bot_prefix):
+            rest = key[len(bot_prefix):]
+            if rest.startswith("[") and rest.endswith("]"):
+                result[f"BOT_{rest[1:-1]}"] = value
+
+    user_prefix = "data[USER]"
+    for key, value in data.items():
+        if key.startswith(user_prefix):
+            result[f"USER_{key[len(user_prefix) + 1:-1]}"] = value
+
+    for key, value in data.items():
+        if key.startswith("auth["):
+            result[f"AUTH_{key[5:-1]}"] = value
+
+    for key, value in data.items():
+        k_upper = key.upper()
+        if "SESSION_ID" in k_upper and "SESSION_ID" not in result:
+            result["SESSION_ID"] = value
+        if "DIALOG_ID" in k_upper and "DIALOG_ID" not in result:
+            result["DIALOG_ID"] = value
+        if "CHAT_ID" in k_upper and "CHAT_ID" not in result:
+            result["CHAT_ID"] = value
+
+    if result.get("CHAT_ENTITY_TYPE") == "LINES" and not result.get("SESSION_ID"):
+        parts = (result.get("CHAT_ENTITY_DATA_1") or "").split("|")
+        if len(parts) > 5 and parts[5].isdigit():
+            result["SESSION_ID"] = int(parts[5])
+    return result
+
+
+def with_extra_fields(data: dict, extra: int) -> dict:
+    padded = dict(data)
+    for i in range(extra):
+        padded[f"data[PARAMS][EXTRA_FIELD_{i}]"] = f"value-{i}"
+    return padded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--extra", type=int, default=0)
+    args = parser.parse_args()
+
+    for extra in sorted({0, args.extra}):
+        payload = with_extra_fields(SAMPLE_EVENT, extra)
+        assert extract_event_data(payload) == legacy_extract_event_data(payload), "Resultados distintos"
+
+        legacy = timeit.timeit(lambda: legacy_extract_event_data(payload), number=args.iterations)
+        flat = timeit.timeit(lambda: extract_event_data(payload), number=args.iterations)
+        typed = timeit.timeit(lambda: parse_event(payload), number=args.iterations)
+
+        per_call = lambda t: t / args.iterations * 1e6
+        print(f"\n📦 Payload: {len(payload)} claves ({extra} extra), {args.iterations} iteraciones")
+        print(f"  legacy (5 pasadas)      : {per_call(legacy):7.2f} µs/evento")
+        print(f"  extract_event_data      : {per_call(flat):7.2f} µs/evento  ({legacy / flat:.2f}x)")
+        print(f"  parse_event (tipado)    : {per_call(typed):7.2f} µs/evento  ({legacy / typed:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
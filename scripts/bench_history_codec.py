@@ -0,0 +1,148 @@
+"""
+Benchmark de codecs del historial (app.history_codec): bytes por mensaje y
+throughput de codificación/decodificación.
+- json         : formato anterior (json.dumps, ensure_ascii=False)
+- msgpack      : encabezado versionado + msgpack
+- msgpack+zstd : msgpack comprimido (sin diccionario y, si se pasa --dict, con diccionario)
+
+Los mensajes se generan con el mismo esquema que app.memory.add_message, o se
+leen de Redis con --from-redis (patrón chat:*:history).
+Con --train-dict entrena un diccionario zstd sobre la muestra y lo guarda
+(para usar con HISTORY_ZSTD_DICT).
+
+Uso: python scripts/bench_history_codec.py [--messages 5000] [--from-redis] [--train-dict history.dict] [--dict history.dict]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msgpack
+from app import history_codec
+from app.history_codec import JsonCodec, MsgpackCodec, decode_entry
+
+USER_TEXTS = [
+    "Hola, quiero información del paquete a Cusco para 4 personas en julio",
+    "¿Cuánto cuesta el tour a Machu Picchu con hotel incluido?",
+    "Mi nombre es María Fernanda López y mi teléfono es +51 987 654 321",
+    "Perfecto, ¿tienen disponibilidad del 12 al 18 de agosto?",
+    "ok gracias",
+    "Somos 2 adultos y 1 niño de 8 años, ¿hay descuento?",
+]
+BOT_TEXTS = [
+    "¡Hola! 👋 Con gusto te ayudo. Tenemos tres opciones para Cusco en julio: "
+    "1) Cusco Clásico 4D/3N desde USD 450 por persona, 2) Cusco + Valle Sagrado 5D/4N "
+    "desde USD 620 y 3) Cusco Premium con tren Vistadome desde USD 890. ¿Cuál te interesa?",
+    "El paquete Machu Picchu Full Day incluye traslados, tren ida y vuelta, entrada, guía "
+    "bilingüe y almuerzo buffet. El precio es USD 380 por persona en habitación doble.",
+    "Gracias, María Fernanda. Ya registré tus datos y un asesor te contactará en breve. ✅",
+    "Sí, hay disponibilidad para esas fechas. ¿Deseas que te envíe la cotización por correo?",
+]
+
+
+def synthetic_messages(n: int) -> list:
+    rnd = random.Random(42)
+    messages = []
+    for i in range(n):
+        if i % 2 == 0:
+            text = rnd.choice(USER_TEXTS)
+            messages.append({
+                "role": "user", "content": text, "tokens": len(text) // 4,
+                "context": {"BITRIX_SESSION_ID": 18000 + i, "BITRIX_CHAT_ID": 5000 + i // 20,
+                            "USER_NAME": "María", "USER_ID": "123",
+                            "client_endpoint": "https://empresa.bitrix24.es/rest/",
+                            "DIALOG_ID": f"chat{5000 + i // 20}"},
+            })
+        else:
+            text = rnd.choice(BOT_TEXTS)
+            messages.append({"role": "assistant", "content": text, "tokens": len(text) // 4})
+    return messages
+
+
+async def redis_messages(limit: int) -> list:
+    from app.redis_client import get_redis_binary
+    r = await get_redis_binary()
+    messages = []
+    async for key in r.scan_iter(match="chat:*:history", count=500):
+        for raw in await r.lrange(key, 0, -1):
+            messages.append(decode_entry(raw))
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+
+def measure(label: str, codec, messages: list, rounds: int = 5):
+    encoded = [codec.encode(m) for m in messages]
+    total_bytes = sum(len(e) for e in encoded)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for m in messages:
+            codec.encode(m)
+    encode_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for e in encoded:
+            decode_entry(e)
+    decode_s = time.perf_counter() - start
+
+    n = len(messages) * rounds
+    print(f"  {label:22s}: {total_bytes / len(messages):7.1f} B/msg | "
+          f"encode {n / encode_s / 1000:7.1f} k msg/s | decode {n / decode_s / 1000:7.1f} k msg/s")
+    return total_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--from-redis", action="store_true")
+    parser.add_argument("--train-dict", help="Entrenar un diccionario zstd y guardarlo en esta ruta")
+    parser.add_argument("--dict", help="Diccionario zstd existente")
+    parser.add_argument("--dict-size", type=int, default=16 * 1024)
+    args = parser.parse_args()
+
+    if args.from_redis:
+        messages = asyncio.run(redis_messages(args.messages))
+        source = "Redis"
+    else:
+        messages = synthetic_messages(args.messages)
+        source = "sintéticos"
+    print(f"\n📦 {len(messages)} mensajes ({source})")
+
+    baseline = measure("json (anterior)", JsonCodec(), messages)
+    codecs = [("msgpack", MsgpackCodec())]
+
+    if history_codec.zstandard is None:
+        print("  (zstandard no instalado: se omiten los codecs comprimidos)")
+    else:
+        import zstandard
+        codecs.append(("msgpack+zstd", history_codec.ZstdMsgpackCodec()))
+        dict_data = None
+        if args.train_dict:
+            samples = [msgpack.packb(m, use_bin_type=True) for m in messages]
+            dict_data = zstandard.train_dictionary(args.dict_size, samples).as_bytes()
+            with open(args.train_dict, "wb") as f:
+                f.write(dict_data)
+            print(f"  📚 Diccionario de {len(dict_data)} bytes guardado en {args.train_dict}")
+        elif args.dict:
+            with open(args.dict, "rb") as f:
+                dict_data = f.read()
+        if dict_data:
+            codec = history_codec.ZstdMsgpackCodec(dict_data)
+            history_codec._zstd_codecs[codec.dict_id] = codec
+            codecs.append(("msgpack+zstd+dict", codec))
+
+    for label, codec in codecs:
+        if isinstance(codec, history_codec.ZstdMsgpackCodec):
+            history_codec._zstd_codecs.setdefault(codec.dict_id, codec)
+        size = measure(label, codec, messages)
+        print(f"  {'':22s}  ahorro vs json: {(1 - size / baseline) * 100:5.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark del índice local de productos (app.product_index): tiempo de
+construcción y latencia de búsqueda (p50/p99) sobre un catálogo sintético, con
+consultas con tildes, errores de tipeo y filtros de sección/precio.
+La búsqueda en vivo (`%NAME` en crm.product.list) cuesta un round trip a
+Bitrix por consulta (típicamente 150-400 ms).
+
+Uso: python scripts/bench_product_index.py [--products 5000] [--queries 2000]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.product_index import ProductIndex
+
+DESTINATIONS = ["Cusco", "Machu Picchu", "Máncora", "Arequipa", "Puno", "Iquitos", "Paracas", "Lima",
+                "Huaraz", "Nazca", "Cañón del Colca", "Lago Titicaca", "Valle Sagrado", "Chachapoyas"]
+KINDS = ["Paquete", "Tour", "Hotel", "Traslado", "Vuelo", "Crucero", "Excursión"]
+EXTRAS = ["Clásico", "Premium", "Económico", "Familiar", "Full Day", "4D/3N", "5D/4N", "con guía"]
+QUERIES = ["cusco", "machupichu", "mancora", "hotel lima", "valle sagrado", "excursion colca",
+           "canon del colca", "premium cusco", "titicaca", "tour", "vuelo arequipa", "xyz"]
+
+
+def synthetic_products(n: int) -> list:
+    rnd = random.Random(42)
+    return [{
+        "ID": str(i),
+        "NAME": f"{rnd.choice(KINDS)} {rnd.choice(DESTINATIONS)} {rnd.choice(EXTRAS)}",
+        "PRICE": str(rnd.randint(50, 3000)),
+        "CURRENCY_ID": "USD",
+        "SECTION_ID": str(rnd.randint(1, 12)),
+        "DATE_MODIFY": f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T10:00:00+00:00",
+    } for i in range(n)]
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    products = synthetic_products(args.products)
+    index = ProductIndex("bench")
+    start = time.perf_counter()
+    index.replace_all(products)
+    print(f"\n📦 {len(index)} productos indexados en {(time.perf_counter() - start) * 1000:.0f} ms "
+          f"({len(index._by_token)} tokens, {len(index._by_trigram)} trigramas)")
+
+    rnd = random.Random(7)
+    for label, kwargs in [("sin filtros", {}), ("sección + precio", {"section_id": 3, "max_price": 1500})]:
+        cold, warm = [], []
+        for _ in range(args.queries):
+            query = rnd.choice(QUERIES)
+            index._results.clear()
+            t0 = time.perf_counter()
+            index.search(query, **kwargs)
+            cold.append((time.perf_counter() - t0) * 1e6)
+            t0 = time.perf_counter()
+            index.search(query, **kwargs)
+            warm.append((time.perf_counter() - t0) * 1e6)
+        print(f"  {label:18s}: p50 {percentile(cold, 0.5):7.0f} µs | p99 {percentile(cold, 0.99):7.0f} µs | "
+              f"repetida p50 {percentile(warm, 0.5):5.1f} µs")
+
+    for query in QUERIES[:6]:
+        top = index.search(query, limit=3)
+        print(f"  '{query}': {[p['NAME'] for p in top]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark de creación de sesiones: construcción completa por chat vs. fábrica con prototipo.
+- legacy : un Agent nuevo por chat (registro de tools + __aenter__ + LLM), como antes.
+- factory: un prototipo por (tenant, bot) y solo un AugmentedLLM por chat (app.agent_factory).
+Mide la latencia de nueva sesión (p50/p95) y el RSS adicional por sesión viva.
+No llama al LLM ni a Firestore: el prompt se pasa fijo.
+
+Uso: python scripts/bench_session_factory.py [--sessions 200]
+"""
+import os
+import sys
+import gc
+import time
+import asyncio
+import argparse
+import statistics
+
+import psutil
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench-000000000000")
+
+from mcp_agent.agents.agent import Agent
+from app.context import get_agent_app, close_agent_app
+from app.agent_factory import AgentFactory, get_mcp_tool_map
+
+PROMPT = "Eres un asistente de viajes. " * 200  # ~6 KB, similar a un systemPrompt real
+
+
+def _rss_mb() -> float:
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+async def legacy_session(chat_id: str, tool_fns: list, proto):
+    agent = Agent(name=f"legacy_{chat_id}", instruction=PROMPT, server_names=[], functions=tool_fns)
+    await agent.__aenter__()
+    llm = proto.llm_class(agent=agent, instruction=PROMPT, name=f"legacy_{chat_id}",
+                          default_request_params=proto.request_params.model_copy(update={"systemPrompt": PROMPT}))
+    return agent, llm
+
+
+async def run(label: str, make_session, n: int):
+    gc.collect()
+    rss_before = _rss_mb()
+    sessions, timings = [], []
+    for i in range(n):
+        start = time.perf_counter()
+        sessions.append(await make_session(f"chat{i}"))
+        timings.append((time.perf_counter() - start) * 1000)
+    gc.collect()
+    rss_per_session = (_rss_mb() - rss_before) * 1024 / n
+    timings.sort()
+    print(f"  {label:8s}: p50 {statistics.median(timings):7.2f} ms | p95 {timings[int(n * 0.95) - 1]:7.2f} ms"
+          f" | RSS {rss_per_session:7.1f} KB/sesión")
+    return sessions
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=200)
+    args = parser.parse_args()
+
+    await get_agent_app()
+    tools = get_mcp_tool_map()
+    tool_fns = [t.fn for t in tools.values()]
+    factory = AgentFactory()
+    proto = await factory.build_prototype("bench.bitrix24.com", "1", instruction=PROMPT)
+    print(f"\n📦 {args.sessions} sesiones, {len(tools)} tools, prompt de {len(PROMPT)} caracteres")
+
+    legacy = await run("legacy", lambda cid: legacy_session(cid, tool_fns, proto), args.sessions)
+    factory_sessions = await run("factory", lambda cid: _factory_session(factory, proto, cid), args.sessions)
+
+    for agent, _llm in legacy:
+        await agent.__aexit__(None, None, None)
+    del factory_sessions
+    await factory.close()
+    await close_agent_app()
+
+
+async def _factory_session(factory: AgentFactory, proto, chat_id: str):
+    return factory.create_llm(proto, chat_id)
+
+
+if __name__ == "__main__":
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main())
+    # Algunas tareas de fondo de mcp-agent no responden a la cancelación al cerrar el loop
+    sys.stdout.flush()
+    os._exit(0)
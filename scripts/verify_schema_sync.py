@@ -61,7 +61,7 @@ async def verify_schema_sync():
             "temperature": 0.8
         }
         
-        cache_key = f"config:tenant:{tenant_id}"
+        cache_key = fs._get_cache_key(tenant_id, version=await fs._version(tenant_id))
         await redis.set(cache_key, json.dumps(mock_data), ex=30)
         print("  ✅ Mock de cambio en Dashboard inyectado en Redis.")
 
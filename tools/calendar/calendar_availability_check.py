@@ -1,8 +1,10 @@
 """
 Tool to check availability of participants in Bitrix24 calendar.
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def calendar_availability_check(start_time: str, end_time: str) -> str:
     """
@@ -19,8 +21,8 @@ async def calendar_availability_check(start_time: str, end_time: str) -> str:
     3. REPLY with that single recommendation: "I have availability on [Date] at [Time]. Should I book it?"
     4. Be extremely brief.
     """
-    sys.stderr.write(f"  📅 Tool calendar_availability_check: start='{start_time}', end='{end_time}'\n")
-    sys.stderr.write("  🔑 Creds: (usando TokenManager centralizado)\n")
+    logger.info(f"📅 Tool calendar_availability_check: start='{start_time}', end='{end_time}'")
+    logger.info("🔑 Creds: (usando TokenManager centralizado)")
 
     if not start_time or not end_time:
         return "Error: Faltan argumentos (start_time, end_time)"
@@ -56,5 +58,5 @@ async def calendar_availability_check(start_time: str, end_time: str) -> str:
         return output
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en calendar_availability_check: {e}\n")
+        logger.error(f"❌ Error en calendar_availability_check: {e}")
         return f"Error verificando disponibilidad: {e}"
@@ -1,8 +1,10 @@
 """
 Tool to create new calendar events in Bitrix24.
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def calendar_event_create(title: str, start_time: str, end_time: str, description: str = "", remind_mins: int = 60, section_id: int = 0) -> str:
     """
@@ -19,7 +21,7 @@ async def calendar_event_create(title: str, start_time: str, end_time: str, desc
     if not title or not start_time or not end_time:
         return "Error: title, start_time y end_time son requeridos."
 
-    sys.stderr.write(f"  📅 Tool calendar_event_create: {title} ({start_time}) en sección {section_id}\n")
+    logger.info(f"📅 Tool calendar_event_create: {title} ({start_time}) en sección {section_id}")
 
     try:
         from app.auth import get_current_user_id
@@ -44,7 +46,7 @@ async def calendar_event_create(title: str, start_time: str, end_time: str, desc
         # Si falla por sección inválida, reintentar con sección 0
         error_msg = result.get("error_description", "")
         if not event_id and "ID de sección" in error_msg and section_id != 0:
-            sys.stderr.write(f"  ⚠️ Reintentando calendar_event_create con sección 0 por error: {error_msg}\n")
+            logger.warning(f"⚠️ Reintentando calendar_event_create con sección 0 por error: {error_msg}")
             fields["section"] = 0
             result = await call_bitrix_method("calendar.event.add", fields)
             event_id = result.get("result")
@@ -56,5 +58,5 @@ async def calendar_event_create(title: str, start_time: str, end_time: str, desc
             return f"Error de Bitrix al crear evento: {error}"
         
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en calendar_event_create: {e}\n")
+        logger.error(f"❌ Error en calendar_event_create: {e}")
         return f"Error técnico: {e}"
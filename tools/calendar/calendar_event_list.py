@@ -1,9 +1,11 @@
 """
 Tool to list calendar events to avoid conflicts in Bitrix24.
 """
+import logging
 from app.auth import call_bitrix_method
 from datetime import datetime, timedelta
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def calendar_event_list(from_date: str = None, to_date: str = None) -> str:
     """
@@ -14,8 +16,8 @@ async def calendar_event_list(from_date: str = None, to_date: str = None) -> str
         from_date: Fecha inicio (YYYY-MM-DD). Usa siempre el año y fecha actual del contexto.
         to_date: Fecha fin (YYYY-MM-DD). Usa siempre el año y fecha actual del contexto.
     """
-    sys.stderr.write(f"  📅 Tool calendar_event_list: from={from_date}, to={to_date}\n")
-    sys.stderr.write("  🔑 Creds: (usando TokenManager centralizado)\n")
+    logger.info(f"📅 Tool calendar_event_list: from={from_date}, to={to_date}")
+    logger.info("🔑 Creds: (usando TokenManager centralizado)")
 
     # Default dates
     if not from_date:
@@ -50,5 +52,5 @@ async def calendar_event_list(from_date: str = None, to_date: str = None) -> str
         return output
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en calendar_event_list: {e}\n")
+        logger.error(f"❌ Error en calendar_event_list: {e}")
         return f"Error consultando agenda: {e}"
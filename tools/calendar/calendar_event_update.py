@@ -1,8 +1,10 @@
 """
 Tool to update/reschedule calendar events.
 """
+import logging
 from app.auth import call_bitrix_method, get_current_user_id
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def calendar_event_update(event_id: int, title: str = None, start_time: str = None, end_time: str = None, description: str = None, remind_mins: int = None) -> str:
     """
@@ -11,7 +13,7 @@ async def calendar_event_update(event_id: int, title: str = None, start_time: st
     if not event_id:
         return "Error: event_id es requerido."
 
-    sys.stderr.write(f"  📅 Tool calendar_event_update: ID {event_id}\n")
+    logger.info(f"📅 Tool calendar_event_update: ID {event_id}")
 
     try:
         owner_id = await get_current_user_id()
@@ -38,5 +40,5 @@ async def calendar_event_update(event_id: int, title: str = None, start_time: st
             return f"Error al actualizar evento: {error}"
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en calendar_event_update: {e}\n")
+        logger.error(f"❌ Error en calendar_event_update: {e}")
         return f"Error técnico: {e}"
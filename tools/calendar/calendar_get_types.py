@@ -1,7 +1,7 @@
 """
 Tool to get available calendar types.
 """
-from app.auth import call_bitrix_method
+from app.reference_cache import cached_bitrix_call
 
 async def calendar_get_types() -> str:
     """
@@ -12,7 +12,7 @@ async def calendar_get_types() -> str:
         str: Lista de tipos de calendario o error.
     """
     try:
-        result = await call_bitrix_method("calendar.type.get", {})
+        result = await cached_bitrix_call("calendar.type.get", {})
         types = result.get("result", [])
         
         if not types:
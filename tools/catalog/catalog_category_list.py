@@ -1,7 +1,7 @@
 """
 Tool to list categories in a catalog.
 """
-from app.auth import call_bitrix_method
+from app.reference_cache import cached_bitrix_call
 
 async def catalog_category_list(catalog_id: int) -> str:
     """
@@ -15,7 +15,7 @@ async def catalog_category_list(catalog_id: int) -> str:
 
     try:
         # Usamos crm.productsection.list que es más común para CRM
-        result = await call_bitrix_method("crm.productsection.list", {
+        result = await cached_bitrix_call("crm.productsection.list", {
             "order": {"NAME": "ASC"},
             "filter": {"CATALOG_ID": catalog_id}
         })
@@ -1,7 +1,7 @@
 """
 Tool to list available product catalogs.
 """
-from app.auth import call_bitrix_method
+from app.reference_cache import cached_bitrix_call
 
 async def catalog_list() -> str:
     """
@@ -11,7 +11,7 @@ async def catalog_list() -> str:
         str: Lista de catálogos con sus IDs.
     """
     try:
-        result = await call_bitrix_method("crm.catalog.list", {})
+        result = await cached_bitrix_call("crm.catalog.list", {})
         catalogs = result.get("result", [])
         
         if not catalogs:
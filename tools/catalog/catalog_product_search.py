@@ -1,36 +1,36 @@
 """
 Tool to search products by name.
 """
-from app.auth import call_bitrix_method
+from app.product_index import get_product_catalog
 
-async def catalog_product_search(name: str) -> str:
+async def catalog_product_search(name: str, section_id: int = None, min_price: float = None, max_price: float = None) -> str:
     """
     Usa esta tool para BUSCAR productos por nombre (ej: "Madrid", "Hotel playa").
+    Tolera tildes y errores de tipeo; los resultados vienen ordenados por relevancia.
     Si la búsqueda no retorna resultados, no te rindas: usa el recurso 'bitrix://catalogs' para explorar el inventario manualmente.
-    
+
     Args:
         name: Término de búsqueda.
+        section_id: (Opcional) Solo productos de esta sección/categoría.
+        min_price: (Opcional) Precio mínimo.
+        max_price: (Opcional) Precio máximo.
     """
     if not name:
         return "Error: Falta query (término de búsqueda)"
 
     try:
-        # Filtro SEARCH_CONTENT suele funcionar, o %NAME%
-        result = await call_bitrix_method("crm.product.list", {
-            "order": {"NAME": "ASC"},
-            "filter": {"%NAME": name}, # Búsqueda parcial por nombre
-            "select": ["ID", "NAME", "PRICE", "CURRENCY_ID", "SECTION_ID"]
-        })
-        products = result.get("result", [])
-        
+        # Índice local del catálogo (cae a la API en vivo si no está sincronizado)
+        catalog = get_product_catalog()
+        products = await catalog.search(name, section_id=section_id, min_price=min_price, max_price=max_price)
+
         if not products:
             return f"No se encontraron productos coincidiendo con '{name}'."
-            
+
         output = f"Resultados búsqueda '{name}':\n"
         for p in products:
             output += f"- ID: {p.get('ID')} | {p.get('NAME')} | Precio: {p.get('PRICE')} {p.get('CURRENCY_ID')} (Cat: {p.get('SECTION_ID')})\n"
-            
+
         return output
-        
+
     except Exception as e:
         return f"Error buscando productos: {e}"
@@ -1,7 +1,7 @@
 """
 Tool to add products to a deal.
 """
-from app.auth import call_bitrix_method
+from app.auth import BitrixBatch
 
 async def deal_add_products(deal_id: int, products: list[dict]) -> str:
     """
@@ -18,7 +18,10 @@ async def deal_add_products(deal_id: int, products: list[dict]) -> str:
     output = ""
     error_count = 0
 
-    for p in products:
+    # Todas las filas en un solo batch (1 round trip en lugar de N)
+    batch = BitrixBatch()
+    rows = []
+    for i, p in enumerate(products):
         # Normalizar para ser resiliente a lo que envíe el LLM
         pid = p.get("PRODUCT_ID") or p.get("product_id")
         price = p.get("PRICE") or p.get("price")
@@ -36,13 +39,20 @@ async def deal_add_products(deal_id: int, products: list[dict]) -> str:
         if curr:
             fields["CURRENCY_ID"] = curr
 
-        try:
-            # crm.productrow.add (legacy but standard for deals) or crm.item.productrow.add (new item based)
-            # Para Deals estándar, crm.productrow.add es lo usual.
-            result = await call_bitrix_method("crm.productrow.add", {"fields": fields})
-            output += f"- Producto {p.get('product_id')} agregado (Row ID: {result.get('result')})\n"
-        except Exception as e:
-            output += f"- Error agregando producto {p.get('product_id')}: {e}\n"
+        # crm.productrow.add (legacy but standard for deals) or crm.item.productrow.add (new item based)
+        # Para Deals estándar, crm.productrow.add es lo usual.
+        rows.append((batch.add(f"row{i}", "crm.productrow.add", {"fields": fields}), pid))
+
+    try:
+        res = await batch.execute()
+    except Exception as e:
+        return f"Falló agregar todos los productos: {e}"
+
+    for name, pid in rows:
+        if res.ok(name):
+            output += f"- Producto {pid} agregado (Row ID: {res.get(name)})\n"
+        else:
+            output += f"- Error agregando producto {pid}: {res.error(name) or 'sin respuesta'}\n"
             error_count += 1
             
     if error_count == len(products):
@@ -2,8 +2,10 @@
 Herramienta para añadir comentarios a la línea de tiempo (timeline) de cualquier entidad CRM en Bitrix24.
 Usa el método: crm.timeline.comment.add
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def crm_add_note(entity_id: int, entity_type: str, message: str, access_token: str = None, domain: str = None) -> str:
     """
@@ -28,7 +30,7 @@ async def crm_add_note(entity_id: int, entity_type: str, message: str, access_to
     
     e_type = entity_type_map.get(entity_type.upper(), entity_type.lower())
 
-    sys.stderr.write(f"  📝 Tool crm_add_note: {e_type}:{entity_id}\n")
+    logger.info(f"📝 Tool crm_add_note: {e_type}:{entity_id}")
 
     try:
         params = {
@@ -45,9 +47,9 @@ async def crm_add_note(entity_id: int, entity_type: str, message: str, access_to
             return f"Nota agregada exitosamente a {entity_type} {entity_id}."
         else:
             error = result.get("error_description", result)
-            sys.stderr.write(f"  ❌ Error en crm.timeline.comment.add: {error}\n")
+            logger.error(f"❌ Error en crm.timeline.comment.add: {error}")
             return f"Error al agregar nota: {error}"
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Excepción en crm_add_note: {e}\n")
+        logger.error(f"❌ Excepción en crm_add_note: {e}")
         return f"Error al agregar nota: {e}"
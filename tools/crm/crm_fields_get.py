@@ -1,7 +1,7 @@
 """
 Tool to fetch CRM field definitions (schema).
 """
-from app.auth import call_bitrix_method
+from app.reference_cache import cached_bitrix_call
 
 async def crm_fields_get(entity_type: str) -> str:
     """
@@ -24,7 +24,7 @@ async def crm_fields_get(entity_type: str) -> str:
         return f"Error: Entidad '{entity_type}' no soportada."
 
     try:
-        result = await call_bitrix_method(method, {})
+        result = await cached_bitrix_call(method, {})
         fields = result.get("result", {})
         
         output = f"Esquema de campos para {etype}:\n"
@@ -1,7 +1,7 @@
 """
 Tool to fetch CRM stages/statuses.
 """
-from app.auth import call_bitrix_method
+from app.reference_cache import cached_bitrix_call
 
 async def crm_stages_list(entity_type: str = "DEAL") -> str:
     """
@@ -18,7 +18,7 @@ async def crm_stages_list(entity_type: str = "DEAL") -> str:
         entity_id = "DEAL_STAGE"
 
     try:
-        result = await call_bitrix_method("crm.status.list", {
+        result = await cached_bitrix_call("crm.status.list", {
             "filter": {"ENTITY_ID": entity_id},
             "order": {"SORT": "ASC"}
         })
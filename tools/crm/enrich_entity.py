@@ -1,6 +1,8 @@
+import logging
 from app.auth import call_bitrix_method
 from app.models import EnrichmentRequest
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def enrich_entity(entity_id: int, entity_type: str, fields: dict) -> str:
     """
@@ -36,13 +38,13 @@ async def enrich_entity(entity_id: int, entity_type: str, fields: dict) -> str:
     if entity_type == "LEAD" and "SOURCE_ID" not in normalized_fields:
         normalized_fields["SOURCE_ID"] = "WEB"
 
-    sys.stderr.write(f"  🧠 Pydantic-Enriched {entity_type}:{req.entity_id} with {normalized_fields}\n")
+    logger.debug(f"🧠 Pydantic-Enriched {entity_type}:{req.entity_id} with {normalized_fields}")
 
     try:
         result = await call_bitrix_method(bitrix_method, {
             "id": req.entity_id,
             "fields": normalized_fields
-        })
+        }, priority="low")
         
         if result.get("result"):
             return f"{entity_type} {req.entity_id} enriquecido exitosamente."
@@ -51,5 +53,5 @@ async def enrich_entity(entity_id: int, entity_type: str, fields: dict) -> str:
             return f"Error enriqueciendo {entity_type}: {error}"
             
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error in enrich_entity: {e}\n")
+        logger.error(f"❌ Error in enrich_entity: {e}")
         return f"Excepción en enrich_entity: {e}"
@@ -1,10 +1,11 @@
 """
 Herramienta para convertir un Lead en Contacto + Deal en Bitrix24.
-Usa crm.lead.update y luego crea Contacto/Deal manualmente.
+Lee el Lead y luego crea Contacto/Empresa/Deal y lo cierra en un único batch.
 """
-from app.auth import call_bitrix_method
-import json
-import sys
+import logging
+from app.auth import call_bitrix_method, BitrixBatch
+
+logger = logging.getLogger(__name__)
 
 async def lead_convert(lead_id: int, deal_category_id: int = 0, chat_id: int = None, create_deal: bool = True, create_contact: bool = True, create_company: bool = False) -> str:
     """
@@ -17,7 +18,7 @@ async def lead_convert(lead_id: int, deal_category_id: int = 0, chat_id: int = N
     if not (create_deal or create_contact or create_company):
          return "Error: Debes seleccionar al menos una entidad para crear (Deal, Contacto o Empresa)."
 
-    sys.stderr.write(f"  🚀 Tool lead_convert: lead_id={lead_id}, deal={create_deal}, contact={create_contact}, company={create_company}\n")
+    logger.info(f"🚀 Tool lead_convert: lead_id={lead_id}, deal={create_deal}, contact={create_contact}, company={create_company}")
 
     try:
         # 1. Obtener datos del Lead
@@ -26,11 +27,11 @@ async def lead_convert(lead_id: int, deal_category_id: int = 0, chat_id: int = N
         if not lead:
             return f"Error: no se encontró el Lead {lead_id}."
 
-        contact_id = None
-        company_id = None
-        deal_id = None
         entities_created = []
 
+        # 2-6. Crear entidades y cerrar el Lead en un único batch (halt: se detiene al primer error)
+        batch = BitrixBatch(halt=True)
+
         # 2. Crear Contacto
         if create_contact:
             contact_fields = {
@@ -43,10 +44,7 @@ async def lead_convert(lead_id: int, deal_category_id: int = 0, chat_id: int = N
             if lead.get("EMAIL"): contact_fields["EMAIL"] = lead["EMAIL"]
             if lead.get("ASSIGNED_BY_ID"): contact_fields["ASSIGNED_BY_ID"] = lead["ASSIGNED_BY_ID"]
 
-            contact_result = await call_bitrix_method("crm.contact.add", {"fields": contact_fields})
-            contact_id = contact_result.get("result")
-            if contact_id:
-                entities_created.append(f"CONTACTO:{contact_id}")
+            batch.add("contact", "crm.contact.add", {"fields": contact_fields})
 
         # 3. Crear Empresa (Opcional - Caso B2B)
         if create_company:
@@ -58,18 +56,14 @@ async def lead_convert(lead_id: int, deal_category_id: int = 0, chat_id: int = N
             }
             if lead.get("PHONE"): company_fields["PHONE"] = lead["PHONE"]
             if lead.get("EMAIL"): company_fields["EMAIL"] = lead["EMAIL"]
-            
-            
-            company_result = await call_bitrix_method("crm.company.add", {"fields": company_fields})
-            company_id = company_result.get("result")
-            if company_id:
-                entities_created.append(f"EMPRESA:{company_id}")
-                # Vincular contacto a la empresa (si se creó contacto)
-                if contact_id:
-                    await call_bitrix_method("crm.contact.update", {
-                        "id": contact_id,
-                        "fields": {"COMPANY_ID": company_id}
-                    })
+
+            batch.add("company", "crm.company.add", {"fields": company_fields})
+            # Vincular contacto a la empresa (si se creó contacto)
+            if create_contact:
+                batch.add("contact_company", "crm.contact.update", {
+                    "id": batch.ref("contact"),
+                    "fields": {"COMPANY_ID": batch.ref("company")}
+                })
 
         # 4. Crear Deal (Negocio)
         if create_deal:
@@ -81,31 +75,36 @@ async def lead_convert(lead_id: int, deal_category_id: int = 0, chat_id: int = N
                 "OPPORTUNITY": lead.get("OPPORTUNITY", 0),
                 "CURRENCY_ID": lead.get("CURRENCY_ID", "USD")
             }
-            if contact_id: deal_fields["CONTACT_ID"] = contact_id
-            if company_id: deal_fields["COMPANY_ID"] = company_id
+            if create_contact: deal_fields["CONTACT_ID"] = batch.ref("contact")
+            if create_company: deal_fields["COMPANY_ID"] = batch.ref("company")
             if lead.get("ASSIGNED_BY_ID"): deal_fields["ASSIGNED_BY_ID"] = lead["ASSIGNED_BY_ID"]
 
-            deal_result = await call_bitrix_method("crm.deal.add", {"fields": deal_fields})
-            deal_id = deal_result.get("result")
-            
-            if deal_id:
-                entities_created.append(f"DEAL:{deal_id}")
-            else:
-                return f"Error al crear Deal: {deal_result.get('error_description')} (Entities: {entities_created})"
+            batch.add("deal", "crm.deal.add", {"fields": deal_fields})
 
-        # 5. La vinculación del chat en Bitrix24 Open Channels se hereda o se gestiona por el sistema.
         # 5. La vinculación de chat se gestiona de forma nativa por Bitrix24 en Open Channels.
         if chat_id:
-            sys.stderr.write(f"  ℹ️ Conversión para chat {chat_id}. Bitrix24 gestionará el vínculo automáticamente.\n")
+            logger.info(f"ℹ️ Conversión para chat {chat_id}. Bitrix24 gestionará el vínculo automáticamente.")
 
         # 6. Finalizar Lead (Marcar como convertido)
-        await call_bitrix_method("crm.lead.update", {
+        batch.add("lead", "crm.lead.update", {
             "id": lead_id,
             "fields": {"STATUS_ID": "CONVERTED"}
         })
 
+        res = await batch.execute()
+
+        for name, label in (("contact", "CONTACTO"), ("company", "EMPRESA"), ("deal", "DEAL")):
+            if res.ok(name):
+                entities_created.append(f"{label}:{res.get(name)}")
+
+        if res.errors:
+            failed = next(iter(res.errors))
+            if failed == "deal":
+                return f"Error al crear Deal: {res.error('deal')} (Entities: {entities_created})"
+            return f"Error convirtiendo lead ({failed}): {res.error(failed)} (Entities: {entities_created})"
+
         return f"CONVERSIÓN EXITOSA. Entidades creadas: {', '.join(entities_created)}. El Lead {lead_id} ha sido cerrado."
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en lead_convert: {e}\n")
+        logger.error(f"❌ Error en lead_convert: {e}")
         return f"Error convirtiendo lead: {e}"
@@ -1,8 +1,10 @@
 """
 Tool inteligente para calificar y avanzar Leads en el embudo de ventas.
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def lead_qualify(lead_id: int) -> str:
     """
@@ -13,7 +15,7 @@ async def lead_qualify(lead_id: int) -> str:
     - NEW -> IN_PROCESS (IDENTIFICACIÓN): Si tiene Nombre + (Teléfono o Email).
     - IN_PROCESS -> UC_7AIMVU (ASIGNACIÓN): Si tiene un Responsable humano asignado.
     """
-    sys.stderr.write(f"  🧠 Tool lead_qualify para ID: {lead_id}\n")
+    logger.info(f"🧠 Tool lead_qualify para ID: {lead_id}")
 
     try:
         # 1. Obtener datos actuales del Lead
@@ -53,7 +55,7 @@ async def lead_qualify(lead_id: int) -> str:
 
         # 3. Aplicar cambio si aplica
         if new_status and new_status != current_status:
-            sys.stderr.write(f"  ⬆️ Avanzando Lead a {new_status}...\n")
+            logger.info(f"⬆️ Avanzando Lead a {new_status}...")
             update_res = await call_bitrix_method("crm.lead.update", {
                 "id": lead_id,
                 "fields": {"STATUS_ID": new_status}
@@ -67,5 +69,5 @@ async def lead_qualify(lead_id: int) -> str:
         return f"INFO: El Lead {lead_id} se mantiene en etapa '{current_status}'. No cumple condiciones para avanzar aún."
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en lead_qualify: {e}\n")
+        logger.error(f"❌ Error en lead_qualify: {e}")
         return f"Error calificando lead: {e}"
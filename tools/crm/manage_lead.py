@@ -1,9 +1,11 @@
 """
 Tool inteligente para gestionar Leads: Busca duplicados, actualiza si existe, o crea uno nuevo.
+Usa dos batch de Bitrix24 (búsqueda + escritura) en lugar de ~8 llamadas secuenciales.
 """
-from app.auth import call_bitrix_method
-import sys
-import json
+import logging
+from app.auth import BitrixBatch
+
+logger = logging.getLogger(__name__)
 
 async def manage_lead(name: str = None, phone: str = None, email: str = None, 
                      title: str = None, chat_id: int = None, 
@@ -24,14 +26,14 @@ async def manage_lead(name: str = None, phone: str = None, email: str = None,
         source_id: Origen del lead.
         comments: Nota o contexto inicial.
     """
-    sys.stderr.write(f"  🧠 Tool manage_lead: name={name}, phone={phone}, chat_id={chat_id}\n")
+    logger.info(f"🧠 Tool manage_lead: name={name}, phone={phone}, chat_id={chat_id}")
 
     # 1. Validación mínima
     if not phone and not email:
         return "Error: Se requiere al menos un teléfono o email para gestionar el lead."
 
     try:
-        # 2. Buscar Duplicados (Estrategia: crm.duplicate.findbycomm)
+        # 2. Buscar Duplicados + metadata del chat en un solo batch (1 round trip)
         existing_lead_id = None
         existing_contact_id = None
         
@@ -42,47 +44,46 @@ async def manage_lead(name: str = None, phone: str = None, email: str = None,
             "type": "PHONE" if phone else "EMAIL",
             "values": search_values
         }
-        
-        # A) Buscar en LEADS (Intento 1: Strict)
-        try:
-            lead_res = await call_bitrix_method("crm.duplicate.findbycomm", {**params, "entity_type": "LEAD"})
-            # sys.stderr.write(f"DEBUG LEAD RES: {lead_res}\n")
-            if lead_res.get("result"):
-                leads_found = lead_res["result"]
-                if isinstance(leads_found, list) and len(leads_found) > 0:
-                    existing_lead_id = leads_found[0]
-                    sys.stderr.write(f"  🔍 Lead existente encontrado (findbycomm): {existing_lead_id}\n")
-        except Exception as e:
-            sys.stderr.write(f"  ⚠️ Error buscando lead duplicado: {e}\n")
-
-        if not existing_lead_id and phone:
-             try:
-                # Bitrix guarda telefonos en formato limpio a veces, o con formato. Buscamos exacto.
-                filter_params = {"PHONE": phone.strip()} 
-                list_res = await call_bitrix_method("crm.lead.list", {
-                    "filter": filter_params, 
-                    "select": ["ID", "TITLE", "PHONE"]
-                })
-                if list_res.get("result"):
-                    leads_list = list_res["result"]
-                    if leads_list:
-                        existing_lead_id = leads_list[0]["ID"]
-                        sys.stderr.write(f"  🔍 Lead existente encontrado (lead.list fallback): {existing_lead_id}\n")
-             except Exception as e:
-                 sys.stderr.write(f"  ⚠️ Error en fallback lead.list: {e}\n")
 
+        lookup = BitrixBatch()
+        # A) Buscar en LEADS (Intento 1: Strict)
+        lookup.add("lead_dup", "crm.duplicate.findbycomm", {**params, "entity_type": "LEAD"})
+        if phone:
+            # Fallback: Bitrix guarda telefonos en formato limpio a veces, o con formato. Buscamos exacto.
+            lookup.add("lead_list", "crm.lead.list", {
+                "filter": {"PHONE": phone.strip()},
+                "select": ["ID", "TITLE", "PHONE"]
+            })
         # B) Buscar en CONTACTOS (si no encontramos Lead, o para vincular)
-        try:
-            contact_res = await call_bitrix_method("crm.duplicate.findbycomm", {**params, "entity_type": "CONTACT"})
-            if contact_res.get("result"):
-                contacts_found = contact_res["result"]
-                if isinstance(contacts_found, list) and len(contacts_found) > 0:
-                    existing_contact_id = contacts_found[0]
-                    sys.stderr.write(f"  🔍 Contacto existente encontrado: {existing_contact_id}\n")
-        except Exception as e:
-            sys.stderr.write(f"  ⚠️ Error buscando contacto duplicado: {e}\n")
-
-        sys.stderr.write(f"  📊 Resultados Búsqueda: Lead={existing_lead_id}, Contact={existing_contact_id}\n")
+        lookup.add("contact_dup", "crm.duplicate.findbycomm", {**params, "entity_type": "CONTACT"})
+        if chat_id:
+            # Detalles del diálogo para extraer USER_CODE, LINE_ID y SESSION_ID
+            lookup.add("dialog", "imopenlines.dialog.get", {"CHAT_ID": chat_id})
+
+        found = await lookup.execute()
+
+        existing_lead_id = _first_duplicate(found.get("lead_dup"), "LEAD")
+        if existing_lead_id:
+            logger.info(f"🔍 Lead existente encontrado (findbycomm): {existing_lead_id}")
+        elif found.error("lead_dup"):
+            logger.warning(f"⚠️ Error buscando lead duplicado: {found.error('lead_dup')}")
+
+        if not existing_lead_id and found.get("lead_list"):
+            existing_lead_id = found.get("lead_list")[0]["ID"]
+            logger.info(f"🔍 Lead existente encontrado (lead.list fallback): {existing_lead_id}")
+
+        existing_contact_id = _first_duplicate(found.get("contact_dup"), "CONTACT")
+        if existing_contact_id:
+            logger.info(f"🔍 Contacto existente encontrado: {existing_contact_id}")
+        elif found.error("contact_dup"):
+            logger.warning(f"⚠️ Error buscando contacto duplicado: {found.error('contact_dup')}")
+
+        logger.info(f"📊 Resultados Búsqueda: Lead={existing_lead_id}, Contact={existing_contact_id}")
+
+        # Metadata para vincular chat a la ficha
+        chat_metadata = _chat_metadata(found.get("dialog")) if chat_id else {}
+        if chat_id and found.error("dialog"):
+            logger.warning(f"⚠️ Error obteniendo metadata del chat: {found.error('dialog')}")
 
         # 3. Preparar campos de datos (comunes para crear o actualizar)
         fields = {}
@@ -95,14 +96,15 @@ async def manage_lead(name: str = None, phone: str = None, email: str = None,
         if phone: fields["PHONE"] = [{"VALUE": phone, "VALUE_TYPE": "WORK"}]
         if email: fields["EMAIL"] = [{"VALUE": email, "VALUE_TYPE": "WORK"}]
 
-        action_taken = ""
-        final_lead_id = None
+        # 4. Escritura + vínculo del chat en un segundo batch (1 round trip).
+        # halt: si falla el lead no se crean la actividad ni la nota (referenciarían $result[lead])
+        write = BitrixBatch(halt=True)
 
         # CASO 1: Actualizar Lead Existente
         if existing_lead_id:
-            sys.stderr.write(f"  🔄 Actualizando Lead {existing_lead_id}...\n")
-            await call_bitrix_method("crm.lead.update", {"id": existing_lead_id, "fields": fields})
-            final_lead_id = existing_lead_id
+            logger.info(f"🔄 Actualizando Lead {existing_lead_id}...")
+            write.add("lead", "crm.lead.update", {"id": existing_lead_id, "fields": fields})
+            lead_ref = existing_lead_id
             action_taken = f"Lead {existing_lead_id} actualizado con nueva información."
 
         # CASO 2: Crear Nuevo Lead (Vinculado a Contacto si existe)
@@ -120,100 +122,91 @@ async def manage_lead(name: str = None, phone: str = None, email: str = None,
             else:
                 action_taken = "Nuevo Lead creado (Prospecto nuevo)."
 
-            # Metadata para vincular chat a la ficha
-            chat_metadata = {}
-            if chat_id:
-                try:
-                    # Obtener detalles del diálogo para extraer USER_CODE, LINE_ID y SESSION_ID
-                    dialog_res = await call_bitrix_method("imopenlines.dialog.get", {"CHAT_ID": chat_id})
-                    if dialog_res.get("result"):
-                        d = dialog_res["result"]
-                        # imol|workflow_whatsapp|24|573158273960|1068
-                        user_code = d.get("entity_link", {}).get("id", "") or d.get("entity_id", "")
-                        
-                        # Extraer Session ID de entity_data_1 (sexto parámetro)
-                        data_1 = d.get("entity_data_1", "")
-                        session_id = None
-                        if data_1 and "|" in data_1:
-                            parts = data_1.split("|")
-                            if len(parts) >= 6:
-                                session_id = parts[5]
-                        
-                        chat_metadata = {
-                            "USER_CODE": user_code,
-                            "LINE_ID": d.get("entity_id", "").split("|")[1] if "|" in d.get("entity_id", "") else "0",
-                            "SESSION_ID": session_id
-                        }
-                        
-                        if user_code:
-                            fields["IM"] = [{"VALUE": f"imol|{user_code}", "VALUE_TYPE": "IMOL"}]
-                            sys.stderr.write(f"  🔗 Preparado vínculo IMOL: {user_code}\n")
-                except Exception as e:
-                    sys.stderr.write(f"  ⚠️ Error obteniendo metadata del chat: {e}\n")
-
-            sys.stderr.write(f"  🆕 Creando Lead nuevo mediante crm.lead.add...\n")
-            create_res = await call_bitrix_method("crm.lead.add", {"fields": fields})
-            final_lead_id = create_res.get("result")
-            
-            if not final_lead_id:
-                return f"Error al crear lead: {create_res.get('error_description', 'Error desconocido')}"
-            
-            sys.stderr.write(f"  ✅ Lead nuevo ID: {final_lead_id}\n")
+            if chat_metadata.get("USER_CODE"):
+                fields["IM"] = [{"VALUE": f"imol|{chat_metadata['USER_CODE']}", "VALUE_TYPE": "IMOL"}]
+                logger.info(f"🔗 Preparado vínculo IMOL: {chat_metadata['USER_CODE']}")
 
-        # 4. Vincular Chat (Independientemente de si se creó o actualizó)
-        if chat_id and final_lead_id:
-            sys.stderr.write(f"  🔗 Vinculando chat {chat_id} al Lead {final_lead_id}...\n")
-            
+            logger.info(f"🆕 Creando Lead nuevo mediante crm.lead.add...")
+            write.add("lead", "crm.lead.add", {"fields": fields})
+            lead_ref = BitrixBatch.ref("lead")
+
+        if chat_id:
+            logger.info(f"🔗 Vinculando chat {chat_id} al Lead...")
             # 1. Crear ACTIVIDAD DE SESIÓN (Fuerza el vínculo visual en el Contact Center)
-            try:
-                # Si no tenemos metadata (porque fue un update), intentamos obtenerla ahora
-                if not locals().get("chat_metadata"):
-                    dialog_res = await call_bitrix_method("imopenlines.dialog.get", {"CHAT_ID": chat_id})
-                    if dialog_res.get("result"):
-                        d = dialog_res["result"]
-                        user_code = d.get("entity_link", {}).get("id", "") or d.get("entity_id", "")
-                        data_1 = d.get("entity_data_1", "")
-                        session_id = data_1.split("|")[5] if "|" in data_1 and len(data_1.split("|")) >= 6 else None
-                        chat_metadata = {
-                            "USER_CODE": user_code,
-                            "LINE_ID": d.get("entity_id", "").split("|")[1] if "|" in d.get("entity_id", "") else "0",
-                            "SESSION_ID": session_id
-                        }
-
-                if chat_metadata.get("SESSION_ID"):
-                    activity_fields = {
-                        "OWNER_ID": final_lead_id,
-                        "OWNER_TYPE_ID": 1, # Lead
-                        "TYPE_ID": 6,       # IM
-                        "PROVIDER_ID": "IMOPENLINES_SESSION",
-                        "PROVIDER_TYPE_ID": chat_metadata["LINE_ID"],
-                        "ASSOCIATED_ENTITY_ID": chat_metadata["SESSION_ID"],
-                        "SUBJECT": f"Sesión de Chat (Canal Abierto)",
-                        "COMPLETED": "Y",
-                        "DIRECTION": 1,
-                        "ORIGIN_ID": f"IMOL_{chat_metadata['SESSION_ID']}",
-                        "PROVIDER_PARAMS": {"USER_CODE": chat_metadata["USER_CODE"]}
-                    }
-                    await call_bitrix_method("crm.activity.add", {"fields": activity_fields})
-                    sys.stderr.write(f"  ⛓️ Actividad de sesión vinculada (Lead {final_lead_id}).\n")
-            except Exception as e:
-                sys.stderr.write(f"  ⚠️ Error creando actividad de vínculo: {e}\n")
+            if chat_metadata.get("SESSION_ID"):
+                write.add("activity", "crm.activity.add", {"fields": {
+                    "OWNER_ID": lead_ref,
+                    "OWNER_TYPE_ID": 1, # Lead
+                    "TYPE_ID": 6,       # IM
+                    "PROVIDER_ID": "IMOPENLINES_SESSION",
+                    "PROVIDER_TYPE_ID": chat_metadata["LINE_ID"],
+                    "ASSOCIATED_ENTITY_ID": chat_metadata["SESSION_ID"],
+                    "SUBJECT": f"Sesión de Chat (Canal Abierto)",
+                    "COMPLETED": "Y",
+                    "DIRECTION": 1,
+                    "ORIGIN_ID": f"IMOL_{chat_metadata['SESSION_ID']}",
+                    "PROVIDER_PARAMS": {"USER_CODE": chat_metadata["USER_CODE"]}
+                }})
 
             # 2. Registrar NOTA en el timeline (Backup visual)
-            try:
-                msg = f"[BOT] Gestión automática: {action_taken} (Chat ID: {chat_id})"
-                await call_bitrix_method("crm.timeline.comment.add", {
-                    "fields": {
-                        "ENTITY_ID": final_lead_id,
-                        "ENTITY_TYPE": "lead",
-                        "COMMENT": msg
-                    }
-                })
-            except Exception as e:
-                sys.stderr.write(f"  ⚠️ Warning en crm.timeline.comment.add: {e}\n")
+            write.add("note", "crm.timeline.comment.add", {
+                "fields": {
+                    "ENTITY_ID": lead_ref,
+                    "ENTITY_TYPE": "lead",
+                    "COMMENT": f"[BOT] Gestión automática: {action_taken} (Chat ID: {chat_id})"
+                }
+            })
+
+        written = await write.execute()
+
+        if not written.ok("lead"):
+            return f"Error al {'actualizar' if existing_lead_id else 'crear'} lead: {written.error('lead') or 'Error desconocido'}"
+
+        final_lead_id = existing_lead_id or written.get("lead")
+        if not existing_lead_id:
+            logger.info(f"✅ Lead nuevo ID: {final_lead_id}")
+
+        if written.ok("activity"):
+            logger.info(f"⛓️ Actividad de sesión vinculada (Lead {final_lead_id}).")
+        elif written.error("activity"):
+            logger.warning(f"⚠️ Error creando actividad de vínculo: {written.error('activity')}")
+        if written.error("note"):
+            logger.warning(f"⚠️ Warning en crm.timeline.comment.add: {written.error('note')}")
 
         return f"GESTIÓN EXITOSA: {action_taken} (ID: {final_lead_id})"
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en manage_lead: {e}\n")
+        logger.error(f"❌ Error en manage_lead: {e}")
         return f"Error gestionando lead: {e}"
+
+
+def _first_duplicate(result, entity_type: str):
+    """Primer ID de crm.duplicate.findbycomm ({"LEAD": [ids]} o lista plana)."""
+    if isinstance(result, dict):
+        result = result.get(entity_type) or []
+    if isinstance(result, list) and len(result) > 0:
+        return result[0]
+    return None
+
+
+def _chat_metadata(dialog: dict) -> dict:
+    """USER_CODE, LINE_ID y SESSION_ID a partir de imopenlines.dialog.get."""
+    if not dialog:
+        return {}
+    # imol|workflow_whatsapp|24|573158273960|1068
+    user_code = dialog.get("entity_link", {}).get("id", "") or dialog.get("entity_id", "")
+
+    # Extraer Session ID de entity_data_1 (sexto parámetro)
+    data_1 = dialog.get("entity_data_1", "")
+    session_id = None
+    if data_1 and "|" in data_1:
+        parts = data_1.split("|")
+        if len(parts) >= 6:
+            session_id = parts[5]
+
+    entity_id = dialog.get("entity_id", "")
+    return {
+        "USER_CODE": user_code,
+        "LINE_ID": entity_id.split("|")[1] if "|" in entity_id else "0",
+        "SESSION_ID": session_id
+    }
@@ -1,7 +1,7 @@
 """
 Tool to list document templates.
 """
-from app.auth import call_bitrix_method
+from app.reference_cache import cached_bitrix_call
 
 async def document_template_list(entity_type_id: int = 2) -> str:
     """
@@ -15,7 +15,7 @@ async def document_template_list(entity_type_id: int = 2) -> str:
         params["filter"] = {"entityTypeId": entity_type_id}
 
     try:
-        result = await call_bitrix_method("crm.documentgenerator.template.list", params)
+        result = await cached_bitrix_call("crm.documentgenerator.template.list", params)
         # Debug
         # print(f"DEBUG: document_template_list result: {result}")
         
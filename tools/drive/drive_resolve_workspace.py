@@ -2,8 +2,10 @@
 Tool to resolve or create a dedicated workspace folder for a CRM identity (Lead/Contact/Deal).
 Ensures that the bot only works within the "Domain of Identity".
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def drive_resolve_workspace(entity_id: int, entity_type: str, entity_name: str = "Reserva") -> str:
     """
@@ -51,5 +53,5 @@ async def drive_resolve_workspace(entity_id: int, entity_type: str, entity_name:
             return f"Nuevo workspace creado para la identidad: ID {workspace_id} (Carpeta: {folder_name})"
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en drive_resolve_workspace: {e}\n")
+        logger.error(f"❌ Error en drive_resolve_workspace: {e}")
         return f"Error al resolver el dominio de identidad: {e}"
@@ -2,8 +2,10 @@
 Tool to send direct system notifications to advisors in Bitrix24.
 Uses: im.notify.system.add
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def advisor_notify(user_id: int, message: str, access_token: str = None, domain: str = None) -> str:
     """
@@ -16,7 +18,7 @@ async def advisor_notify(user_id: int, message: str, access_token: str = None, d
     if not user_id or not message:
         return "Error: user_id and message are required."
 
-    sys.stderr.write(f"  🔔 Tool advisor_notify: User {user_id}\n")
+    logger.info(f"🔔 Tool advisor_notify: User {user_id}")
 
     params = {
         "USER_ID": user_id,
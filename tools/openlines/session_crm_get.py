@@ -1,13 +1,15 @@
+import logging
 from app.auth import call_bitrix_method
-import sys
 import json
 
+logger = logging.getLogger(__name__)
+
 async def session_crm_get(chat_id: int, access_token: str = None, domain: str = None) -> str:
     """
     Verifica si la sesión de chat actual ya tiene un CRM (Lead/Deal) vinculado.
     Usa imopenlines.dialog.get y parsea entity_data_2.
     """
-    sys.stderr.write(f"  🔍 Tool session_crm_get: chat_id={chat_id}\n")
+    logger.info(f"🔍 Tool session_crm_get: chat_id={chat_id}")
 
     try:
         params = {
@@ -25,7 +27,7 @@ async def session_crm_get(chat_id: int, access_token: str = None, domain: str =
 
         # Buscamos en entity_data_2 (formato: LEAD|0|COMPANY|0|CONTACT|51908|DEAL|10378)
         entity_data = data.get("entity_data_2", "")
-        sys.stderr.write(f"  📊 Raw entity_data_2: {entity_data}\n")
+        logger.debug(f"📊 Raw entity_data_2: {entity_data}")
         
         crm_info = {}
         if entity_data:
@@ -43,5 +45,5 @@ async def session_crm_get(chat_id: int, access_token: str = None, domain: str =
         return f"CRM VINCULADO: {json.dumps(crm_info)}"
 
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en session_crm_get: {e}\n")
+        logger.error(f"❌ Error en session_crm_get: {e}")
         return f"Error verificando CRM de sesión: {e}"
@@ -2,8 +2,10 @@
 Tool to silently read the chat history of an Open Line session.
 Uses imopenlines.session.history.get to read without being a visible participant.
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def session_history_read(session_id: int) -> str:
     """
@@ -14,7 +16,7 @@ async def session_history_read(session_id: int) -> str:
     Args:
         session_id: ID de la sesión de Open Lines a leer.
     """
-    sys.stderr.write(f"  🔍 Tool session_history_read: session_id={session_id}\n")
+    logger.info(f"🔍 Tool session_history_read: session_id={session_id}")
     
     try:
         result = await call_bitrix_method("imopenlines.session.history.get", {
@@ -42,5 +44,5 @@ async def session_history_read(session_id: int) -> str:
         return output
         
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en session_history_read: {e}\n")
+        logger.error(f"❌ Error en session_history_read: {e}")
         return f"Error leyendo historial: {e}"
@@ -1,8 +1,10 @@
 """
 Tool to list online operators for an Open Line using imopenlines.config.get.
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def session_operator_list(config_id: int = 1) -> str:
     """
@@ -12,7 +14,7 @@ async def session_operator_list(config_id: int = 1) -> str:
     Args:
         config_id: ID de la configuración de Open Line (por defecto 1).
     """
-    sys.stderr.write(f"  🔍 Tool session_operator_list: config_id={config_id}\n")
+    logger.info(f"🔍 Tool session_operator_list: config_id={config_id}")
     
     try:
         result = await call_bitrix_method("imopenlines.config.get", {
@@ -40,5 +42,5 @@ async def session_operator_list(config_id: int = 1) -> str:
         return output
         
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en session_operator_list: {e}\n")
+        logger.error(f"❌ Error en session_operator_list: {e}")
         return f"Error listando operadores: {e}"
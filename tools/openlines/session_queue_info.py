@@ -1,8 +1,10 @@
 """
 Tool to get queue configuration info for an Open Line.
 """
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def session_queue_info(config_id: int = 1) -> str:
     """
@@ -12,7 +14,7 @@ async def session_queue_info(config_id: int = 1) -> str:
     Args:
         config_id: ID de la configuración de Open Line (por defecto 1).
     """
-    sys.stderr.write(f"  🔍 Tool session_queue_info: config_id={config_id}\n")
+    logger.info(f"🔍 Tool session_queue_info: config_id={config_id}")
     
     try:
         result = await call_bitrix_method("imopenlines.config.get", {
@@ -45,5 +47,5 @@ async def session_queue_info(config_id: int = 1) -> str:
         return output
         
     except Exception as e:
-        sys.stderr.write(f"  ❌ Error en session_queue_info: {e}\n")
+        logger.error(f"❌ Error en session_queue_info: {e}")
         return f"Error consultando cola: {e}"
@@ -1,5 +1,7 @@
+import logging
 from app.auth import call_bitrix_method
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def session_title_update(chat_id: int, title: str, access_token: str = None, domain: str = None) -> str:
     """
@@ -10,7 +12,7 @@ async def session_title_update(chat_id: int, title: str, access_token: str = Non
         chat_id: ID del chat (no el DIALOG_ID, sino el ID numérico).
         title: El nuevo título para el chat.
     """
-    sys.stderr.write(f"  📝 Tool session_title_update: chat_id={chat_id}, title={title}\n")
+    logger.info(f"📝 Tool session_title_update: chat_id={chat_id}, title={title}")
 
     if not chat_id:
         return "Error: chat_id es requerido."
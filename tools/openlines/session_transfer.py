@@ -2,8 +2,11 @@
 Herramienta para transferir una sesión de Open Lines a un operador o cola.
 Usa el método: imopenlines.bot.session.transfer
 """
+import logging
 from app.auth import call_bitrix_method
 
+logger = logging.getLogger(__name__)
+
 
 async def session_transfer(chat_id: str, user_id: str = "", queue_id: str = "", access_token: str = None, domain: str = None) -> str:
     """
@@ -19,8 +22,7 @@ async def session_transfer(chat_id: str, user_id: str = "", queue_id: str = "",
     if not chat_id:
         return "Error: chat_id es requerido."
     if not user_id and not queue_id:
-        import sys
-        sys.stderr.write(f"  ⚠️ No se proporcionó user_id ni queue_id para chat {chat_id}. Usando queue_id=1 por defecto.\n")
+        logger.warning(f"⚠️ No se proporcionó user_id ni queue_id para chat {chat_id}. Usando queue_id=1 por defecto.")
         queue_id = "1"
 
     params = {"CHAT_ID": chat_id}
@@ -30,8 +32,7 @@ async def session_transfer(chat_id: str, user_id: str = "", queue_id: str = "",
         params["QUEUE_ID"] = queue_id
 
     try:
-        import sys
-        sys.stderr.write(f"  📤 Intentando transferencia: CHAT={chat_id}, USER={user_id}, QUEUE={queue_id}\n")
+        logger.info(f"📤 Intentando transferencia: CHAT={chat_id}, USER={user_id}, QUEUE={queue_id}")
         result = await call_bitrix_method("imopenlines.bot.session.transfer", params, access_token=access_token, domain=domain)
         if result.get("result"):
             dest = f"operador {user_id}" if user_id else f"cola {queue_id}"
@@ -1,9 +1,11 @@
 """
 Tool to create tasks for human follow-up in Bitrix24, with CRM linking support.
 """
+import logging
 from app.auth import call_bitrix_method
 from datetime import datetime, timedelta
-import sys
+
+logger = logging.getLogger(__name__)
 
 async def task_create(title: str, description: str, responsible_id: int = None, deadline_hours: int = 24, entity_id: int = None, entity_type: str = "LEAD") -> str:
     """
@@ -17,7 +19,7 @@ async def task_create(title: str, description: str, responsible_id: int = None,
         entity_id: ID de la entidad CRM a vincular (opcional).
         entity_type: "LEAD", "DEAL", "CONTACT", "COMPANY".
     """
-    sys.stderr.write(f"  🔍 Tool task_create: {title}\n")
+    logger.info(f"🔍 Tool task_create: {title}")
     
     if not title:
         return "Error: Falta título de la tarea."
@@ -37,21 +37,21 @@ async def verify_metrics():
     print("  📝 Logging Tool Usage...")
     await ms.log_tool_usage("test-tenant", "test_tool", True, 150.5)
     
-    # 4. Wait for async tasks
-    await asyncio.sleep(0.1)
+    # 4. Flush the buffer (normally every METRICS_FLUSH_SECONDS / on shutdown)
+    await ms.flush()
     
     # 5. Verify calls
     print("  🔍 Verifying Firestore calls...")
     
-    calls = mock_collection.add.call_args_list
-    print(f"    Calls to add(): {len(calls)}")
+    calls = mock_firestore_client.batch.return_value.set.call_args_list
+    print(f"    Calls to batch.set(): {len(calls)}")
     
     found_token = False
     found_tool = False
     
     for call in calls:
         args, kwargs = call
-        data = args[0]
+        data = args[1]
         print(f"    📄 Logged: {data.get('metricType')} - {data.get('tenantId')}")
         
         if data.get('metricType') == 'tokens' and data.get('tenantId') == 'test-tenant':
@@ -61,7 +61,7 @@ async def verify_metrics():
                 
         if data.get('metricType') == 'tool_usage' and data.get('tenantId') == 'test-tenant':
             found_tool = True
-            if data.get('toolName') == 'test_tool' and data.get('success') is True:
+            if data.get('toolName') == 'test_tool' and data.get('calls') == 1 and data.get('errors') == 0:
                  print("      ✅ Tool data matches")
             
     if found_token and found_tool: